@@ -0,0 +1,125 @@
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_instagram import MockInstagram
+
+import src.codec as codec
+from src.api import InstagramDownloader
+
+
+class FakeResponse:
+    # Just enough of requests.Response for decode_response
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def make_pages(users: int, posts: int, page_size: int, extra_fields: int):
+    mock = MockInstagram(users=users, posts=posts)
+    mock.base_url = "https://cdn.example.com"
+    # Real feed items carry a lot we never read (captions, comment previews, music, sharing info, ...)
+    filler = {f"unused_{i}": {"text": "x" * 40, "count": i, "flags": [True, False, None]} for i in range(extra_fields)}
+    pages = []
+    for account in mock.accounts.values():
+        for first in range(account["posts"], 0, -page_size):
+            items = [dict(mock.post(account, n), **filler) for n in range(first, max(first - page_size, 0), -1)]
+            pages.append(json.dumps({"items": items, "more_available": first > page_size, "next_max_id": items[-1]["pk"], "status": "ok"}).encode())
+    return pages
+
+
+def parse_pages(pages):
+    instagram = InstagramDownloader("")
+    parsed = []
+    for page in pages:
+        data = codec.decode_response(FakeResponse(page), "FeedPage")
+        for items in instagram.parse_posts_data(data["items"]):
+            parsed.extend(items)
+    return parsed
+
+
+def measure(name: str, pages, repeat: int):
+    gc.collect()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parsed = parse_pages(pages)
+        best = min(best, time.perf_counter() - start)
+        del parsed
+
+    # Memory of the parsed items that stay around for the rest of the run
+    gc.collect()
+    tracemalloc.start()
+    parsed = parse_pages(pages)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    encoded = codec.dumps(parsed)
+    encode_seconds = time.perf_counter() - start
+
+    result = {
+        "name": name,
+        "items": len(parsed),
+        "parse_items_per_second": round(len(parsed) / best),
+        "held_mb": round(held / 1024 / 1024, 2),
+        "peak_mb": round(peak / 1024 / 1024, 2),
+        "encode_ms": round(encode_seconds * 1000, 2),
+        "encoded_kb": round(len(encoded) / 1024, 1),
+    }
+    print(
+        f"{name:<10} {result['items']:>8} items {result['parse_items_per_second']:>10} items/s "
+        f"{result['held_mb']:>8.2f} MB held {result['peak_mb']:>8.2f} MB peak "
+        f"encode {result['encode_ms']:>8.2f} ms {result['encoded_kb']:>9.1f} KB"
+    )
+    return parsed, result
+
+
+def main():
+    parser = ArgumentParser("bench_decode", description="Parse throughput and memory of the dict path against --fast-json")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--extra-fields", type=int, default=40, help="Unused fields added to every item to look like a real response")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", dest="json_file", default="", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    pages = make_pages(args.users, args.posts, args.page_size, args.extra_fields)
+    print(f"{len(pages)} pages, {sum(map(len, pages)) / 1024 / 1024:.1f} MB of json")
+
+    baseline, result = measure("dict", pages, args.repeat)
+    results = [result]
+    expected = json.loads(codec.dumps(baseline))
+    if not codec.available():
+        print("msgspec / orjson not installed, only the dict path was measured")
+    else:
+        codec.enable_fast_json()
+        for name, disabled in [("msgspec", "orjson"), ("orjson", "msgspec")]:
+            if getattr(codec, name) is None:
+                continue
+            saved = getattr(codec, disabled)
+            setattr(codec, disabled, None) # Measure each library on its own
+            try:
+                parsed, result = measure(name, pages, args.repeat)
+            finally:
+                setattr(codec, disabled, saved)
+            if json.loads(codec.dumps(parsed)) != expected:
+                raise Exception(f"{name} parsed items differ from the dict path")
+            results.append(result)
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What each target may not pull in on its own, they are only needed once a download, an S3 upload or a mode of main.py starts
+HEAVY = [
+    "requests", "urllib3", "boto3", "botocore", "msgspec", "orjson", "filedate", "tqdm",
+    "http.server", "cProfile", "pstats", "multiprocessing", "concurrent.futures.process", "sqlite3", "redis",
+    "src.structs", "src.daemon", "src.distributed", "src.processes", "src.workqueue", "src.retention",
+]
+TARGETS = {
+    "src.api": "import src.api",
+    "src.library": "import src.library",
+    "main": "import runpy, sys\nsys.argv = ['main.py', '--help']\nrunpy.run_path('main.py', run_name='__main__')",
+}
+CHECK = "import sys, json\ntry:\n    exec({code!r})\nexcept SystemExit:\n    pass\nprint(json.dumps([name for name in {heavy!r} if name in sys.modules]))"
+
+
+def run(code: str):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        raise Exception(f"{code!r} failed:\n{result.stderr}")
+    return seconds, result.stdout
+
+
+def measure(name: str, code: str, repeat: int, baseline: float):
+    best = min(run(code)[0] for _ in range(repeat))
+    _, output = run(CHECK.format(code=code, heavy=HEAVY))
+    loaded = json.loads(output.splitlines()[-1])
+    result = {"name": name, "ms": round((best - baseline) * 1000, 1), "heavy": loaded}
+    print(f"{name:<12} {result['ms']:>8.1f} ms" + (f"  heavy: {', '.join(loaded)}" if loaded else ""))
+    return result
+
+
+def main():
+    parser = ArgumentParser("bench_import", description="Import time of the library and of main.py startup, over a bare interpreter")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=0, help="Fail when any target takes longer than this")
+    parser.add_argument("--json", dest="json_file", default="", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    # Timed with the bytecode cached, like an installed package. Without it (a fresh checkout, PYTHONDONTWRITEBYTECODE) every import compiles first.
+    subprocess.run([sys.executable, "-m", "compileall", "-q", "src", "main.py"], cwd=ROOT, capture_output=True, check=True)
+    baseline = min(run("pass")[0] for _ in range(args.repeat))
+    print(f"bare interpreter {baseline * 1000:.1f} ms")
+    results = [measure(name, code, args.repeat, baseline) for name, code in TARGETS.items()]
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "baseline_ms": round(baseline * 1000, 1), "results": results}, f, indent=4)
+
+    failed = [result["name"] for result in results if result["heavy"] or (args.max_ms and result["ms"] > args.max_ms)]
+    if failed:
+        print(f"Too slow or importing heavy modules: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
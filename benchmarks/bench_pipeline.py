@@ -0,0 +1,97 @@
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from mock_instagram import MockServer, add_mock_arguments, mock_from_args, write_list_file
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_downloader(server: MockServer, list_file: str, output: str, extra_args, log_file):
+    env = dict(os.environ, IG_API_HOST=server.url, NO_PROXY="127.0.0.1,localhost", PYTHONUNBUFFERED="1")
+    command = [
+        sys.executable, os.path.join(ROOT, "main.py"),
+        "--all-categories", "--input-file", list_file, "--output", output,
+        "--sleep-time", "0", "--allow-proxy",
+        *extra_args,
+    ]
+    server.mock.reset_counters()
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+
+    mock = server.mock
+    api_calls = sum(mock.api_calls.values())
+    items = mock.cdn_files
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024) # Linux reports KB
+    return {
+        "exit_code": proc.returncode,
+        "seconds": round(wall, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "items": items,
+        "bytes": mock.cdn_bytes,
+        "items_per_second": round(items / wall, 2) if wall else 0,
+        "bytes_per_second": round(mock.cdn_bytes / wall) if wall else 0,
+        "api_calls": api_calls,
+        "api_calls_per_item": round(api_calls / items, 3) if items else float(api_calls),
+        "api_calls_by_endpoint": dict(mock.api_calls),
+        "injected_errors": mock.injected_errors,
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+    }
+
+
+def print_result(name: str, result: dict):
+    print(
+        f"{name:<12} {result['seconds']:>8.2f}s {result['items']:>7} items {result['items_per_second']:>9.2f} items/s "
+        f"{result['bytes_per_second'] / 1024 / 1024:>8.2f} MB/s {result['api_calls_per_item']:>7.3f} calls/item "
+        f"{result['peak_rss_mb']:>7.1f} MB rss  exit {result['exit_code']}"
+    )
+
+
+def main():
+    parser = ArgumentParser("bench_pipeline", description="End to end benchmark of main.py against the local mock server")
+    parser.add_argument("--new-posts", type=int, default=3, help="Posts added to every account before the incremental run")
+    parser.add_argument("--downloader-args", default="", help="Extra arguments for main.py, e.g. \"--download-workers 4 -l 5\"")
+    parser.add_argument("--json", dest="json_file", default="", help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the downloaded tree and logs")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = mock_from_args(args)
+    server = MockServer(mock).start()
+    workdir = tempfile.mkdtemp(prefix="igbench_")
+    list_file = os.path.join(workdir, "list.json")
+    output = os.path.join(workdir, "media")
+    write_list_file(mock, list_file)
+    extra_args = shlex.split(args.downloader_args)
+
+    results = {}
+    try:
+        with open(os.path.join(workdir, "downloader.log"), "w") as log_file:
+            results["cold"] = run_downloader(server, list_file, output, extra_args, log_file)
+            print_result("cold", results["cold"])
+            mock.advance(new_posts=args.new_posts)
+            results["incremental"] = run_downloader(server, list_file, output, extra_args, log_file)
+            print_result("incremental", results["incremental"])
+    finally:
+        server.stop()
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=4)
+    if args.keep:
+        print("Work directory kept at", workdir)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import io
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tqdm import tqdm
+
+from src.utils import set_creation_time, write_response
+
+
+class FakeResponse:
+    def __init__(self, payload: bytes):
+        self.headers = {"content-length": str(len(payload))}
+        self.raw = io.BytesIO(payload)
+
+    def iter_content(self, chunk_size=1):
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def legacy_write(context, store_path, timestamp, desc=None):
+    # The download_item write loop before the fast path
+    total_size = int(context.headers.get("content-length", 0))
+    with open(store_path, "wb") as f, tqdm(total=total_size, unit='B', unit_scale=True, desc=desc) as pbar:
+        for chunk in context.iter_content(chunk_size=8192):
+            if chunk:
+                f.write(chunk)
+                pbar.update(len(chunk))
+    if timestamp > 0:
+        set_creation_time(store_path, timestamp)
+
+
+def fast_write(context, store_path, timestamp, desc=None):
+    write_response(context, store_path, timestamp, desc=desc)
+
+
+def run(writer, payload: bytes, files: int, folder: str):
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(files):
+        writer(FakeResponse(payload), os.path.join(folder, f"{i}.bin"), 1600000000, desc=str(i))
+    return (time.process_time() - cpu_start) / files, (time.perf_counter() - wall_start) / files
+
+
+def main():
+    parser = ArgumentParser("bench_write_path")
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="Bytes per file")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+    devnull = open(os.devnull, "w")
+    stderr, sys.stderr = sys.stderr, devnull # Keep progress bars out of the numbers
+    try:
+        results = {}
+        for name, writer in [("legacy", legacy_write), ("fast", fast_write)]:
+            with tempfile.TemporaryDirectory() as folder:
+                results[name] = run(writer, payload, args.files, folder)
+    finally:
+        sys.stderr = stderr
+        devnull.close()
+
+    for name, (cpu, wall) in results.items():
+        print(f"{name:>6}: {cpu * 1000:.2f}ms cpu/file, {wall * 1000:.2f}ms wall/file")
+    print(f"cpu speedup: {results['legacy'][0] / (results['fast'][0] or 1e-9):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
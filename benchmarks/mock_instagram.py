@@ -0,0 +1,419 @@
+import json
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+BLOCK = bytes(range(256)) * 256 # 64KB of filler streamed by the CDN
+HOUR = 60 * 60
+
+
+class MockInstagram:
+    # Synthetic accounts served through the same endpoints as src/consts.py, plus a CDN for the media bytes
+    def __init__(
+        self,
+        users: int = 10,
+        posts: int = 100,
+        carousel: int = 3,
+        carousel_ratio: float = 0.3,
+        stories: int = 5,
+        highlights: int = 3,
+        highlight_items: int = 5,
+        image_size: int = 200 * 1024,
+        video_size: int = 2 * 1024 * 1024,
+        video_ratio: float = 0.2,
+        latency: float = 0.0,
+        cdn_latency: float = 0.0,
+        rate_429: float = 0.0,
+        rate_5xx: float = 0.0,
+        seed: int = 0,
+    ):
+        self.posts = posts
+        self.carousel = carousel
+        self.carousel_ratio = carousel_ratio
+        self.stories = stories
+        self.highlights = highlights
+        self.highlight_items = highlight_items
+        self.image_size = image_size
+        self.video_size = video_size
+        self.video_ratio = video_ratio
+        self.latency = latency
+        self.cdn_latency = cdn_latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.random = random.Random(seed)
+        self.now = int(time.time())
+        self.highlights_created = self.now - 30 * 24 * HOUR # Highlights don't move with advance(), only new stories and posts do
+        self.story_epoch = 0
+        self.base_url = ""
+
+        self.accounts: Dict[str, dict] = {}
+        self.accounts_by_id: Dict[str, dict] = {}
+        for i in range(users):
+            user_id = str(1000 + i)
+            account = {"id": user_id, "username": f"user{i}", "posts": posts}
+            self.accounts[account["username"]] = account
+            self.accounts_by_id[user_id] = account
+
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self._lock:
+            self.api_calls: Dict[str, int] = {}
+            self.cdn_files = 0
+            self.cdn_bytes = 0
+            self.injected_errors = 0
+
+    def count_api(self, name: str):
+        with self._lock:
+            self.api_calls[name] = self.api_calls.get(name, 0) + 1
+
+    def count_cdn(self, size: int):
+        with self._lock:
+            self.cdn_files += 1
+            self.cdn_bytes += size
+
+    def advance(self, new_posts: int = 0, hours: int = 1):
+        # Simulate time passing between two runs: new posts and a fresh set of stories
+        for account in self.accounts.values():
+            account["posts"] += new_posts
+        self.now += hours * HOUR
+        self.story_epoch += 1
+
+    # Synthetic content
+
+    def user_object(self, account: dict):
+        pic = f"{self.base_url}/cdn/p/{account['id']}_{self.story_epoch // 24}.jpg"
+        return {
+            "pk": account["id"],
+            "id": account["id"],
+            "username": account["username"],
+            "full_name": account["username"].title(),
+            "profile_pic_url": pic,
+            "profile_pic_url_hd": pic,
+            "hd_profile_pic_url_info": {"url": pic},
+        }
+
+    def media(self, account: dict, pk: str, taken_at: int, index: int, parent: Optional[str] = None):
+        width, height = 1080, 1350
+        item = {
+            "pk": pk,
+            "id": f"{pk}_{account['id']}",
+            "user": self.user_object(account),
+            "taken_at": taken_at,
+            "audience": "",
+            "image_versions2": {"candidates": [
+                {"width": width, "height": height, "url": f"{self.base_url}/cdn/i/{pk}.jpg"},
+                {"width": width // 2, "height": height // 2, "url": f"{self.base_url}/cdn/i/{pk}_s.jpg"},
+            ]},
+        }
+        if self.video_ratio and index % max(round(1 / self.video_ratio), 1) == 0:
+            item["video_versions"] = [{"width": width, "height": height, "url": f"{self.base_url}/cdn/v/{pk}.mp4"}]
+        if parent:
+            item["carousel_parent_id"] = parent
+        return item
+
+    def post(self, account: dict, n: int):
+        pk = str(int(account["id"]) * 10 ** 7 + n)
+        taken_at = self.now - (account["posts"] - n) * 6 * HOUR
+        item = self.media(account, pk, taken_at, n)
+        if self.carousel > 1 and self.carousel_ratio and n % max(round(1 / self.carousel_ratio), 1) == 0:
+            item.pop("video_versions", None)
+            item["carousel_media"] = [
+                {k: v for k, v in self.media(account, f"{pk}{j}", taken_at, n + j, parent=pk).items() if k not in ("user", "taken_at")}
+                for j in range(self.carousel)
+            ]
+        return item
+
+    def reel(self, account: dict):
+        items = []
+        for k in range(self.stories):
+            pk = str(int(account["id"]) * 10 ** 7 + 9 * 10 ** 6 + self.story_epoch * 100 + k)
+            items.append(self.media(account, pk, self.now - (self.stories - k) * HOUR, k))
+        return {"id": account["id"], "user": self.user_object(account), "items": items}
+
+    def highlight_reel(self, highlight_id: str):
+        account = self.accounts_by_id[highlight_id[:-2]]
+        items = []
+        for k in range(self.highlight_items):
+            pk = f"{highlight_id}{k:03d}"
+            items.append(self.media(account, pk, self.highlights_created + k * HOUR, k))
+        return {"id": f"highlight:{highlight_id}", "user": self.user_object(account), "items": items}
+
+    # Endpoints
+
+    def web_profile_info(self, query):
+        account = self.accounts.get(query.get("username", [""])[0])
+        if account is None:
+            return 404, {"status": "fail"}
+        return 200, {"data": {"user": self.user_object(account)}, "status": "ok"}
+
+    def reels_media(self, query):
+        reels = {}
+        for reel_id in query.get("reel_ids", []):
+            if reel_id.startswith("highlight:"):
+                reels[reel_id] = self.highlight_reel(reel_id.split(":", 1)[1])
+            elif reel_id in self.accounts_by_id and self.stories:
+                reels[reel_id] = self.reel(self.accounts_by_id[reel_id])
+        return 200, {"reels": reels, "status": "ok"}
+
+    def feed_user(self, user_id: str, query):
+        account = self.accounts_by_id.get(user_id)
+        if account is None:
+            return 404, {"status": "fail"}
+        count = int(query.get("count", ["12"])[0] or 12)
+        max_id = query.get("max_id", [""])[0]
+        newest = account["posts"]
+        if max_id:
+            newest = int(max_id) - int(account["id"]) * 10 ** 7 - 1
+        numbers = list(range(newest, max(newest - count, 0), -1))
+        items = [self.post(account, n) for n in numbers]
+        more = bool(numbers) and numbers[-1] > 1
+        return 200, {
+            "items": items,
+            "more_available": more,
+            "next_max_id": items[-1]["pk"] if more else "",
+            "status": "ok",
+        }
+
+    def clips_user(self, form):
+        status, data = self.feed_user(form.get("target_user_id", [""])[0], {
+            "count": form.get("page_size", ["12"]),
+            "max_id": form.get("max_id", [""]),
+        })
+        if status != 200:
+            return status, data
+        return 200, {
+            "items": [{"media": item} for item in data["items"] if "carousel_media" not in item],
+            "paging_info": {"max_id": data["next_max_id"], "more_available": data["more_available"]},
+            "status": "ok",
+        }
+
+    def graphql_query(self, query):
+        variables = json.loads(query.get("variables", ["{}"])[0])
+        account = self.accounts_by_id.get(str(variables.get("user_id")))
+        if account is None:
+            return 404, {"status": "fail"}
+        edges = [
+            {"node": {
+                "id": f"{account['id']}{h:02d}",
+                "title": f"Highlight {h}",
+                "cover_media": {"thumbnail_src": f"{self.base_url}/cdn/t/{account['id']}{h:02d}.jpg"},
+            }}
+            for h in range(self.highlights)
+        ]
+        return 200, {"data": {"user": {"edge_highlight_reels": {"edges": edges}}}, "status": "ok"}
+
+    def highlights_tray(self, user_id: str):
+        account = self.accounts_by_id.get(user_id)
+        if account is None:
+            return 404, {"status": "fail"}
+        tray = [
+            {
+                "id": f"highlight:{account['id']}{h:02d}",
+                "title": f"Highlight {h}",
+                "latest_reel_media": self.highlights_created + (self.highlight_items - 1) * HOUR,
+                "media_count": self.highlight_items,
+                "cover_media": {
+                    "media_id": f"{account['id']}{h:02d}000",
+                    "cropped_image_version": {"url": f"{self.base_url}/cdn/t/{account['id']}{h:02d}.jpg"},
+                },
+            }
+            for h in range(self.highlights)
+        ]
+        return 200, {"tray": tray, "status": "ok"}
+
+    def cdn_size(self, path: str):
+        if path.startswith("/cdn/v/"):
+            return self.video_size
+        if path.startswith("/cdn/t/") or path.startswith("/cdn/p/") or path.endswith("_s.jpg"):
+            return max(self.image_size // 10, 1)
+        return self.image_size
+
+    def inject_error(self) -> Optional[int]:
+        roll = self.random.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return self.random.choice([500, 502, 503])
+        return None
+
+
+def make_handler(mock: MockInstagram):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status: int, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if not self.headers.get("Cookie", "").count("csrftoken"):
+                self.send_header("Set-Cookie", "csrftoken=mock; Path=/")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def route(self, method: str):
+            url = urlparse(self.path)
+            query = parse_qs(url.query, keep_blank_values=True)
+            path = url.path
+
+            if path.startswith("/cdn/"):
+                return self.serve_cdn(path)
+            if path == "/":
+                return self.send_json(200, {})
+
+            if method == "POST":
+                length = int(self.headers.get("Content-Length", 0))
+                query.update(parse_qs(self.rfile.read(length).decode("utf-8"), keep_blank_values=True))
+
+            routes = [
+                ("/api/v1/users/web_profile_info/", "web_profile_info", lambda: mock.web_profile_info(query)),
+                ("/api/v1/feed/reels_media/", "reels_media", lambda: mock.reels_media(query)),
+                ("/api/v1/feed/user/", "feed_user", lambda: mock.feed_user(path.strip("/").split("/")[4], query)),
+                ("/api/v1/clips/user/", "clips_user", lambda: mock.clips_user(query)),
+                ("/api/v1/highlights/", "highlights_tray", lambda: mock.highlights_tray(path.strip("/").split("/")[3])),
+                ("/graphql/query/", "graphql_profile_info", lambda: mock.graphql_query(query)),
+            ]
+            for prefix, name, handler in routes:
+                if path.startswith(prefix):
+                    mock.count_api(name)
+                    if mock.latency:
+                        time.sleep(mock.latency)
+                    error = mock.inject_error()
+                    if error:
+                        mock.injected_errors += 1
+                        return self.send_json(error, {"message": "Please wait a few minutes before you try again.", "status": "fail"})
+                    return self.send_json(*handler())
+            return self.send_json(404, {"status": "fail"})
+
+        def serve_cdn(self, path: str):
+            if mock.cdn_latency:
+                time.sleep(mock.cdn_latency)
+            error = mock.inject_error()
+            if error and error != 429: # The CDN only ever fails with server errors
+                mock.injected_errors += 1
+                self.send_response(error)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            size = mock.cdn_size(path)
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp4" if path.endswith(".mp4") else "image/jpeg")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining > 0:
+                chunk = BLOCK[:remaining]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+            mock.count_cdn(size)
+
+        def do_GET(self):
+            self.route("GET")
+
+        def do_POST(self):
+            self.route("POST")
+
+    return MockHandler
+
+
+class MockServer:
+    def __init__(self, mock: MockInstagram, host: str = "127.0.0.1", port: int = 0):
+        self.mock = mock
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(mock))
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        mock.base_url = self.url
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-instagram", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_mock_arguments(parser: ArgumentParser):
+    group = parser.add_argument_group("Mock accounts")
+    group.add_argument("--users", type=int, default=10, help="Number of synthetic accounts")
+    group.add_argument("--posts", type=int, default=100, help="Posts per account")
+    group.add_argument("--carousel", type=int, default=3, help="Items per carousel post")
+    group.add_argument("--carousel-ratio", type=float, default=0.3, help="Share of posts that are carousels")
+    group.add_argument("--stories", type=int, default=5, help="Active stories per account")
+    group.add_argument("--highlights", type=int, default=3, help="Highlights per account")
+    group.add_argument("--highlight-items", type=int, default=5, help="Items per highlight")
+    group.add_argument("--image-size", type=int, default=200 * 1024, help="Bytes per image")
+    group.add_argument("--video-size", type=int, default=2 * 1024 * 1024, help="Bytes per video")
+    group.add_argument("--video-ratio", type=float, default=0.2, help="Share of items that are videos")
+    group.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API call")
+    group.add_argument("--cdn-latency", type=float, default=0.0, help="Seconds added to every media request")
+    group.add_argument("--rate-429", type=float, default=0.0, help="Share of API calls answered with 429")
+    group.add_argument("--rate-5xx", type=float, default=0.0, help="Share of calls answered with a 5xx")
+    group.add_argument("--seed", type=int, default=0)
+
+
+def mock_from_args(args) -> MockInstagram:
+    return MockInstagram(
+        users=args.users,
+        posts=args.posts,
+        carousel=args.carousel,
+        carousel_ratio=args.carousel_ratio,
+        stories=args.stories,
+        highlights=args.highlights,
+        highlight_items=args.highlight_items,
+        image_size=args.image_size,
+        video_size=args.video_size,
+        video_ratio=args.video_ratio,
+        latency=args.latency,
+        cdn_latency=args.cdn_latency,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        seed=args.seed,
+    )
+
+
+def write_list_file(mock: MockInstagram, path: str, category: str = "MOCK"):
+    data = {
+        "categories": {category: {"sessionid": "mock", "users": sorted(mock.accounts)}},
+        "sessionids": {"mock": "mock-session"},
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+
+
+def main():
+    parser = ArgumentParser("mock_instagram", description="Local stand-in for the Instagram API and CDN")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--list-file", default="", help="Also write a list.json for the synthetic accounts here")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = mock_from_args(args)
+    server = MockServer(mock, args.host, args.port)
+    if args.list_file:
+        write_list_file(mock, args.list_file)
+        print("Wrote", args.list_file)
+    print(f"Serving {len(mock.accounts)} mock accounts on {server.url}")
+    print(f"Run the downloader with IG_API_HOST={server.url} NO_PROXY=127.0.0.1")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,500 +1,783 @@
-import json
-import os
-from argparse import ArgumentParser
-from math import ceil
-from time import sleep
-from typing import Dict, List
-
-from src.api import InstagramDownloader
-from src.consts import LIMIT, MEDIA_PATH
-from src.utils import (
-    disable_proxy,
-    download_item,
-    download_profile_pic,
-    get_extension_from_url,
-    get_time_now_as_hour,
-    get_time_now_as_week,
-    unquote_sid,
-    verify_profile_pic,
-)
-from src.validators import ListObjectType, ListUserType
-
-
-def parse_args(*args):
-    parser = ArgumentParser("InstagramDownloader")
-    parser.add_argument(
-        "users",
-        metavar="categories",
-        type=str,
-        nargs="*",
-        help="The categories that has the sessionid and the users to scrape",
-        default=["TEST"],
-    )
-    parser.add_argument(
-        "--output",
-        "-o",
-        dest="download_path",
-        type=str,
-        help="The folder to store downloaded files in.",
-        default=MEDIA_PATH,
-    )
-    parser.add_argument(
-        "--download-limit",
-        "-l",
-        dest="download_limit",
-        type=int,
-        help=f"The number of calls to do per one call. Keep it at a low number to avoid huge payload, but not too low to avoid rate limiting. (Default {LIMIT})",
-        default=LIMIT,
-    )
-
-    input_group = parser.add_argument_group(title="Input Methods")
-    input_group.add_argument(
-        "--input-file",
-        "-f",
-        type=str,
-        help="The json file to load session and users from",
-        default=os.path.join("data", "list.json"),
-    )
-    input_group.add_argument(
-        "--all-categories",
-        "-a",
-        dest="all_users",
-        action="store_true",
-        help="Automatically goes through all the categories",
-    )
-    input_group.add_argument(
-        "--session-id", "-e", type=str, help="Your session id to login as.", default=""
-    )
-    input_group.add_argument(
-        "--users",
-        "-u",
-        metavar="USERNAME",
-        dest="usernames",
-        type=str,
-        nargs="+",
-        help="The usernames to download",
-        default=[],
-    )
-
-    save_group = parser.add_argument_group(title="Download Switches")
-    save_group.add_argument(
-        "--disable-save-story",
-        "--no-story",
-        "-s",
-        dest="dl_story",
-        action="store_false",
-        help="Disable downloading Stories if on",
-    )
-    save_group.add_argument(
-        "--disable-save-posts",
-        "--no-posts",
-        "-p",
-        dest="dl_posts",
-        action="store_false",
-        help="Disable downloading Posts if on",
-    )
-    save_group.add_argument(
-        "--disable-save-reels",
-        "--no-reels",
-        "-r",
-        dest="dl_reels",
-        action="store_true", # Until I find a workaround this is store_true
-        help="Disable downloading Reels if on",
-    )
-    save_group.add_argument(
-        "--disable-save-highlights",
-        "--no-highlights",
-        "-i",
-        dest="dl_high",
-        action="store_false",
-        help="Disable downloading Highlights if on",
-    )
-
-    save_only_group = save_group.add_mutually_exclusive_group()
-    save_only_group.add_argument(
-        "--save-story-only",
-        "--only-story",
-        "-S",
-        dest="story_only",
-        action="store_true",
-        help="Download Stories only",
-    )
-    save_only_group.add_argument(
-        "--save-posts-only",
-        "--only-posts",
-        "-P",
-        dest="posts_only",
-        action="store_true",
-        help="Download Posts only",
-    )
-    save_only_group.add_argument(
-        "--save-reels-only",
-        "--only-reels",
-        "-R",
-        dest="reels_only",
-        action="store_true",
-        help="Download Reels only",
-    )
-    save_only_group.add_argument(
-        "--save-highlights-only",
-        "--only-highlights",
-        "-I",
-        dest="high_only",
-        action="store_true",
-        help="Download Highlights only",
-    )
-
-    options_group = parser.add_argument_group("Options")
-    options_group.add_argument(
-        "--allow-proxy",
-        "-x",
-        dest="bypass_proxy",
-        action="store_false",
-        help="Allow usage of os proxy. If off (default) then python will bypass proxy.",
-    )
-    options_group.add_argument(
-        "--sleep-time",
-        "-t",
-        dest="sleep_duration",
-        help="Time to wait in between requests in seconds",
-        metavar="SECONDS",
-        default=1,
-    )
-    options_group.add_argument(
-        "--no-profile-pics",
-        "-n",
-        dest="profile_pic_download",
-        help="Disable downloading profile pics",
-        action="store_false",
-    )
-
-    if args:
-        return parser.parse_args(args)
-    else:
-        return parser.parse_args()
-
-
-if __name__ == "__main__":
-
-    args = parse_args()
-
-    session_users: List[str] = args.users
-    downloads_folder: str = args.download_path
-    download_limit: int = args.download_limit
-
-    input_file: str = args.input_file
-    passed_session_id: str = args.session_id
-    passed_users: List[str] = args.usernames
-    all_users: bool = args.all_users
-
-    dl_story: bool = args.dl_story
-    dl_posts: bool = args.dl_posts
-    dl_reels: bool = args.dl_reels
-    dl_high: bool = args.dl_high
-
-    bypass_proxy: bool = args.bypass_proxy
-    sleep_duration: int = args.sleep_duration
-    profile_pic_download: bool = args.profile_pic_download
-
-    if args.story_only:
-        dl_story = args.dl_story = True
-        dl_posts = args.dl_posts = False
-        dl_reels = args.dl_reels = False
-        dl_high = args.dl_high = False
-    elif args.posts_only:
-        dl_story = args.dl_story = False
-        dl_posts = args.dl_posts = True
-        dl_reels = args.dl_reels = False
-        dl_high = args.dl_high = False
-    elif args.reels_only:
-        dl_story = args.dl_story = False
-        dl_posts = args.dl_posts = False
-        dl_reels = args.dl_reels = True
-        dl_high = args.dl_high = False
-    elif args.high_only:
-        dl_story = args.dl_story = False
-        dl_posts = args.dl_posts = False
-        dl_reels = args.dl_reels = False
-        dl_high = args.dl_high = True
-
-    if dl_reels:
-        print("Reels downloading is disable since it's triggering instagram bot detection")
-        exit(2)
-    dl_reels = False # Turn it off since it's causing issues with csrftoken logging out instagram
-
-    if bypass_proxy:
-        disable_proxy("instagram.com")
-
-    usernames_list: Dict[str, ListUserType]
-
-    def load_users_file(file_path):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                listobject: ListObjectType = json.load(f)
-                usernames_list = listobject.get("categories")
-                session_map = listobject.get("sessionids")
-        except Exception:
-            raise Exception(f"Failed to load list json: {file_path}")
-        return usernames_list, session_map
-
-    if passed_session_id or passed_users:
-        if all_users:
-            raise ValueError("When Users are passed, All Users flag cannot be used.")
-        if not passed_session_id or not passed_users:
-            raise ValueError("Session Id and Users must be passed together.")
-        try:
-            usernames_list, session_map = load_users_file(input_file)
-            found_session_id = session_map.get(passed_session_id)
-            if found_session_id is not None:
-                print("Session Id treated as Key")
-                passed_session_id = found_session_id
-        except Exception:
-            pass
-
-        session_map = {
-            "S": passed_session_id,
-        }
-        usernames_list = {
-            "passed": {
-                "sessionid": "S",
-                "users": passed_users,
-            }
-        }
-        args.users = session_users = ["passed"]
-    else:
-        usernames_list, session_map = load_users_file(input_file)
-        if all_users:
-            args.users = session_users = list(usernames_list.keys())
-
-    for session_user in session_users:
-
-        usernames = usernames_list[session_user].get("users", [])
-
-        sessionid_tag = usernames_list[session_user].get("sessionid", None)
-        if sessionid_tag is None:
-            raise Exception("Invalid Session ID Reference provided")
-
-        sessionid = session_map.get(sessionid_tag, None)
-        if sessionid is None:
-            raise Exception("Invalid Session ID provided")
-        sessionid = unquote_sid(sessionid)
-
-        instagram = InstagramDownloader(sessionid)
-
-        for username in usernames:
-            os.makedirs(os.path.join(downloads_folder, username, "meta"), exist_ok=True)
-            os.makedirs(os.path.join(downloads_folder, username, "profile_pics"), exist_ok=True)
-
-        username_mappings = {}
-        all_usernames = {}
-        users_found = set()
-        usernames_path = os.path.join(downloads_folder, "usernames.json")
-        if os.path.exists(usernames_path):
-            with open(usernames_path, "r", encoding="utf-8") as f:
-                all_usernames = json.load(f)
-                for u_id, u_name in all_usernames.items():
-                    if u_name in usernames:
-                        username_mappings[u_id] = u_name
-                        users_found.add(u_name)
-
-        time_str = get_time_now_as_week()
-        missing_profile_pic_ids = {}
-
-        us_rm = set()
-        for username in usernames:
-            if username not in users_found:
-                print(f"New user {username} detected!")
-                user = instagram.get_user_profile(username)
-                if user is None:
-                    print(f"User {username} does not existed or was deleted!")
-                    us_rm.add(username)
-                    continue
-                profile_pic = user.get("profile_pic_url_hd") or user.get("profile_pic_url") or sd_url
-                user_id = user.get("id")
-                username_mappings[user_id] = username
-                all_usernames[user_id] = username
-                download_profile_pic(profile_pic, username, downloads_folder, time_str)
-
-        if us_rm:
-            print(f"Removing a total of {len(us_rm)} deleted users!")
-        for user in us_rm:
-            usernames.remove(user)
-
-        with open(usernames_path, "w", encoding="utf-8") as f:
-            json.dump(all_usernames, f, indent=4, ensure_ascii=False)
-
-        # Traverse stories LIMIT*3 at a time
-        users = list(username_mappings.keys())
-        for i in range(0, len(usernames) if dl_story else 0, download_limit*3):
-            sleep(sleep_duration)
-            cur_users = users[i : i + download_limit*3]
-            cur_usernames = [username_mappings[uid] for uid in cur_users]
-            print("Getting stories for", " ".join(cur_usernames))
-
-            data = instagram.get_story_reels_data(cur_users)
-            missing_profile_pic_ids.update(
-                verify_profile_pic(
-                    data["reels"].values(),
-                    downloads_folder,
-                    missing_profile_pic_ids
-                )
-            )
-
-            for story_data, user_id in instagram.parse_story_reels_data(
-                data, username_mappings
-            ):
-                username = username_mappings[str(user_id)]
-                story_path = os.path.join(downloads_folder, username, "meta")
-                cur_hour = get_time_now_as_hour()
-                story_file = os.path.join(story_path, f"story_{cur_hour}.json")
-
-                with open(story_file, "w", encoding="utf-8") as f:
-                    json.dump(story_data, f, ensure_ascii=False, indent=4)
-
-                instagram.download_list(
-                    story_data, username_mappings, "stories", downloads_folder
-                )
-
-        for user_id, username in username_mappings.items() if dl_posts else []:
-            sleep(sleep_duration)
-            print("Getting posts for", username, user_id)
-
-            posts_folder = os.path.join("posts")
-            posts_meta_path = os.path.join(downloads_folder, username, "meta")
-            posts_file = os.path.join(posts_meta_path, "posts.json")
-            if os.path.exists(posts_file):
-                with open(posts_file, encoding="utf-8") as f:
-                    old_posts = json.load(f)
-            else:
-                old_posts = []
-
-            posts_data = list(instagram.get_posts_data(user_id, old_posts))
-            missing_profile_pic_ids.update(verify_profile_pic(posts_data, downloads_folder, missing_profile_pic_ids, force=True)) # Force redownload all pics, it won't take much and it's just one time, and better safe than sorry, since this is already HD.
-            full_posts = []
-            for posts in instagram.parse_posts_data(posts_data):
-                full_posts.extend(posts)
-            instagram.download_list(
-                full_posts, username_mappings, posts_folder, downloads_folder
-            )
-
-            with open(posts_file, "w", encoding="utf-8") as f:
-                json.dump(full_posts + old_posts, f, ensure_ascii=False, indent=4)
-
-        for user_id, username in username_mappings.items() if dl_reels else []:
-            sleep(sleep_duration)
-            print("Getting reels for", username, user_id)
-
-            reels_folder = os.path.join("reels")
-            reels_meta_path = os.path.join(downloads_folder, username, "meta")
-            reels_file = os.path.join(reels_meta_path, "reels.json")
-            if os.path.exists(reels_file):
-                with open(reels_file, encoding="utf-8") as f:
-                    old_reels = json.load(f)
-            else:
-                old_reels = []
-
-            reels_data = list(instagram.get_reels_data(user_id, old_reels))
-            full_reels = []
-            for reels in instagram.parse_posts_data(reels_data):
-                full_reels.extend(reels)
-            instagram.download_list(
-                full_reels, username_mappings, reels_folder, downloads_folder
-            )
-
-            with open(reels_file, "w", encoding="utf-8") as f:
-                json.dump(full_reels + old_reels, f, ensure_ascii=False, indent=4)
-
-        for user_id, username in username_mappings.items() if dl_high else []:
-            sleep(sleep_duration)
-            print("Getting highlights for", username, user_id)
-            highlights_data, highlights_ids = instagram.get_highlights_data(user_id)
-
-            for i in range(0, len(highlights_ids), download_limit):  # Walk 3 at a time
-                sleep(sleep_duration)
-                print(
-                    f"Getting page {i//download_limit +1} / {ceil(len(highlights_ids)/download_limit)}"
-                )
-                cur_h = highlights_ids[i : i + download_limit]
-                data = instagram.get_story_reels_data(cur_h)
-
-                for j, highlight in enumerate(data["reels"].values()):
-                    h_id = highlight["id"].split(":", 1)[-1]
-                    items = highlight["items"]
-                    highlights_data[h_id]["reels"].extend(
-                        instagram.parse_highlights_data(items)
-                    )
-
-                    highlights_folder = os.path.join("highlights", h_id)
-                    highlights_folder_full_path = os.path.join(
-                        downloads_folder, username, highlights_folder
-                    )
-                    print(f"Getting highlight {h_id} ({j+1}/{download_limit})")
-                    instagram.download_list(
-                        highlights_data[h_id]["reels"],
-                        username_mappings,
-                        highlights_folder,
-                        downloads_folder,
-                    )
-
-                    print("Saving name and thumbnail")
-                    thumb_url = highlights_data[h_id]["thumbnail_url"]
-                    thumb_path = os.path.join(
-                        highlights_folder_full_path,
-                        "thumbnail." + get_extension_from_url(thumb_url),
-                    )
-                    download_item(thumb_url, thumb_path, desc="thumbnail")
-                    print()
-                    with open(
-                        os.path.join(highlights_folder_full_path, "name.txt"),
-                        "w",
-                        encoding="utf-8",
-                    ) as f:
-                        f.write(highlights_data[h_id]["title"])
-
-            highlights_path = os.path.join(downloads_folder, username, "meta")
-            os.makedirs(highlights_path, exist_ok=True)
-
-            highlights_file = os.path.join(highlights_path, "highlights.json")
-            with open(highlights_file, "w", encoding="utf-8") as f:
-                json.dump(highlights_data, f, ensure_ascii=False, indent=4)
-
-        # Download profile pictures
-        if not profile_pic_download:
-            continue
-
-        print("Validating profile pictures")
-        for username in usernames:
-            if username in missing_profile_pic_ids:
-                continue
-            pro_pic_path = os.path.join(downloads_folder, username, "profile_pics")
-            pro_pic_file_path = os.path.join(pro_pic_path, "last.txt")
-            os.makedirs(pro_pic_path, exist_ok=True)
-            if username in username_mappings.values():
-                if os.path.exists(pro_pic_file_path):
-                    with open(pro_pic_file_path) as f:
-                        last_date = f.read().strip()
-                        if last_date == time_str:
-                            continue
-                print(f"Profile pic expired for {username}, getting a new one.")
-                missing_profile_pic_ids[username] = {}
-
-        for username, user_obj in missing_profile_pic_ids.items():
-            print(f"Profile pic for {username} expired. Getting a new one!")
-            sleep(sleep_duration)
-            user_id = user_obj.get("id")
-            sd_url = user_obj.get("sd_url")
-            hd_url = user_obj.get("hd_url")
-            hd_max_url = user_obj.get("hd_max_url")
-            force = False
-            if hd_max_url:
-                profile_pic = hd_max_url
-                force = True
-            elif hd_url:
-                profile_pic = hd_url
-            else:
-                user = instagram.get_user_profile(username)
-                profile_pic = user.get("profile_pic_url_hd") or user.get("profile_pic_url") or sd_url
-                user_id = user.get("id")
-            username_mappings[user_id] = username
-            all_usernames[user_id] = username
-            download_profile_pic(profile_pic, username, downloads_folder, time_str, force=force)
+import os
+import sys
+from argparse import ArgumentParser
+from time import time
+from typing import Dict, List
+
+from src.codec import dumps, enable_fast_json
+from src.consts import LIMIT, MEDIA_PATH
+from src.events import EVENTS, open_sink
+from src.index import IndexSink
+from src.jobs import JobScheduler
+from src.layout import SCHEMES
+from src.library import Options, make_runner as library_runner, run
+from src.log import LEVELS, LOG as log, PROGRESS, setup_logging
+from src.metrics import METRICS, RUN_END, RUN_START
+from src.resolver import RESOLVE_RATE, RESOLVE_WORKERS
+from src.runner import get_category_session, load_users_file
+from src.stories import StoryStore
+from src.tracing import TRACER, Profiler
+from src.utils import disable_proxy, format_size, parse_size
+from src.validators import ListUserType
+# Only what a plain run needs is imported up front, the other modes import theirs when they start
+
+def parse_args(*args):
+    parser = ArgumentParser("InstagramDownloader")
+    parser.add_argument(
+        "users",
+        metavar="categories",
+        type=str,
+        nargs="*",
+        help="The categories that has the sessionid and the users to scrape",
+        default=["TEST"],
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        dest="download_path",
+        type=str,
+        help="The folder to store downloaded files in.",
+        default=MEDIA_PATH,
+    )
+    parser.add_argument(
+        "--download-limit",
+        "-l",
+        dest="download_limit",
+        type=int,
+        help=f"The number of calls to do per one call. Keep it at a low number to avoid huge payload, but not too low to avoid rate limiting. (Default {LIMIT})",
+        default=LIMIT,
+    )
+
+    input_group = parser.add_argument_group(title="Input Methods")
+    input_group.add_argument(
+        "--input-file",
+        "-f",
+        type=str,
+        help="The json file to load session and users from",
+        default=os.path.join("data", "list.json"),
+    )
+    input_group.add_argument(
+        "--all-categories",
+        "-a",
+        dest="all_users",
+        action="store_true",
+        help="Automatically goes through all the categories",
+    )
+    input_group.add_argument(
+        "--session-id", "-e", type=str, help="Your session id to login as.", default=""
+    )
+    input_group.add_argument(
+        "--users",
+        "-u",
+        metavar="USERNAME",
+        dest="usernames",
+        type=str,
+        nargs="+",
+        help="The usernames to download",
+        default=[],
+    )
+
+    save_group = parser.add_argument_group(title="Download Switches")
+    save_group.add_argument(
+        "--disable-save-story",
+        "--no-story",
+        "-s",
+        dest="dl_story",
+        action="store_false",
+        help="Disable downloading Stories if on",
+    )
+    save_group.add_argument(
+        "--disable-save-posts",
+        "--no-posts",
+        "-p",
+        dest="dl_posts",
+        action="store_false",
+        help="Disable downloading Posts if on",
+    )
+    save_group.add_argument(
+        "--disable-save-reels",
+        "--no-reels",
+        "-r",
+        dest="dl_reels",
+        action="store_true", # Until I find a workaround this is store_true
+        help="Disable downloading Reels if on",
+    )
+    save_group.add_argument(
+        "--disable-save-highlights",
+        "--no-highlights",
+        "-i",
+        dest="dl_high",
+        action="store_false",
+        help="Disable downloading Highlights if on",
+    )
+
+    save_only_group = save_group.add_mutually_exclusive_group()
+    save_only_group.add_argument(
+        "--save-story-only",
+        "--only-story",
+        "-S",
+        dest="story_only",
+        action="store_true",
+        help="Download Stories only",
+    )
+    save_only_group.add_argument(
+        "--save-posts-only",
+        "--only-posts",
+        "-P",
+        dest="posts_only",
+        action="store_true",
+        help="Download Posts only",
+    )
+    save_only_group.add_argument(
+        "--save-reels-only",
+        "--only-reels",
+        "-R",
+        dest="reels_only",
+        action="store_true",
+        help="Download Reels only",
+    )
+    save_only_group.add_argument(
+        "--save-highlights-only",
+        "--only-highlights",
+        "-I",
+        dest="high_only",
+        action="store_true",
+        help="Download Highlights only",
+    )
+
+    options_group = parser.add_argument_group("Options")
+    options_group.add_argument(
+        "--allow-proxy",
+        "-x",
+        dest="bypass_proxy",
+        action="store_false",
+        help="Allow usage of os proxy. If off (default) then python will bypass proxy.",
+    )
+    options_group.add_argument(
+        "--sleep-time",
+        "-t",
+        dest="sleep_duration",
+        type=float,
+        help="Time to wait in between requests in seconds",
+        metavar="SECONDS",
+        default=1,
+    )
+    options_group.add_argument(
+        "--no-profile-pics",
+        "-n",
+        dest="profile_pic_download",
+        help="Disable downloading profile pics",
+        action="store_false",
+    )
+    options_group.add_argument(
+        "--bandwidth-limit",
+        "-b",
+        dest="bandwidth_limit",
+        type=parse_size,
+        metavar="BYTES",
+        help="Global download speed cap in bytes per second, shared fairly between users (e.g. 500K, 2M). 0 for unlimited.",
+        default=0,
+    )
+    options_group.add_argument(
+        "--metrics-file",
+        dest="metrics_file",
+        type=str,
+        metavar="PATH",
+        help="Write Prometheus metrics for the run to this textfile when done (e.g. for the node exporter textfile collector).",
+        default="",
+    )
+    options_group.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        metavar="PORT",
+        help="Serve Prometheus metrics on this local port while running. 0 to disable.",
+        default=0,
+    )
+    options_group.add_argument(
+        "--trace",
+        dest="trace_file",
+        type=str,
+        metavar="PATH",
+        help="Record a Chrome trace / Perfetto JSON of the run (categories, users, phases, pages and media items) to this file.",
+        default="",
+    )
+    options_group.add_argument(
+        "--profile",
+        dest="profile_file",
+        type=str,
+        metavar="PATH",
+        help="Run under cProfile and write a summary of the hot spots to this file (raw stats go to PATH.prof).",
+        default="",
+    )
+    daemon_group = parser.add_argument_group("Daemon Mode")
+    daemon_group.add_argument(
+        "--daemon",
+        "-d",
+        dest="daemon",
+        action="store_true",
+        help="Keep running and poll every user on its own schedule, learned from how often they post.",
+    )
+    daemon_group.add_argument(
+        "--freshness",
+        dest="freshness",
+        type=float,
+        metavar="SECONDS",
+        help="Shortest time between two polls of the same user, used for the most active accounts. (Default 1800)",
+        default=30 * 60,
+    )
+    daemon_group.add_argument(
+        "--max-interval",
+        dest="max_interval",
+        type=float,
+        metavar="SECONDS",
+        help="Longest time between two posts polls of a quiet user. Stories are always polled before they can expire. (Default 259200)",
+        default=3 * 24 * 60 * 60,
+    )
+    distributed_group = parser.add_argument_group("Distributed Mode")
+    distributed_group.add_argument(
+        "--queue",
+        dest="queue_url",
+        type=str,
+        metavar="URL",
+        help="Shared work queue for --coordinator and --worker: redis://host:6379/0, or a SQLite file on storage every node can reach (sqlite:///mnt/media/queue.db).",
+        default="",
+    )
+    distributed_group.add_argument(
+        "--coordinator",
+        dest="coordinator",
+        action="store_true",
+        help="Resolve the users of the selected categories, queue one job per user and phase and wait until the workers are done.",
+    )
+    distributed_group.add_argument(
+        "--worker",
+        dest="worker",
+        action="store_true",
+        help="Run queued jobs of the selected categories with the sessions from this node's list file, until the coordinator is done.",
+    )
+    distributed_group.add_argument(
+        "--worker-id",
+        dest="worker_id",
+        type=str,
+        help="Name of this worker in the queue. (Default hostname:pid)",
+        default="",
+    )
+    distributed_group.add_argument(
+        "--lease-time",
+        dest="lease_time",
+        type=float,
+        metavar="SECONDS",
+        help="How long a job stays with a worker that stopped responding before another one gets it. (Default 300)",
+        default=300,
+    )
+    distributed_group.add_argument(
+        "--start-timeout",
+        dest="start_timeout",
+        type=float,
+        metavar="SECONDS",
+        help="How long a worker waits for a coordinator to open the queue before it gives up. (Default 600)",
+        default=600,
+    )
+    distributed_group.add_argument(
+        "--stall-timeout",
+        dest="stall_timeout",
+        type=float,
+        metavar="SECONDS",
+        help="How long the coordinator waits with jobs queued and no worker running any before it gives up on them. (Default 1800)",
+        default=1800,
+    )
+    options_group.add_argument(
+        "--storage",
+        dest="storage_url",
+        type=str,
+        metavar="URL",
+        help="Write media and metadata to S3 compatible object storage (s3://bucket/prefix) instead of the output folder, paths inside stay the same. Needs boto3.",
+        default="",
+    )
+    options_group.add_argument(
+        "--storage-endpoint",
+        dest="storage_endpoint",
+        type=str,
+        metavar="URL",
+        help="Endpoint of the object storage, e.g. http://127.0.0.1:9000 for a local MinIO. (Default AWS, or $AWS_ENDPOINT_URL)",
+        default="",
+    )
+    options_group.add_argument(
+        "--fast-json",
+        dest="fast_json",
+        action="store_true",
+        help="Decode API responses with msgspec (or orjson) into compact typed items and write metadata json without indentation. Needs msgspec or orjson.",
+    )
+    options_group.add_argument(
+        "--events",
+        dest="event_targets",
+        action="append",
+        metavar="TARGET",
+        help="Write an event for every file downloaded, linked, skipped or failed and every metadata update, as json lines. "
+        "TARGET is a log file (rotated), unix:///path or tcp://host:port for a listening socket, or exec:COMMAND to pipe them into a command. Can be repeated.",
+        default=[],
+    )
+    options_group.add_argument(
+        "--events-max-size",
+        dest="events_max_size",
+        type=parse_size,
+        metavar="BYTES",
+        help="Rotate the event log once it reaches this size. (Default 64M)",
+        default=64 * 1024 * 1024,
+    )
+    options_group.add_argument(
+        "--events-backups",
+        dest="events_backups",
+        type=int,
+        help="Rotated event logs to keep. (Default 5)",
+        default=5,
+    )
+    options_group.add_argument(
+        "--compact-stories",
+        dest="compact_stories",
+        action="store_true",
+        help="Fold the story logs of the selected users into meta/stories.json, importing and removing old story_{hour}.json files, then exit.",
+    )
+    options_group.add_argument(
+        "--story-hour",
+        dest="story_hour",
+        type=str,
+        metavar="DD-MM-YY_HH",
+        help="Write the stories of the selected users as they were during that hour (UTC) to stdout as json, like the old story_{hour}.json files, then exit. Logs go to stderr instead.",
+        default="",
+    )
+    options_group.add_argument(
+        "--migrate-layout",
+        dest="migrate_layout",
+        choices=SCHEMES,
+        help="Move the stories, posts and reels of every user in the output folder into this layout and use it from now on, then exit. "
+        "month makes year/month folders from when they were posted, hash spreads them over 256 folders by media id, flat is how it always was.",
+        default="",
+    )
+    options_group.add_argument(
+        "--resolve-rate",
+        dest="resolve_rate",
+        type=float,
+        metavar="PER_SECOND",
+        help=f"Profile lookups per second and session when resolving new users, they run {RESOLVE_WORKERS} at a time. 0 for no limit. (Default {RESOLVE_RATE:g})",
+        default=RESOLVE_RATE,
+    )
+    retention_group = parser.add_argument_group("Retention")
+    retention_group.add_argument(
+        "--retain",
+        dest="retention_policies",
+        action="append",
+        metavar="POLICY",
+        help="Remove media of the selected users after the run by COLLECTION:RULES, e.g. profile_pics:keep=3, story_history:days=30, "
+        "video_thumbnails:days=90, tagged:dedupe or all:max_size=20G,order=lru. COLLECTION is a folder in the user's folder, tagged, "
+        "video_thumbnails, all or story_history, RULES are keep=N, days=D, max_size=SIZE with order=oldest|lru, and dedupe. Can be repeated.",
+        default=[],
+    )
+    retention_group.add_argument(
+        "--prune",
+        dest="prune",
+        action="store_true",
+        help="Only apply the --retain policies to the selected users, without downloading anything, then exit.",
+    )
+    retention_group.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Report what the --retain policies would remove instead of removing it.",
+    )
+    retention_group.add_argument(
+        "--rebuild-index",
+        dest="rebuild_index",
+        action="store_true",
+        help="Walk the folders of the selected users once to index the files that were downloaded before meta/media.jsonl existed, then exit.",
+    )
+    options_group.add_argument(
+        "--time-budget",
+        dest="time_budget",
+        type=float,
+        metavar="SECONDS",
+        help="Stop starting backfill work (older posts of new users) after this many seconds, it picks up where it left off next run. Stories and new posts always run. (Default 0, no limit)",
+        default=0,
+    )
+    options_group.add_argument(
+        "--log-level",
+        dest="log_level",
+        choices=LEVELS,
+        help="Least important messages to show, debug shows every file. (Default info)",
+        default="info",
+    )
+    options_group.add_argument(
+        "--log-format",
+        dest="log_format",
+        choices=["text", "json"],
+        help="json writes every message as one json object per line. (Default text)",
+        default="text",
+    )
+    options_group.add_argument(
+        "--quiet",
+        "-q",
+        dest="quiet",
+        action="store_true",
+        help="For cron and scripts: only warnings, errors and the progress lines, all as json. Same as --log-level warning --log-format json.",
+    )
+    options_group.add_argument(
+        "--progress",
+        dest="progress",
+        choices=["auto", "bar", "log", "off"],
+        help="One progress line for the whole run. bar redraws it in place, log writes it every --progress-interval. (Default auto, bar on a terminal)",
+        default="auto",
+    )
+    options_group.add_argument(
+        "--progress-interval",
+        dest="progress_interval",
+        type=float,
+        metavar="SECONDS",
+        help="Seconds between progress updates. (Default 0.5 for the bar, 30 otherwise)",
+        default=0,
+    )
+    options_group.add_argument(
+        "--processes",
+        dest="processes",
+        type=int,
+        help="Run the categories in this many processes at once, each with its own session and connections. --bandwidth-limit is shared between them. (Default 1)",
+        default=1,
+    )
+    options_group.add_argument(
+        "--split-users",
+        dest="split_users",
+        action="store_true",
+        help="With --processes, also split the users of big categories over the processes when there are fewer categories than processes. They use the same session then.",
+    )
+    options_group.add_argument(
+        "--process-logs",
+        dest="process_log_dir",
+        type=str,
+        metavar="FOLDER",
+        help="With --processes, where the output of each process goes. (Default logs)",
+        default="logs",
+    )
+    options_group.add_argument(
+        "--download-workers",
+        "-w",
+        dest="download_workers",
+        type=int,
+        help="Number of media files to download at once. Smaller files are downloaded first. (Default 0, download one by one)",
+        default=0,
+    )
+
+    if args:
+        return parser.parse_args(args)
+    else:
+        return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    log_level: str = "warning" if args.quiet else args.log_level
+    log_format: str = "json" if args.quiet else args.log_format
+    setup_logging(log_level, log_format, sys.stderr if args.story_hour else None) # Keep stdout to the json of --story-hour
+
+    session_users: List[str] = args.users
+    downloads_folder: str = args.download_path
+    download_limit: int = args.download_limit
+
+    input_file: str = args.input_file
+    passed_session_id: str = args.session_id
+    passed_users: List[str] = args.usernames
+    all_users: bool = args.all_users
+
+    dl_story: bool = args.dl_story
+    dl_posts: bool = args.dl_posts
+    dl_reels: bool = args.dl_reels
+    dl_high: bool = args.dl_high
+
+    bypass_proxy: bool = args.bypass_proxy
+    sleep_duration: float = args.sleep_duration
+    profile_pic_download: bool = args.profile_pic_download
+    bandwidth_limit: int = args.bandwidth_limit
+    download_workers: int = args.download_workers
+    metrics_file: str = args.metrics_file
+    metrics_port: int = args.metrics_port
+    trace_file: str = args.trace_file
+    profile_file: str = args.profile_file
+    daemon: bool = args.daemon
+    time_budget: float = args.time_budget
+    queue_url: str = args.queue_url
+    coordinator: bool = args.coordinator
+    worker: bool = args.worker
+    storage_url: str = args.storage_url
+    fast_json: bool = args.fast_json
+    processes: int = args.processes
+    retention_policies = []
+    if args.retention_policies or args.prune:
+        from src.retention import Retention, parse_policies
+        retention_policies = parse_policies(args.retention_policies)
+
+    if args.story_only:
+        dl_story = args.dl_story = True
+        dl_posts = args.dl_posts = False
+        dl_reels = args.dl_reels = False
+        dl_high = args.dl_high = False
+    elif args.posts_only:
+        dl_story = args.dl_story = False
+        dl_posts = args.dl_posts = True
+        dl_reels = args.dl_reels = False
+        dl_high = args.dl_high = False
+    elif args.reels_only:
+        dl_story = args.dl_story = False
+        dl_posts = args.dl_posts = False
+        dl_reels = args.dl_reels = True
+        dl_high = args.dl_high = False
+    elif args.high_only:
+        dl_story = args.dl_story = False
+        dl_posts = args.dl_posts = False
+        dl_reels = args.dl_reels = False
+        dl_high = args.dl_high = True
+
+    if dl_reels:
+        log.error("Reels downloading is disabled since it's triggering instagram bot detection")
+        exit(2)
+    dl_reels = False # Turn it off since it's causing issues with csrftoken logging out instagram
+
+    if bypass_proxy:
+        disable_proxy("instagram.com")
+
+    usernames_list: Dict[str, ListUserType]
+
+    if passed_session_id or passed_users:
+        if all_users:
+            raise ValueError("When Users are passed, All Users flag cannot be used.")
+        if not passed_session_id or not passed_users:
+            raise ValueError("Session Id and Users must be passed together.")
+        try:
+            usernames_list, session_map = load_users_file(input_file)
+            found_session_id = session_map.get(passed_session_id)
+            if found_session_id is not None:
+                log.info("Session Id treated as Key")
+                passed_session_id = found_session_id
+        except Exception:
+            pass
+
+        session_map = {
+            "S": passed_session_id,
+        }
+        usernames_list = {
+            "passed": {
+                "sessionid": "S",
+                "users": passed_users,
+            }
+        }
+        args.users = session_users = ["passed"]
+    else:
+        usernames_list, session_map = load_users_file(input_file)
+        if all_users:
+            args.users = session_users = list(usernames_list.keys())
+
+    if fast_json:
+        enable_fast_json()
+    for target in args.event_targets:
+        EVENTS.add_sink(open_sink(target, args.events_max_size, args.events_backups))
+
+    profiler = None
+    if profile_file:
+        profiler = Profiler(profile_file)
+        profiler.start()
+    if trace_file:
+        TRACER.enable()
+
+    options = Options(
+        downloads_folder,
+        stories=dl_story,
+        posts=dl_posts,
+        highlights=dl_high,
+        profile_pics=profile_pic_download,
+        download_limit=download_limit,
+        sleep_duration=sleep_duration,
+        bandwidth_limit=bandwidth_limit,
+        download_workers=download_workers,
+        storage_url=storage_url,
+        storage_endpoint=args.storage_endpoint,
+        time_budget=time_budget,
+        resolve_rate=args.resolve_rate,
+    )
+    transfers = options.transfers()
+    storage = options.storage()
+    selected_users = [username for category in session_users for username in usernames_list[category].get("users", [])]
+    if args.rebuild_index or args.prune:
+        if args.rebuild_index:
+            from src.index import rebuild_index
+            for username in selected_users:
+                log.info("Indexed %d files of %s", rebuild_index(storage, downloads_folder, username), username)
+        if args.prune:
+            Retention(retention_policies, storage, downloads_folder, args.dry_run).run(selected_users)
+        EVENTS.close()
+        exit(0)
+    if args.migrate_layout:
+        from src.layout import migrate
+        moved = migrate(storage, downloads_folder, args.migrate_layout)
+        log.info("Moved %d files, %s now uses the %s layout", moved, downloads_folder, args.migrate_layout)
+        EVENTS.close()
+        exit(0)
+    if args.compact_stories or args.story_hour:
+        stories = StoryStore(storage, downloads_folder)
+        hour_view = {}
+        for category in session_users:
+            for username in usernames_list[category].get("users", []):
+                if args.compact_stories:
+                    removed = stories.compact(username)
+                    log.info("Compacted stories of %s%s", username, f", imported {removed} hourly files" if removed else "")
+                if args.story_hour:
+                    items = stories.view(username, args.story_hour)
+                    if items is not None:
+                        hour_view[username] = items
+        if args.story_hour:
+            sys.stdout.write(dumps(hour_view).decode("utf-8") + "\n")
+        EVENTS.close()
+        exit(0)
+
+    index = None
+    if daemon or not coordinator: # A coordinator only queues jobs, its workers index what they download
+        index = IndexSink(storage, downloads_folder)
+        EVENTS.add_sink(index)
+
+    METRICS.gauge("ig_transfer_bytes_per_second", "Current media download speed.", callback=lambda: transfers.stats()["bytes_per_second"])
+    METRICS.gauge("ig_transfers_pending", "Media downloads waiting in the queue.", callback=lambda: transfers.stats()["pending"])
+    RUN_START.set(time())
+    RUN_END.set(0)
+    if metrics_port:
+        METRICS.serve(metrics_port)
+        log.info("Serving metrics on http://127.0.0.1:%d/metrics", metrics_port)
+    if processes <= 1:
+        PROGRESS.add_gauge("downloads", lambda: transfers.stats()["pending"])
+    PROGRESS.start(args.progress, args.progress_interval)
+
+    def make_runner(category, usernames_list, session_map):
+        return library_runner(category, usernames_list, session_map, options, transfers, storage)
+
+    if daemon:
+        from src.daemon import Daemon
+        last_retention = 0.0
+
+        def after_cycle():
+            global last_retention
+            if retention_policies and time() - last_retention > 60 * 60: # Hourly is plenty
+                last_retention = time()
+                index.flush()
+                Retention(retention_policies, storage, downloads_folder, args.dry_run).run(selected_users)
+            if metrics_file:
+                METRICS.write_textfile(metrics_file)
+
+        Daemon(
+            {category: make_runner(category, usernames_list, session_map) for category in session_users},
+            downloads_folder,
+            make_runner=make_runner if all_users else None, # New categories are only picked up when running all of them
+            input_file=input_file if not passed_users else "",
+            dl_story=dl_story,
+            dl_posts=dl_posts,
+            dl_high=dl_high,
+            freshness=args.freshness,
+            max_interval=args.max_interval,
+            after_cycle=after_cycle,
+            storage=storage,
+        ).run_forever()
+
+    if coordinator or worker:
+        if not queue_url:
+            raise ValueError("--coordinator and --worker need a --queue")
+        from src.distributed import Coordinator, Worker
+        from src.workqueue import open_queue
+        queue = open_queue(queue_url)
+        if coordinator:
+            Coordinator(
+                queue,
+                {category: make_runner(category, usernames_list, session_map) for category in session_users},
+                dl_story=dl_story,
+                dl_posts=dl_posts,
+                dl_high=dl_high,
+                stall_timeout=args.stall_timeout,
+            ).run()
+        else:
+            Worker(
+                queue,
+                lambda category: make_runner(category, usernames_list, session_map),
+                session_users,
+                worker_id=args.worker_id,
+                lease_time=args.lease_time,
+                start_timeout=args.start_timeout,
+            ).run()
+        queue.close()
+
+    failed_shards = []
+    if processes > 1 and not (daemon or coordinator or worker):
+        from collections import Counter
+        from src.processes import make_shards, run_processes
+        shards = make_shards(usernames_list, session_users, processes, args.split_users)
+        if not shards: # Every user filtered out, there is nothing to split the bandwidth and the sessions over
+            log.warning("No users to download")
+            deferred = 0
+        else:
+            failed_shards, deferred = run_processes(
+                shards,
+                {category: get_category_session(usernames_list, session_map, category) for category, _ in shards},
+                {
+                    "downloads_folder": downloads_folder,
+                    "storage_url": storage_url,
+                    "storage_endpoint": args.storage_endpoint,
+                    "bandwidth_limit": bandwidth_limit // min(processes, len(shards)),
+                    "download_workers": download_workers,
+                    "download_limit": download_limit,
+                    "sleep_duration": sleep_duration,
+                    "profile_pic_download": profile_pic_download,
+                    "resolve_rate": args.resolve_rate / max(Counter(category for category, _ in shards).values()), # Split categories share their session
+                    "time_budget": time_budget,
+                    "fast_json": fast_json,
+                    "dl_story": dl_story,
+                    "dl_posts": dl_posts,
+                    "dl_high": dl_high,
+                    "log_dir": args.process_log_dir,
+                    "log_level": log_level,
+                    "log_format": log_format,
+                },
+                processes,
+            )
+        if deferred:
+            log.warning("Time budget used up, %d backfill jobs left for the next run", deferred)
+        session_users = []
+
+    jobs = JobScheduler(time_budget)
+    PROGRESS.add_gauge("jobs", jobs.pending)
+    run(usernames_list, session_map, options, session_users if not (daemon or coordinator or worker) else [], transfers, storage, jobs)
+    if jobs.deferred:
+        log.warning("Time budget used up, %d backfill jobs left for the next run", len(jobs.deferred))
+
+    if retention_policies and not (coordinator or worker):
+        index.flush() # So this run's downloads are in the index too
+        Retention(retention_policies, storage, downloads_folder, args.dry_run).run(selected_users)
+
+    PROGRESS.stop()
+    stats = transfers.stats()
+    if processes <= 1 or daemon or coordinator or worker: # Each process has its own, the totals are in the progress line
+        log.info(
+            "Transferred %s in %d files (%s/s, %d failed)",
+            format_size(stats["bytes"]), stats["completed"], format_size(stats["average_bytes_per_second"]), stats["failed"],
+        )
+    transfers.close()
+
+    RUN_END.set(time())
+    if metrics_file:
+        METRICS.write_textfile(metrics_file)
+        log.info("Metrics written to %s", metrics_file)
+    METRICS.stop()
+    EVENTS.close()
+
+    if trace_file:
+        TRACER.write(trace_file)
+        log.info(TRACER.summary())
+        log.info("Trace written to %s", trace_file)
+    if profiler is not None:
+        profiler.stop()
+        log.info("Profile written to %s", profile_file)
+
+    if failed_shards:
+        exit(1)
@@ -1,331 +1,418 @@
-import json
-import os
-import shutil
-from typing import Dict, Iterable, List, Optional
-
-import requests
-from tqdm import tqdm
-
-from src.consts import (FEED_API, IG_HEADERS, PROFILE_INFO_GRAPH_API, REELS_API,
-                        STORY_API, USER_ID_API)
-from src.utils import download_item, get_extension_from_url, set_creation_time
-from src.validators import ClipsItemType, ParsedItemType, ParsedTagUserType, ReelItemType, UserMediaTagType, UserType
-
-
-class InstagramDownloader:
-    def __init__(self, sessionid):
-        self.__init_session__(sessionid)
-
-    def __init_session__(self, sessionid):
-        self.session = requests.Session()
-        self.session.cookies.set("sessionid", sessionid, domain=".instagram.com", path="/")
-
-    def _get_csrf_token(self, url: str = ""):
-        for _ in range(10): # Max 10 attempts to get csrftoken
-            if not self.session.cookies.get("csrftoken"):
-                self.session.get(url or "https://instagram.com/")
-            token = self.session.cookies.get("csrftoken")
-            if token:
-                return token
-        raise Exception("Time out while getting csrftoken")
-
-    def _get_request(self, url, timeout: float = 0, override_header: Optional[dict] = {}, auth: bool = True):
-        headers = override_header or IG_HEADERS
-        # requestor = self.session if auth else requests # Instagram not allowing, need to figure out reason
-        requestor = self.session
-        if not timeout:
-            return requestor.get(url, headers=headers)
-        return requestor.get(url, headers=headers, timeout=timeout)
-
-    def _post_request(self, url, body: Iterable, timeout: float = 0, override_header: Optional[dict] = {}, auth: bool = True):
-        headers = override_header or IG_HEADERS
-        more_headers = {
-            "x-csrftoken": self._get_csrf_token(url),
-            "content-type": "application/x-www-form-urlencoded"
-        }
-        headers={**headers, **more_headers}
-        requestor = self.session
-        if not timeout:
-            return requestor.post(url, headers=headers, data=body)
-        return requestor.post(url, headers=headers, data=body, timeout=timeout)
-
-    def get_user_profile(self, username: str):
-        r = self._get_request(USER_ID_API.format(username=username), timeout=5, auth=False)
-        if r.status_code == 404:
-            return None
-        user: UserType = r.json()["data"]["user"]
-        return user
-
-    def get_story_reels_data(self, reel_ids: Iterable[str]):
-        url = STORY_API.format(ids_string='&reel_ids='.join(reel_ids))
-        r = self._get_request(url)
-        return r.json()
-
-    def parse_story_reels_data(self, data, known_mappings):
-        for reel in data["reels"].values():
-            user_id = reel_id = reel["id"]
-            username = known_mappings.get(str(user_id), "Unknown")
-
-            print("Parsing stories for", username)
-
-            items: List[ReelItemType] = reel["items"]
-            story_data = []
-            for item in items:
-                story_item = self.parse_reel_item(item)
-                story_data.append(story_item)
-
-            yield story_data, user_id
-
-    def parse_highlights_data(self, data):
-        for item in data:
-            yield self.parse_reel_item(item)
-
-    def get_all_posts_data(self, user_id):
-        yield from self.get_posts_data(user_id, [])
-
-    def get_reels_data(self, user_id, old_posts = []):
-        next_id = ""
-        has_more = True
-        posts_count = 0
-
-        old_posts = {p["id"] for p in old_posts}
-
-        ctr = 1
-
-        while has_more:
-            print(f"Getting page {ctr} of reels", end = "")
-            body = {
-                "target_user_id": user_id,
-                "page_size": posts_count or 1,
-                "include_feed_video": True,
-                "max_id": next_id,
-            }
-            # url = REELS_API.format(**body)
-            url = REELS_API
-            r = self._post_request(url, body=body)
-            data: ClipsItemType = r.json()
-
-            paging_info = data.get("paging_info")
-            has_more = paging_info.get("more_available", False)
-            print(" with more to come" if has_more else "")
-
-            next_id = paging_info.get("max_id", "")
-            if not posts_count:
-                posts_count = 50
-
-            done = False
-            for item in data["items"]:
-                item = item["media"]
-                item_id = item["pk"]
-                if item_id in old_posts:
-                    done = True
-                    break
-                yield item
-            ctr += 1
-            if done:
-                break
-
-    def get_posts_data(self, user_id, old_posts = []):
-        next_id = ""
-        has_more = True
-        posts_count = 0
-
-        old_posts = {p["id"] for p in old_posts}
-
-        ctr = 1
-
-        while has_more:
-            print(f"Getting page {ctr} of posts", end = "")
-            url = FEED_API.format(
-                user_id=user_id,
-                count=posts_count or 1,
-                last_post_id=next_id,
-            )
-            r = self._get_request(url)
-            data = r.json()
-
-            has_more = data.get("more_available", False)
-            print(" with more to come" if has_more else "")
-            next_id = data.get("next_max_id", "")
-            if not posts_count:
-                posts_count = 50
-
-            done = False
-            for item in data["items"]:
-                item_id = item["pk"]
-                if item_id in old_posts:
-                    done = True
-                    break
-                yield item
-            ctr += 1
-            if done:
-                break
-
-    def parse_posts_data(self, posts):
-        for item in posts:
-            post_items = self.parse_post_item(item)
-            if not post_items:
-                continue
-            yield post_items
-
-    def get_highlights_data(self, user_id, needs_auth = True):
-        variables = {
-            "user_id": user_id,
-            "include_chaining": False,
-            "include_reel": False,
-            "include_suggested_users": False,
-            "include_logged_out_extras": False,
-            "include_highlight_reels": True,
-            "include_live_status": True,
-        }
-        string_vars = json.dumps(variables)
-        url = PROFILE_INFO_GRAPH_API.format(variables=string_vars)
-        r = self._get_request(url, auth=needs_auth) # Auth is when profile is private
-        data = r.json()
-
-        highlights_data = {
-            edge["node"]["id"]: {
-                "title": edge["node"]["title"],
-                "id": edge["node"]["id"],
-                "reels": [],
-                "thumbnail_url": edge["node"]["cover_media"]["thumbnail_src"],
-                } for edge in data["data"]["user"]["edge_highlight_reels"]["edges"]
-        }
-        highlights_ids = [f"highlight:{highlight_id}" for highlight_id in highlights_data.keys()]
-
-        return highlights_data, highlights_ids
-
-    def parse_reel_item(self, item: ReelItemType) -> ParsedItemType:
-        item_id = item["pk"]
-        owner = item["user"]["pk"]
-        owner_user = item["user"].get("username", "")
-        timestamp = item.get("taken_at", 0)
-        parent_id = item.get("carousel_parent_id") or item.get("parent_id")
-        close_friends_only = item.get("audience", "") == "besties"
-        has_images = "image_versions2" in item
-        has_video = "video_versions" in item
-        biggest_photo = max(item["image_versions2"]["candidates"], key=lambda x: x["width"] * x["height"])["url"]
-        biggest_video = ""
-        if has_video:
-            biggest_video = max(item["video_versions"], key=lambda x: x["width"] * x["height"])["url"]
-        if not has_images:
-            raise Exception(f"Failed to find image {item_id} for reel")
-        usertags: Dict[str, List[UserMediaTagType]] = item.get("usertags", {})
-
-        tags: List[ParsedTagUserType] = [
-            {
-                "id": obj["user"]["pk"],
-                "username": obj["user"]["username"]
-            }
-            for tag_list in usertags.values()
-            for obj in tag_list
-        ]
-        return {
-            "id": item_id,
-            "owner": owner,
-            "owner_username": owner_user,
-            "tagged_users": tags,
-            "image_url": biggest_photo,
-            "video_url": biggest_video,
-            "besties_only": close_friends_only,
-            "parent": parent_id,
-            "time": timestamp,
-        }
-
-    def parse_post_item(self, item) -> List[ParsedItemType]:    
-        if "carousel_media" not in item:
-            return [self.parse_reel_item(item)]
-
-        post_items: List[ParsedItemType] = []
-        for carousel_item in item["carousel_media"]:
-            carousel_item["user"] = item["user"]
-            carousel_item["taken_at"] = item["taken_at"]
-            post_item = self.parse_reel_item(carousel_item)
-            post_items.append(post_item)
-
-        return post_items
-
-    def download_list(self, downloads_list: List[ParsedItemType], mappings, folder, download_path):
-        default_path = os.path.join(download_path, "{owner}", folder)
-        for i, item in tqdm(enumerate(downloads_list), total=len(downloads_list), desc="Download List"):
-            parent_id = item["parent"]
-            id_ = item["id"]
-            image_name = video_name = f"{parent_id}_{id_}" if parent_id else id_
-
-            try:
-                owner = mappings[str(item["owner"])]
-            except KeyError:
-                print("Possible Repost found", item["owner"])
-                # owner = os.path.join("Unknown", str(item["owner"]))
-                owner = item["owner_username"] or "Unknown"
-            tqdm_desc = f"Downloading {{}} {id_} for {owner}"
-
-            image = item["image_url"]
-            video = item["video_url"]
-            besties = item["besties_only"]
-            time = item["time"]
-
-            image_ext = get_extension_from_url(image)
-            video_ext = get_extension_from_url(video)
-
-            image_path, video_path = self._get_media_out_paths(default_path, besties, video, owner, False)
-            os.makedirs(image_path, exist_ok=True)
-
-            if video:
-                os.makedirs(video_path, exist_ok=True)
-                image_name = image_name + "_thumbnail"
-                video_file = os.path.join(video_path, f"{video_name}.{video_ext}")
-                download_item(video, video_file, time, desc=tqdm_desc.format("video"))
-
-            image_file = os.path.join(image_path, f"{image_name}.{image_ext}")
-            download_item(image, image_file, time, desc=tqdm_desc.format("image"))
-
-            tagged_users = item["tagged_users"]
-            if tagged_users:
-                print("Handling Tags in item")
-                for user_obj in tagged_users:
-                    if not self._is_user_tracked(user_obj["id"], user_obj["username"], mappings, download_path):
-                        continue
-                    tag_user = user_obj["username"] or mappings.get(str(user_obj["id"]))
-                    im_copy, vd_copy = self._get_media_out_paths(default_path, besties, video, tag_user, True)
-                    os.makedirs(im_copy, exist_ok=True)
-                    self._copy_item(image_file, os.path.join(im_copy, f"{image_name}.{image_ext}"), time)
-                    if video:
-                        os.makedirs(vd_copy, exist_ok=True)
-                        self._copy_item(video_file, os.path.join(vd_copy, f"{video_name}.{video_ext}"), time) # type: ignore
-
-        print()
-
-    def _copy_item(self, from_, to_, time):
-        if os.path.exists(to_):
-            return False
-        shutil.copy2(from_, to_) # type: ignore
-        if time > 0:
-            set_creation_time(to_, time)
-        return True
-
-    def _is_user_tracked(self, user_id: str, user_name: str, mappings: dict, media_path: str):
-        if str(user_id) in mappings:
-            return True
-
-        if not user_name or user_name == "Unknown":
-            return False
-
-        if os.path.exists(os.path.join(media_path, user_name, "meta")): # Needs to have meta
-            return True
-        return False
-
-    def _get_media_out_paths(self, default_path: str, is_private: bool, has_video: Optional[str], owner: str, is_tag: bool):
-        path = default_path
-        if is_tag:
-            path = os.path.join(path, "tagged")
-        if is_private:
-            path = os.path.join(path, "private")
-        if has_video:
-            image_path = os.path.join(path, "video_thumbnails")
-            video_path = path
-        else:
-            image_path = path
-            video_path = ""
-
-        return [s.format(owner=owner) for s in [image_path, video_path]]
+import os
+import threading
+from time import monotonic, perf_counter, sleep
+from typing import Dict, Iterable, List, Optional
+
+from src.codec import decode_response, parsed_item
+from src.consts import (API_ENDPOINTS, FEED_API, IG_HEADERS, IMAGE_SIZE_HINT, REELS_API, STORY_API, STORY_HIGHLIGHTS_API,
+                        USER_ID_API, VIDEO_SIZE_HINT)
+from src.events import EVENTS, ITEM, LINKED
+from src.layout import MediaLayout
+from src.log import get_logger
+from src.metrics import API_ERRORS, API_REQUESTS, API_SECONDS, CACHE_HITS
+from src.storage import LocalStorage
+from src.tracing import TRACER
+from src.transfers import TransferScheduler
+from src.utils import STALE_PART_SECONDS, download_item, get_extension_from_url
+from src.validators import ClipsItemType, HighlightTrayItemType, ParsedItemType, ParsedTagUserType, ReelItemType, UserMediaTagType, UserType
+
+log = get_logger(__name__)
+
+
+def get_endpoint_name(url: str):
+    for name, template in API_ENDPOINTS.items():
+        if url.startswith(template.split("{", 1)[0].split("?", 1)[0]):
+            return name
+    return "other"
+
+def record_api_call(url: str, response, seconds: float):
+    endpoint = get_endpoint_name(url)
+    API_SECONDS.observe(seconds, endpoint=endpoint)
+    API_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 400:
+        API_ERRORS.inc(endpoint=endpoint, status_class=f"{response.status_code // 100}xx")
+
+def get_cover_url(cover: dict):
+    # Some tray entries come without the cropped cover, the full one or the old thumbnail_src do as well
+    for version in ("cropped_image_version", "full_image_version"):
+        url = (cover.get(version) or {}).get("url")
+        if url:
+            return url
+    return cover.get("thumbnail_src", "")
+
+
+class InstagramDownloader:
+    def __init__(self, sessionid, transfers: Optional[TransferScheduler] = None, storage = None, layout: Optional[MediaLayout] = None):
+        self.__init_session__(sessionid)
+        self.transfers = transfers or TransferScheduler()
+        self.storage = storage or LocalStorage()
+        self.layout = layout or MediaLayout()
+        self.deferred_copies: List[tuple] = [] # Tag copies of files someone else was still downloading
+
+    def __init_session__(self, sessionid):
+        self.sessionid = sessionid
+        self._sessions = threading.local()
+
+    @property
+    def session(self):
+        # One per thread, requests.Session isn't safe to share between the resolver's lookups
+        session = getattr(self._sessions, "session", None)
+        if session is None:
+            import requests # Slow to import, and not needed until there is something to download
+            session = self._sessions.session = requests.Session()
+            session.cookies.set("sessionid", self.sessionid, domain=".instagram.com", path="/")
+        return session
+
+    def _get_csrf_token(self, url: str = ""):
+        for _ in range(10): # Max 10 attempts to get csrftoken
+            if not self.session.cookies.get("csrftoken"):
+                self.session.get(url or "https://instagram.com/")
+            token = self.session.cookies.get("csrftoken")
+            if token:
+                return token
+        raise Exception("Time out while getting csrftoken")
+
+    def _get_request(self, url, timeout: float = 0, override_header: Optional[dict] = {}, auth: bool = True):
+        headers = override_header or IG_HEADERS
+        # requestor = self.session if auth else requests # Instagram not allowing, need to figure out reason
+        requestor = self.session
+        start = perf_counter()
+        with TRACER.span(f"GET {get_endpoint_name(url)}", "api"):
+            if not timeout:
+                r = requestor.get(url, headers=headers)
+            else:
+                r = requestor.get(url, headers=headers, timeout=timeout)
+        record_api_call(url, r, perf_counter() - start)
+        return r
+
+    def _post_request(self, url, body: Iterable, timeout: float = 0, override_header: Optional[dict] = {}, auth: bool = True):
+        headers = override_header or IG_HEADERS
+        more_headers = {
+            "x-csrftoken": self._get_csrf_token(url),
+            "content-type": "application/x-www-form-urlencoded"
+        }
+        headers={**headers, **more_headers}
+        requestor = self.session
+        start = perf_counter()
+        with TRACER.span(f"POST {get_endpoint_name(url)}", "api"):
+            if not timeout:
+                r = requestor.post(url, headers=headers, data=body)
+            else:
+                r = requestor.post(url, headers=headers, data=body, timeout=timeout)
+        record_api_call(url, r, perf_counter() - start)
+        return r
+
+    def get_user_profile(self, username: str):
+        r = self._get_request(USER_ID_API.format(username=username), timeout=5, auth=False)
+        if r.status_code == 404:
+            return None
+        with TRACER.span("json", "parse"):
+            user: UserType = decode_response(r)["data"]["user"]
+        return user
+
+    def get_story_reels_data(self, reel_ids: Iterable[str]):
+        url = STORY_API.format(ids_string='&reel_ids='.join(reel_ids))
+        r = self._get_request(url)
+        with TRACER.span("json", "parse"):
+            return decode_response(r, "ReelsMedia")
+
+    def parse_story_reels_data(self, data, known_mappings):
+        for reel in data["reels"].values():
+            user_id = reel_id = reel["id"]
+            username = known_mappings.get(str(user_id), "Unknown")
+
+            log.debug("Parsing stories for %s", username)
+
+            items: List[ReelItemType] = reel["items"]
+            story_data = []
+            for item in items:
+                story_item = self.parse_reel_item(item)
+                story_data.append(story_item)
+
+            yield story_data, user_id
+
+    def parse_highlights_data(self, data):
+        for item in data:
+            yield self.parse_reel_item(item)
+
+    def get_all_posts_data(self, user_id):
+        yield from self.get_posts_data(user_id, [])
+
+    def get_reels_data(self, user_id, old_posts = []):
+        next_id = ""
+        has_more = True
+        posts_count = 0
+
+        old_posts = {p["id"] for p in old_posts}
+
+        ctr = 1
+
+        while has_more:
+            body = {
+                "target_user_id": user_id,
+                "page_size": posts_count or 1,
+                "include_feed_video": True,
+                "max_id": next_id,
+            }
+            # url = REELS_API.format(**body)
+            url = REELS_API
+            with TRACER.span(f"reels page {ctr}", "page", user_id=user_id):
+                r = self._post_request(url, body=body)
+                with TRACER.span("json", "parse"):
+                    data: ClipsItemType = decode_response(r)
+
+            paging_info = data.get("paging_info")
+            has_more = paging_info.get("more_available", False)
+            log.info("Got page %d of reels%s", ctr, " with more to come" if has_more else "")
+
+            next_id = paging_info.get("max_id", "")
+            if not posts_count:
+                posts_count = 50
+
+            done = False
+            for item in data["items"]:
+                item = item["media"]
+                item_id = item["pk"]
+                if item_id in old_posts:
+                    CACHE_HITS.inc(kind="known_post")
+                    done = True
+                    break
+                yield item
+            ctr += 1
+            if done:
+                break
+
+    def get_posts_page(self, user_id, max_id: str = "", count: int = 50, page: int = 1):
+        url = FEED_API.format(
+            user_id=user_id,
+            count=count,
+            last_post_id=max_id,
+        )
+        with TRACER.span(f"posts page {page}", "page", user_id=user_id):
+            r = self._get_request(url)
+            with TRACER.span("json", "parse"):
+                data = decode_response(r, "FeedPage")
+
+        has_more = data.get("more_available", False)
+        log.info("Got page %d of posts%s", page, " with more to come" if has_more else "")
+        return data["items"], data.get("next_max_id", ""), has_more
+
+    def get_posts_data(self, user_id, old_posts = []):
+        next_id = ""
+        has_more = True
+        posts_count = 0
+
+        old_posts = {p["id"] for p in old_posts}
+
+        ctr = 1
+
+        while has_more:
+            items, next_id, has_more = self.get_posts_page(user_id, next_id, posts_count or 1, ctr)
+            if not posts_count:
+                posts_count = 50
+
+            done = False
+            for item in items:
+                item_id = item["pk"]
+                if item_id in old_posts:
+                    CACHE_HITS.inc(kind="known_post")
+                    done = True
+                    break
+                yield item
+            ctr += 1
+            if done:
+                break
+
+    def parse_posts_data(self, posts):
+        for item in posts:
+            post_items = self.parse_post_item(item)
+            if not post_items:
+                continue
+            yield post_items
+
+    def get_highlights_data(self, user_id, needs_auth = True):
+        # The tray has what changes when a highlight does (newest item, item count, cover), so unchanged highlights don't need their items fetched
+        url = STORY_HIGHLIGHTS_API.format(user_id=user_id)
+        r = self._get_request(url, auth=needs_auth) # Auth is when profile is private
+        with TRACER.span("json", "parse"):
+            tray: List[HighlightTrayItemType] = decode_response(r)["tray"]
+
+        highlights_data = {}
+        for highlight in tray:
+            highlight_id = str(highlight["id"]).split(":", 1)[-1]
+            cover = highlight.get("cover_media") or {}
+            highlights_data[highlight_id] = {
+                "title": highlight["title"],
+                "id": highlight_id,
+                "reels": [],
+                "thumbnail_url": get_cover_url(cover),
+                "latest_reel_media": highlight.get("latest_reel_media", 0),
+                "media_count": highlight.get("media_count", 0),
+                "cover_id": str(cover.get("media_id", "")),
+            }
+        highlights_ids = [f"highlight:{highlight_id}" for highlight_id in highlights_data.keys()]
+
+        return highlights_data, highlights_ids
+
+    def parse_reel_item(self, item: ReelItemType) -> ParsedItemType:
+        item_id = item["pk"]
+        owner = item["user"]["pk"]
+        owner_user = item["user"].get("username", "")
+        timestamp = item.get("taken_at", 0)
+        parent_id = item.get("carousel_parent_id") or item.get("parent_id")
+        close_friends_only = item.get("audience", "") == "besties"
+        has_images = "image_versions2" in item
+        has_video = "video_versions" in item
+        biggest_photo = max(item["image_versions2"]["candidates"], key=lambda x: x["width"] * x["height"])["url"]
+        biggest_video = ""
+        if has_video:
+            biggest_video = max(item["video_versions"], key=lambda x: x["width"] * x["height"])["url"]
+        if not has_images:
+            raise Exception(f"Failed to find image {item_id} for reel")
+        usertags: Dict[str, List[UserMediaTagType]] = item.get("usertags", {})
+
+        tags: List[ParsedTagUserType] = [
+            {
+                "id": obj["user"]["pk"],
+                "username": obj["user"]["username"]
+            }
+            for tag_list in usertags.values()
+            for obj in tag_list
+        ]
+        return parsed_item(
+            id=item_id,
+            owner=owner,
+            owner_username=owner_user,
+            tagged_users=tags,
+            image_url=biggest_photo,
+            video_url=biggest_video,
+            besties_only=close_friends_only,
+            parent=parent_id,
+            time=timestamp,
+        )
+
+    def parse_post_item(self, item) -> List[ParsedItemType]:    
+        if "carousel_media" not in item:
+            return [self.parse_reel_item(item)]
+
+        post_items: List[ParsedItemType] = []
+        for carousel_item in item["carousel_media"]:
+            carousel_item["user"] = item["user"]
+            carousel_item["taken_at"] = item["taken_at"]
+            post_item = self.parse_reel_item(carousel_item)
+            post_items.append(post_item)
+
+        return post_items
+
+    def download_list(self, downloads_list: List[ParsedItemType], mappings, folder, download_path):
+        default_path = os.path.join(download_path, "{owner}", folder)
+        futures = []
+        tagged_items = []
+        log.debug("Queueing %d items of %s", len(downloads_list), folder)
+        for item in downloads_list:
+            parent_id = item["parent"]
+            id_ = item["id"]
+            image_name = video_name = f"{parent_id}_{id_}" if parent_id else id_
+
+            try:
+                owner = mappings[str(item["owner"])]
+            except KeyError:
+                log.debug("Possible repost found %s", item["owner"])
+                # owner = os.path.join("Unknown", str(item["owner"]))
+                owner = item["owner_username"] or "Unknown"
+
+            image = item["image_url"]
+            video = item["video_url"]
+            besties = item["besties_only"]
+            time = item["time"]
+
+            image_ext = get_extension_from_url(image)
+            video_ext = get_extension_from_url(video)
+            EVENTS.emit(
+                ITEM, media_id=id_, parent=parent_id, owner=owner, collection=folder, taken_at=time or None, image_url=image, video_url=video,
+                besties_only=besties, tagged=[tag["username"] for tag in item["tagged_users"]],
+            )
+
+            shard = self.layout.shard(folder, id_, time)
+            image_path, video_path = self._get_media_out_paths(default_path, besties, video, owner, False, shard)
+            self.storage.makedirs(image_path)
+
+            video_file = ""
+            if video:
+                self.storage.makedirs(video_path)
+                image_name = image_name + "_thumbnail"
+                video_file = os.path.join(video_path, f"{video_name}.{video_ext}")
+                futures.append(self.transfers.submit(
+                    owner, VIDEO_SIZE_HINT, download_item, video, video_file, time,
+                    desc=f"video {id_} of {owner}", scheduler=self.transfers, key=owner, storage=self.storage,
+                    event={"kind": "video", "media_id": id_, "parent": parent_id, "owner": owner, "collection": folder},
+                ))
+
+            image_file = os.path.join(image_path, f"{image_name}.{image_ext}")
+            futures.append(self.transfers.submit(
+                owner, IMAGE_SIZE_HINT, download_item, image, image_file, time,
+                desc=f"image {id_} of {owner}", scheduler=self.transfers, key=owner, storage=self.storage,
+                event={"kind": "image", "media_id": id_, "parent": parent_id, "owner": owner, "collection": folder},
+            ))
+
+            if item["tagged_users"]:
+                tagged_items.append((item, shard, image_file, f"{image_name}.{image_ext}", video_file, f"{video_name}.{video_ext}"))
+
+        self.transfers.wait(futures) # Tag copies need the downloaded files
+
+        for item, shard, image_file, image_file_name, video_file, video_file_name in tagged_items:
+            log.debug("Copying %s to the tagged users", item["id"])
+            video = item["video_url"]
+            besties = item["besties_only"]
+            time = item["time"]
+            for user_obj in item["tagged_users"]:
+                if not self._is_user_tracked(user_obj["id"], user_obj["username"], mappings, download_path):
+                    continue
+                tag_user = user_obj["username"] or mappings.get(str(user_obj["id"]))
+                im_copy, vd_copy = self._get_media_out_paths(default_path, besties, video, tag_user, True, shard)
+                link = {"media_id": item["id"], "owner": tag_user, "collection": folder, "taken_at": time or None}
+                self.storage.makedirs(im_copy)
+                self._link(image_file, os.path.join(im_copy, image_file_name), time, "image", link)
+                if video:
+                    self.storage.makedirs(vd_copy)
+                    self._link(video_file, os.path.join(vd_copy, video_file_name), time, "video", link)
+
+    def _link(self, source: str, target: str, time: int, kind: str, link: dict):
+        if self._copy_item(source, target, time):
+            EVENTS.emit(LINKED, kind=kind, path=target, source=source, **link)
+        elif not self.storage.exists(source) and self.storage.in_progress(source):
+            # Another worker or process claimed the download and hasn't finished it, copied in finish_copies
+            self.deferred_copies.append((source, target, time, kind, link))
+
+    def finish_copies(self, timeout: float = STALE_PART_SECONDS):
+        # Waits for the downloads deferred tag copies need, as long as someone is still writing them
+        deadline = monotonic() + timeout
+        while self.deferred_copies:
+            copies, self.deferred_copies = self.deferred_copies, []
+            for source, target, time, kind, link in copies:
+                if self.storage.exists(source):
+                    self._link(source, target, time, kind, link)
+                elif self.storage.in_progress(source) and monotonic() < deadline:
+                    self.deferred_copies.append((source, target, time, kind, link))
+                else:
+                    log.warning("Not copying %s to %s, its download never finished", source, target)
+            if self.deferred_copies:
+                sleep(1)
+
+    def _copy_item(self, from_, to_, time):
+        return self.storage.copy(from_, to_, time)
+
+    def _is_user_tracked(self, user_id: str, user_name: str, mappings: dict, media_path: str):
+        if str(user_id) in mappings:
+            return True
+
+        if not user_name or user_name == "Unknown":
+            return False
+
+        if self.storage.has_dir(os.path.join(media_path, user_name, "meta")): # Needs to have meta
+            return True
+        return False
+
+    def _get_media_out_paths(self, default_path: str, is_private: bool, has_video: Optional[str], owner: str, is_tag: bool, shard: str = ""):
+        paths = self.layout.media_paths(default_path, is_private, has_video, is_tag, shard)
+        return [s.format(owner=owner) for s in paths]
@@ -0,0 +1,80 @@
+import importlib.util
+import json
+from typing import Union
+
+# Only imported once something needs them (--fast-json or the first line log), importing src doesn't pay for them
+msgspec = None
+orjson = None
+_imported = False
+
+# Off by default: responses decode to plain dicts and metadata is written with indent=4 like it always was.
+# enable_fast_json() switches to msgspec (typed structs with only the fields we read) or orjson (fast dicts), and compact metadata.
+FAST = False
+
+
+def import_fast():
+    global msgspec, orjson, _imported
+    if _imported:
+        return
+    try:
+        import msgspec
+    except ModuleNotFoundError:
+        pass
+    try:
+        import orjson
+    except ModuleNotFoundError:
+        pass
+    _imported = True
+
+def available():
+    return any(importlib.util.find_spec(name) is not None for name in ("msgspec", "orjson"))
+
+def enable_fast_json():
+    global FAST
+    import_fast()
+    if msgspec is None and orjson is None:
+        raise Exception("--fast-json needs msgspec or orjson, install one with pip install msgspec")
+    FAST = True
+
+def typed():
+    return FAST and msgspec is not None
+
+
+def loads(data: Union[bytes, str]):
+    if FAST and msgspec is not None:
+        return msgspec.json.decode(data)
+    if FAST and orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def decode_response(response, type_: str = ""):
+    # Straight from the raw body into the schema (a struct in src/structs.py) when we can, requests' .json() otherwise
+    if type_ and typed():
+        from src import structs
+        return msgspec.json.decode(response.content, type=getattr(structs, type_))
+    if FAST:
+        return loads(response.content)
+    return response.json()
+
+def dumps(data) -> bytes:
+    if FAST and msgspec is not None:
+        return msgspec.json.encode(data)
+    if FAST and orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8")
+
+def dumps_line(data) -> bytes:
+    # Always compact, for one record per line logs
+    import_fast()
+    if msgspec is not None:
+        return msgspec.json.encode(data)
+    if orjson is not None and not typed():
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def parsed_item(**fields):
+    if typed():
+        from src.structs import ParsedItem, TagUser
+        fields["tagged_users"] = [TagUser(**tag) for tag in fields["tagged_users"]]
+        return ParsedItem(**fields)
+    return fields
@@ -1,24 +1,44 @@
-from src.utils import url_join
-
-IG_APP_ID = "936619743392459"
-IG_HEADERS = {
-    "x-ig-app-id": IG_APP_ID
-}
-PROFILE_QUERY_HASH = "d4d88dc1500312af6f937f7b804c68c3"
-
-INSTAGRAM_API_V1 = "https://instagram.com/api/v1/"
-INSTAGRAM_I_API_V1 = "https://i.instagram.com/api/v1/"
-INSTAGRAM_API_GRAPH = "https://instagram.com/graphql/"
-INSTAGRAM_API_BASIC = ""
-
-# V1
-STORY_API = url_join(INSTAGRAM_I_API_V1, "feed/reels_media/?reel_ids={ids_string}")
-USER_ID_API = url_join(INSTAGRAM_I_API_V1, "users/web_profile_info/?username={username}")
-STORY_HIGHLIGHTS_API = url_join(INSTAGRAM_I_API_V1, "highlights/{user_id}/highlights_tray")
-FEED_API = url_join(INSTAGRAM_I_API_V1, "feed/user/{user_id}/?count={count}&max_id={last_post_id}")
-REELS_API = url_join(INSTAGRAM_I_API_V1, "clips/user/") # target_user_id=id, page_size=size, include_feed_video=true, max_id=last_post_id
-# Graph
-PROFILE_INFO_GRAPH_API = url_join(INSTAGRAM_API_GRAPH, "query", f"?query_hash={PROFILE_QUERY_HASH}&variables=""{variables}")
-
-MEDIA_PATH = "media"
-LIMIT = 3
+import os
+
+from src.utils import url_join
+
+IG_APP_ID = "936619743392459"
+IG_HEADERS = {
+    "x-ig-app-id": IG_APP_ID
+}
+PROFILE_QUERY_HASH = "d4d88dc1500312af6f937f7b804c68c3"
+
+# Send every API call to another host instead, e.g. the benchmark mock server (http://127.0.0.1:8000)
+INSTAGRAM_HOST_OVERRIDE = os.environ.get("IG_API_HOST", "")
+
+INSTAGRAM_API_V1 = url_join(INSTAGRAM_HOST_OVERRIDE or "https://instagram.com", "api/v1/")
+INSTAGRAM_I_API_V1 = url_join(INSTAGRAM_HOST_OVERRIDE or "https://i.instagram.com", "api/v1/")
+INSTAGRAM_API_GRAPH = url_join(INSTAGRAM_HOST_OVERRIDE or "https://instagram.com", "graphql/")
+INSTAGRAM_API_BASIC = ""
+
+# V1
+STORY_API = url_join(INSTAGRAM_I_API_V1, "feed/reels_media/?reel_ids={ids_string}")
+USER_ID_API = url_join(INSTAGRAM_I_API_V1, "users/web_profile_info/?username={username}")
+STORY_HIGHLIGHTS_API = url_join(INSTAGRAM_I_API_V1, "highlights/{user_id}/highlights_tray")
+FEED_API = url_join(INSTAGRAM_I_API_V1, "feed/user/{user_id}/?count={count}&max_id={last_post_id}")
+REELS_API = url_join(INSTAGRAM_I_API_V1, "clips/user/") # target_user_id=id, page_size=size, include_feed_video=true, max_id=last_post_id
+# Graph
+PROFILE_INFO_GRAPH_API = url_join(INSTAGRAM_API_GRAPH, "query", f"?query_hash={PROFILE_QUERY_HASH}&variables=""{variables}")
+
+# Names used to label API calls in metrics
+API_ENDPOINTS = {
+    "reels_media": STORY_API,
+    "web_profile_info": USER_ID_API,
+    "highlights_tray": STORY_HIGHLIGHTS_API,
+    "feed_user": FEED_API,
+    "clips_user": REELS_API,
+    "graphql_profile_info": PROFILE_INFO_GRAPH_API,
+}
+
+MEDIA_PATH = "media"
+LIMIT = 3
+STORY_TTL = 24 * 60 * 60 # Stories disappear a day after they are posted
+
+# Rough transfer sizes used to put small files ahead of big ones in the download queue
+IMAGE_SIZE_HINT = 256 * 1024
+VIDEO_SIZE_HINT = 8 * 1024 * 1024
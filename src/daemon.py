@@ -0,0 +1,312 @@
+import json
+import os
+import signal
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.consts import STORY_TTL
+from src.log import get_logger
+from src.metrics import METRICS
+from src.runner import BACKFILL_PAGES, CategoryRunner, load_users_file
+from src.storage import LocalStorage
+from src.stories import StoryStore
+
+log = get_logger(__name__)
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+HISTORY_WINDOW = 30 * DAY # Only recent posting habits count
+STORY_MARGIN = 2 * HOUR # Poll quiet accounts this long before a story posted right after the last poll would expire
+PROFILE_PIC_CHECK_INTERVAL = HOUR
+FAILURE_BACKOFF = 5 * 60 # After a failed poll, doubled for every failure in a row up to the user's normal interval
+STATE_FILE = "daemon_state.json"
+
+DAEMON_POLLS = METRICS.counter("ig_daemon_polls_total", "Scheduled polls in daemon mode, by kind and whether anything new was found.", ["kind", "result"])
+DAEMON_USERS_DUE = METRICS.gauge("ig_daemon_users_due", "Users that were due for a poll in the last daemon cycle.")
+
+
+class PollSchedule:
+    # Learns how often a user posts from their item timestamps and polls about once per expected new item
+    def __init__(self, min_interval: float, max_interval: float, target_items: float = 1.0):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.target_items = target_items
+        self.timestamps: List[int] = []
+        self.interval = self.max_interval
+        self.next_poll = 0.0 # Due straight away the first time
+        self.failures = 0
+
+    def learn(self, timestamps: Iterable[int], now: float):
+        self.timestamps = sorted(set(self.timestamps).union(t for t in timestamps if t)) # type: ignore
+        self.timestamps = [t for t in self.timestamps if now - t <= HISTORY_WINDOW] or self.timestamps[-1:]
+        self.interval = self._interval(now)
+
+    def _interval(self, now: float):
+        if not self.timestamps:
+            return self.max_interval
+        recent = [t for t in self.timestamps if now - t <= HISTORY_WINDOW]
+        if len(recent) >= 2:
+            rate = len(recent) / max(now - recent[0], DAY) # items per second
+        else:
+            rate = 1 / max(now - self.timestamps[-1], DAY) # One item in however long it has been quiet
+        return min(max(self.target_items / rate, self.min_interval), self.max_interval)
+
+    def polled(self, new_timestamps: List[int], now: float):
+        self.learn(new_timestamps, now)
+        self.failures = 0
+        self.next_poll = now + self.interval
+
+    def failed(self, now: float):
+        self.failures += 1
+        self.next_poll = now + min(FAILURE_BACKOFF * 2 ** (self.failures - 1), max(self.interval, FAILURE_BACKOFF))
+
+    def due(self, now: float):
+        return self.next_poll <= now
+
+    def to_dict(self):
+        return {"timestamps": self.timestamps, "interval": self.interval, "next_poll": self.next_poll, "failures": self.failures}
+
+    def load(self, data: dict):
+        self.timestamps = data.get("timestamps", [])
+        self.interval = min(max(data.get("interval", self.max_interval), self.min_interval), self.max_interval)
+        self.next_poll = data.get("next_poll", 0.0)
+        self.failures = data.get("failures", 0)
+
+
+def read_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def load_history(downloads_folder: str, username: str, storage = None) -> Dict[str, List[int]]:
+    storage = storage or LocalStorage()
+    meta_path = os.path.join(downloads_folder, username, "meta")
+    posts = [item.get("time", 0) for item in storage.read_json(os.path.join(meta_path, "posts.json"), [])]
+    stories = [entry["item"].get("time", 0) for entry in StoryStore(storage, downloads_folder).items(username).values()]
+    highlights = [
+        item.get("time", 0)
+        for highlight in storage.read_json(os.path.join(meta_path, "highlights.json"), {}).values()
+        for item in highlight.get("reels", [])
+    ]
+    return {"stories": stories, "posts": posts, "highlights": highlights}
+
+
+class Daemon:
+    # Keeps sessions and state in memory and polls every user on its own learned cadence
+    def __init__(
+        self,
+        runners: Dict[str, CategoryRunner],
+        downloads_folder: str,
+        make_runner: Optional[Callable[[str, dict, dict], CategoryRunner]] = None,
+        input_file: str = "",
+        dl_story: bool = True,
+        dl_posts: bool = True,
+        dl_high: bool = True,
+        freshness: float = 30 * 60,
+        max_interval: float = 3 * DAY,
+        after_cycle: Optional[Callable[[], None]] = None,
+        storage = None,
+        backfill_pages: int = BACKFILL_PAGES,
+    ):
+        self.runners = runners
+        self.downloads_folder = downloads_folder
+        self.make_runner = make_runner
+        self.input_file = input_file
+        self.kinds = [kind for kind, on in [("stories", dl_story), ("posts", dl_posts), ("highlights", dl_high)] if on]
+        self.freshness = freshness
+        self.max_interval = max_interval
+        self.after_cycle = after_cycle
+        self.storage = storage or LocalStorage()
+        self.backfill_pages = backfill_pages
+
+        self.state_path = os.path.join(downloads_folder, STATE_FILE)
+        self.schedules: Dict[Tuple[str, str], PollSchedule] = {}
+        self.saved_state: dict = {}
+        self.seen_stories: Dict[str, Dict[str, int]] = {} # user id -> story id -> taken at
+        self.list_mtime = os.path.getmtime(input_file) if input_file and os.path.exists(input_file) else 0
+        self.last_profile_pic_check = 0.0
+        self.stopped = False
+
+    def new_schedule(self, kind: str):
+        if kind == "stories":
+            return PollSchedule(self.freshness, STORY_TTL - STORY_MARGIN)
+        if kind == "highlights": # Highlights are old stories, nothing there goes stale quickly
+            return PollSchedule(max(self.freshness, DAY), max(self.max_interval, 7 * DAY))
+        return PollSchedule(self.freshness, self.max_interval)
+
+    def schedule(self, user_id: str, kind: str, username: str, now: float):
+        key = (user_id, kind)
+        if key not in self.schedules:
+            schedule = self.new_schedule(kind)
+            state = self.saved_state.get("schedules", {}).get(f"{user_id}:{kind}")
+            if state:
+                schedule.load(state)
+            else:
+                schedule.learn(load_history(self.downloads_folder, username, self.storage)[kind], now)
+            self.schedules[key] = schedule
+        return self.schedules[key]
+
+    # State
+
+    def load_state(self):
+        self.saved_state = read_json(self.state_path, {})
+        self.seen_stories = self.saved_state.get("seen_stories", {})
+
+    def save_state(self):
+        now = time.time()
+        for user_id, seen in self.seen_stories.items():
+            self.seen_stories[user_id] = {k: t for k, t in seen.items() if now - t <= STORY_TTL}
+        state = {
+            "schedules": {f"{user_id}:{kind}": s.to_dict() for (user_id, kind), s in self.schedules.items()},
+            "seen_stories": self.seen_stories,
+        }
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def reload_list(self):
+        if not self.input_file or not os.path.exists(self.input_file):
+            return
+        mtime = os.path.getmtime(self.input_file)
+        if mtime == self.list_mtime:
+            return
+        self.list_mtime = mtime
+        log.info("User list changed, reloading %s", self.input_file)
+        usernames_list, session_map = load_users_file(self.input_file)
+        for category in list(self.runners):
+            if category in usernames_list:
+                runner = self.runners[category]
+                runner.usernames = usernames_list[category].get("users", [])
+                runner.username_mappings.clear()
+                runner.prepare()
+        for category in usernames_list if self.make_runner else []:
+            if category not in self.runners:
+                self.runners[category] = self.make_runner(category, usernames_list, session_map)
+                self.runners[category].prepare()
+
+    # Loop
+
+    def stop(self, *args):
+        log.info("Stopping after the current poll")
+        self.stopped = True
+
+    def run_forever(self):
+        self.load_state()
+        signal.signal(signal.SIGTERM, self.stop)
+        for runner in self.runners.values():
+            runner.prepare()
+        try:
+            while not self.stopped:
+                try:
+                    self.reload_list()
+                except Exception as e: # A half written list file, try again next cycle
+                    log.error("Failed to reload %s: %r", self.input_file, e)
+                self.run_cycle(time.time())
+                self.save_state()
+                if self.after_cycle:
+                    try:
+                        self.after_cycle()
+                    except Exception as e:
+                        log.error("After cycle hook failed: %r", e)
+                self.wait()
+        except KeyboardInterrupt:
+            log.info("Interrupted")
+        finally:
+            self.save_state()
+            for runner in self.runners.values():
+                runner.close()
+
+    def run_cycle(self, now: float):
+        users_due = set()
+        for category, runner in list(self.runners.items()):
+            if self.stopped:
+                break
+            try:
+                users_due.update(self.run_category(category, runner, now))
+            except Exception as e: # Polls have their own backoff, this is everything around them
+                log.error("Daemon cycle of %s failed: %r", category, e, extra={"fields": {"category": category}})
+        if now - self.last_profile_pic_check >= PROFILE_PIC_CHECK_INTERVAL:
+            self.last_profile_pic_check = now
+        DAEMON_USERS_DUE.set(len(users_due))
+
+    def run_category(self, category: str, runner: CategoryRunner, now: float):
+        users_due = set()
+        runner.retry_unresolved(now) # The list file didn't change, so nothing else would look them up again
+        mappings = dict(runner.username_mappings)
+        for kind in self.kinds:
+            due = [
+                user_id for user_id, username in mappings.items()
+                if self.schedule(user_id, kind, username, now).due(now)
+            ]
+            users_due.update(due)
+            if due:
+                log.info("%s: %d users due for %s", category, len(due), kind)
+            self.poll(runner, kind, due)
+        if runner.profile_pic_download and now - self.last_profile_pic_check >= PROFILE_PIC_CHECK_INTERVAL:
+            runner.download_profile_pics()
+        return users_due
+
+    def poll(self, runner: CategoryRunner, kind: str, user_ids: List[str]):
+        if kind == "stories" and user_ids:
+            try:
+                stories = runner.download_stories(user_ids)
+            except Exception as e: # One request for all of them, so they all wait
+                for user_id in user_ids:
+                    self.failed(runner, user_id, kind, e)
+                return
+            for user_id in user_ids:
+                seen = self.seen_stories.setdefault(user_id, {})
+                new = [item["time"] for item in stories.get(user_id, []) if str(item["id"]) not in seen]
+                for item in stories.get(user_id, []):
+                    seen[str(item["id"])] = item["time"]
+                self.polled(user_id, kind, new)
+            return
+
+        for user_id in user_ids:
+            if self.stopped:
+                return
+            username = runner.username_mappings[user_id]
+            try:
+                if kind == "posts":
+                    new = [item["time"] for item in runner.download_posts(user_id, username, self.backfill_pages)]
+                else:
+                    old = {
+                        item["id"]
+                        for highlight in runner.storage.read_json(os.path.join(self.downloads_folder, username, "meta", "highlights.json"), {}).values()
+                        for item in highlight.get("reels", [])
+                    }
+                    highlights = runner.download_highlights(user_id, username)
+                    new = [item["time"] for highlight in highlights.values() for item in highlight["reels"] if item["id"] not in old]
+            except Exception as e:
+                self.failed(runner, user_id, kind, e)
+                continue
+            self.polled(user_id, kind, new)
+            if kind == "posts" and runner.backfill_left(username): # A few more pages once the others had their turn
+                schedule = self.schedules[(user_id, kind)]
+                schedule.next_poll = min(schedule.next_poll, time.time() + self.freshness)
+
+    def polled(self, user_id: str, kind: str, new_timestamps: List[int]):
+        DAEMON_POLLS.inc(kind=kind, result="new" if new_timestamps else "empty")
+        self.schedules[(user_id, kind)].polled(new_timestamps, time.time())
+
+    def failed(self, runner: CategoryRunner, user_id: str, kind: str, error: Exception):
+        DAEMON_POLLS.inc(kind=kind, result="failed")
+        schedule = self.schedules[(user_id, kind)]
+        schedule.failed(time.time())
+        username = runner.username_mappings.get(user_id, user_id)
+        log.warning(
+            "Polling %s of %s failed (%r), trying again in %.0f minutes", kind, username, error, (schedule.next_poll - time.time()) / 60,
+            extra={"fields": {"user": username, "kind": kind, "failures": schedule.failures}},
+        )
+
+    def wait(self):
+        # Wake up for the next due user, but check the list file and signals at least every minute
+        next_poll = min((s.next_poll for s in self.schedules.values()), default=time.time() + 60)
+        wake_at = time.time() + min(max(next_poll - time.time(), 1), 60)
+        while not self.stopped and time.time() < wake_at:
+            time.sleep(max(min(wake_at - time.time(), 1), 0))
@@ -0,0 +1,234 @@
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Callable, Dict, List
+
+from src.jobs import BACKFILL, EPHEMERAL, HIGHLIGHTS, NEW_CONTENT, PROFILE
+from src.log import get_logger
+from src.metrics import METRICS
+from src.runner import BACKFILL_PAGES, CategoryRunner
+from src.tracing import TRACER
+
+log = get_logger(__name__)
+
+QUEUE_JOBS = METRICS.counter("ig_queue_jobs_total", "Jobs run from the shared queue, by phase and result.", ["phase", "result"])
+
+PRIORITIES = {"stories": EPHEMERAL, "posts": NEW_CONTENT, "highlights": HIGHLIGHTS, "profile_pics": PROFILE, "backfill": BACKFILL}
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Coordinator:
+    # Resolves the users of every category and puts one job per user and phase on the queue, then waits for the workers
+    def __init__(
+        self,
+        queue,
+        runners: Dict[str, CategoryRunner],
+        dl_story: bool = True,
+        dl_posts: bool = True,
+        dl_high: bool = True,
+        poll_interval: float = 5,
+        stall_timeout: float = 30 * 60,
+    ):
+        self.queue = queue
+        self.runners = runners
+        self.phases = [name for name, on in [("stories", dl_story), ("posts", dl_posts), ("highlights", dl_high)] if on]
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+
+    def jobs(self, runner: CategoryRunner):
+        users = list(runner.username_mappings.items())
+        for name in self.phases:
+            # Stories are fetched for several users per request, keep them batched like a local run does
+            size = runner.download_limit * 3 if name == "stories" else 1
+            for i in range(0, len(users), size):
+                batch = users[i : i + size]
+                job_id = f"{runner.category}:{name}:{','.join(user_id for user_id, _ in batch)}"
+                yield job_id, {"category": runner.category, "phase": name, "users": batch}
+        if runner.profile_pic_download:
+            yield f"{runner.category}:profile_pics", {"category": runner.category, "phase": "profile_pics", "users": []}
+
+    def enqueue(self):
+        queued = 0
+        for category, runner in self.runners.items():
+            with TRACER.span(f"category {category}", "category"):
+                runner.prepare()
+                for job_id, payload in self.jobs(runner):
+                    queued += self.queue.put(job_id, category, payload, PRIORITIES[payload["phase"]])
+        log.info("Queued %d jobs", queued)
+        return queued
+
+    def wait(self):
+        last = None
+        changed = time.monotonic()
+        while True:
+            self.queue.expire() # Workers only expire leases when they lease, with all of them gone nobody would
+            counts = self.queue.counts(self.runners.keys())
+            progress = (counts["queued"], counts["leased"], counts["done"], counts["failed"])
+            if progress != last:
+                log.info("%d queued, %d running (%d expired), %d done, %d failed", counts["queued"], counts["leased"], counts["expired"], counts["done"], counts["failed"])
+                last = progress
+                changed = time.monotonic()
+            if not counts["queued"] and not counts["leased"]:
+                return counts
+            if not counts["leased"] and time.monotonic() - changed > self.stall_timeout:
+                stuck = [job_id for job_id, _, _ in self.queue.unfinished() if job_id.split(":", 1)[0] in self.runners]
+                log.error(
+                    "No worker took a job in %d minutes, giving up on %d jobs: %s%s",
+                    self.stall_timeout / 60, len(stuck), ", ".join(stuck[:20]), ", ..." if len(stuck) > 20 else "",
+                )
+                return counts
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        self.queue.set_open(True)
+        try:
+            self.enqueue()
+            self.wait()
+        finally:
+            self.queue.set_open(False)
+            for runner in self.runners.values():
+                runner.close()
+        for job_id, error in self.queue.failures():
+            log.error("Failed %s: %s", job_id, error)
+
+
+class Worker:
+    # Leases jobs for the categories it has sessions for and runs them with its own runners
+    def __init__(
+        self,
+        queue,
+        make_runner: Callable[[str], CategoryRunner],
+        categories: List[str],
+        worker_id: str = "",
+        lease_time: float = 300,
+        idle_sleep: float = 5,
+        backfill_pages: int = BACKFILL_PAGES,
+        start_timeout: float = 10 * 60,
+    ):
+        self.queue = queue
+        self.make_runner = make_runner
+        self.categories = categories
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_time = lease_time
+        self.idle_sleep = idle_sleep
+        self.start_timeout = start_timeout
+        self.backfill_pages = backfill_pages
+        self.runners: Dict[str, CategoryRunner] = {}
+        self.stopped = False
+
+    def runner(self, category: str):
+        if category not in self.runners:
+            runner = self.make_runner(category)
+            runner.load_mappings()
+            self.runners[category] = runner
+        return self.runners[category]
+
+    def stop(self, *args):
+        log.info("Stopping after the current job")
+        self.stopped = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        log.info("Worker %s serving %s", self.worker_id, ", ".join(self.categories))
+        done = 0
+        started = time.monotonic()
+        opened = False # Until a coordinator opened the queue, a closed queue means it hasn't started yet
+        try:
+            while not self.stopped:
+                job = self.queue.lease(self.worker_id, self.lease_time, self.categories)
+                if job is None:
+                    if self.queue.is_open():
+                        opened = True
+                    else:
+                        counts = self.queue.counts(self.categories)
+                        if not counts["queued"] and not counts["leased"]:
+                            if opened:
+                                break
+                            if time.monotonic() - started > self.start_timeout:
+                                log.warning("No coordinator opened the queue in %d seconds", self.start_timeout)
+                                break
+                    # Expired leases of crashed workers come back on a later lease call
+                    time.sleep(self.idle_sleep)
+                    continue
+                opened = True
+                self.run_job(job)
+                done += 1
+        finally:
+            for runner in self.runners.values():
+                runner.close()
+        log.info("Worker %s ran %d jobs", self.worker_id, done)
+
+    def run_job(self, job: dict):
+        payload = job["payload"]
+        lost = threading.Event()
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(self.lease_time / 3):
+                try:
+                    renewed = self.queue.renew(job["id"], self.worker_id, self.lease_time)
+                except Exception as e: # A busy or unreachable queue, the lease has two more tries before it runs out
+                    log.warning("Failed to renew the lease on %s: %r", job["id"], e)
+                    continue
+                if not renewed:
+                    lost.set()
+                    return
+
+        renewer = threading.Thread(target=heartbeat, name="lease-renewer", daemon=True)
+        renewer.start()
+        try:
+            with TRACER.span(job["id"], "job", attempt=job["attempts"]):
+                result = self.execute(payload)
+        except Exception as e:
+            log.error("Job %s failed: %r", job["id"], e)
+            self.queue.fail(job["id"], self.worker_id, repr(e))
+            QUEUE_JOBS.inc(phase=payload["phase"], result="failed")
+            return
+        finally:
+            finished.set()
+            renewer.join()
+        if lost.is_set() or not self.queue.complete(job["id"], self.worker_id, result):
+            log.warning("Lease on %s was lost before it finished", job["id"])
+            QUEUE_JOBS.inc(phase=payload["phase"], result="lease_lost")
+            return
+        QUEUE_JOBS.inc(phase=payload["phase"], result="done")
+
+    def execute(self, payload: dict):
+        runner = self.runner(payload["category"])
+        name = payload["phase"]
+        users = [(user_id, username) for user_id, username in payload["users"]]
+        runner.username_mappings.update(users)
+
+        items = 0
+        if name == "stories":
+            runner.sleep()
+            items = sum(len(story) for story in runner.download_story_batch([user_id for user_id, _ in users]).values())
+        elif name in ("posts", "backfill"):
+            for user_id, username in users:
+                items += len(runner.download_posts(user_id, username, self.backfill_pages))
+                if runner.backfill_left(username):
+                    # Queued behind everyone's stories and new posts, before this job is done so the coordinator keeps waiting.
+                    # Every step has its own id, this job's id is still leased and put would refuse it.
+                    step = payload.get("step", 0) + 1
+                    self.queue.put(
+                        f"{runner.category}:backfill:{user_id}:{step}", runner.category,
+                        {"category": runner.category, "phase": "backfill", "users": [(user_id, username)], "step": step}, BACKFILL,
+                    )
+        elif name == "highlights":
+            for user_id, username in users:
+                items += sum(len(h["reels"]) for h in runner.download_highlights(user_id, username).values())
+        elif name == "profile_pics":
+            runner.download_profile_pics()
+        else:
+            raise ValueError(f"Unknown phase {name}")
+
+        if runner.missing_profile_pic_ids:
+            # Pictures found missing while running this job, the weekly check is left to the profile_pics job
+            runner.download_profile_pics(check_expired=False)
+        runner.instagram.finish_copies() # The lease is renewed meanwhile
+        return {"worker": self.worker_id, "items": items}
@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+from typing import Iterator, List
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+DOWNLOADED = "downloaded"
+LINKED = "linked" # Tag copy into another tracked user's folder
+SKIPPED = "skipped"
+FAILED = "failed"
+METADATA_UPDATED = "metadata_updated"
+REMOVED = "removed" # Pruned by a retention policy
+ITEM = "item" # An item about to be downloaded, only for sinks that ask for them (library streams)
+
+
+class JsonlSink:
+    # Append only, one event per line. Rotates like logging's RotatingFileHandler: events.jsonl -> events.jsonl.1 -> ... -> events.jsonl.N
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, backups: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, "ab")
+        if tail(path)[-1:] not in (b"", b"\n"): # Half a line from a crash, don't glue the next event onto it
+            self.file.write(b"\n")
+
+    def last_seq(self):
+        for path in [self.path] + [f"{self.path}.{i}" for i in range(1, self.backups + 1)]:
+            record = last_record(path)
+            if record:
+                return record.get("seq", 0)
+        return 0
+
+    def write(self, line: bytes):
+        if self.max_bytes and self.file.tell() + len(line) > self.max_bytes and self.file.tell():
+            self.rotate()
+        self.file.write(line)
+        self.file.flush() # Consumers tail the file, don't leave half a batch in our buffer
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        self.file.close()
+
+
+class SocketSink:
+    # Newline delimited json to a unix socket or tcp listener. Events are dropped while nobody is listening, the log file is the durable option.
+    def __init__(self, address: str):
+        self.address = address
+        self.sock = None
+        self.dropped = 0
+
+    def connect(self):
+        import socket # Only for this sink, keeps src.events light for the library
+        if self.address.startswith("unix://"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address[len("unix://"):])
+        else:
+            host, port = self.address[len("tcp://"):].rsplit(":", 1)
+            sock = socket.create_connection((host, int(port)), timeout=5)
+        return sock
+
+    def write(self, line: bytes):
+        try:
+            if self.sock is None:
+                self.sock = self.connect()
+            self.sock.sendall(line)
+        except OSError:
+            if self.sock is not None:
+                self.sock.close()
+            self.sock = None
+            if not self.dropped:
+                log.warning("Event listener at %s is not reachable, dropping events until it is", self.address)
+            self.dropped += 1
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+class CommandSink:
+    # Starts the command once and feeds it the events on stdin
+    def __init__(self, command: str):
+        import subprocess # Only for this sink, like socket for SocketSink
+        self.command = command
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        self.dropped = 0
+
+    def write(self, line: bytes):
+        if not self.dropped:
+            try:
+                self.process.stdin.write(line)
+                self.process.stdin.flush()
+                return
+            except OSError:
+                pass
+            log.warning("Event command exited with %s, dropping events from now on: %s", self.process.poll(), self.command)
+        self.dropped += 1
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError: # Already gone
+            pass
+        self.process.wait()
+
+
+class QueueSink:
+    # Hands the events of a worker process to the parent, which numbers them into its own log. Also what library streams read from, with items.
+    def __init__(self, queue, source: str, items: bool = False):
+        self.queue = queue
+        self.source = source
+        self.items = items
+
+    def write(self, line: bytes):
+        self.queue.put((self.source, line))
+
+    def close(self):
+        pass
+
+
+def open_sink(target: str, max_bytes: int = 64 * 1024 * 1024, backups: int = 5):
+    if target.startswith(("unix://", "tcp://")):
+        return SocketSink(target)
+    if target.startswith("exec:"):
+        return CommandSink(target[len("exec:"):])
+    return JsonlSink(target, max_bytes, backups)
+
+
+class EventLog:
+    def __init__(self):
+        self.sinks: List = []
+        self.seq = 0
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        if isinstance(sink, JsonlSink): # Keep counting from where the last run stopped
+            self.seq = max(self.seq, sink.last_seq())
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        with self._lock: # A new list, emit may be going through the old one
+            self.sinks = [other for other in self.sinks if other is not sink]
+
+    def emit(self, event: str, **fields):
+        sinks = [sink for sink in self.sinks if getattr(sink, "items", False)] if event == ITEM else self.sinks
+        if not sinks:
+            return
+        with self._lock:
+            record = {"ts": round(time.time(), 3), "event": event}
+            if event != ITEM: # Items don't take a seq, logs keep counting only what happened to files
+                self.seq += 1
+                record = {"seq": self.seq, **record}
+            record.update((k, v) for k, v in fields.items() if v is not None)
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            self._write(sinks, line)
+
+    def forward(self, line: bytes):
+        # An event from another process, renumbered into this log's sequence
+        if not self.sinks:
+            return
+        record = json.loads(line)
+        with self._lock:
+            self.seq += 1
+            record["seq"] = self.seq
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            self._write(self.sinks, line)
+
+    def _write(self, sinks: List, line: bytes):
+        # Events are a side channel, a sink that breaks must not fail the download that emitted them
+        for sink in sinks:
+            try:
+                sink.write(line)
+            except Exception as e:
+                log.warning("Event sink %s failed: %r", type(sink).__name__, e)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+
+def tail(path: str, size: int = 64 * 1024) -> bytes:
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - size, 0))
+        return f.read()
+
+def last_record(path: str) -> dict:
+    # The last event that parses, a crash can leave half a line at the end
+    for line in reversed(tail(path).splitlines()):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return {}
+
+def read_events(path: str, after_seq: int = 0, backups: int = 5) -> Iterator[dict]:
+    # For consumers: everything newer than the last event they handled, oldest first, across rotated files
+    for file_path in [f"{path}.{i}" for i in range(backups, 0, -1)] + [path]:
+        if not os.path.exists(file_path):
+            continue
+        if last_record(file_path).get("seq", 0) <= after_seq:
+            continue
+        with open(file_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # Still being written
+                try:
+                    event = json.loads(line)
+                except ValueError: # Cut short by a crash
+                    continue
+                if event.get("seq", 0) > after_seq:
+                    yield event
+
+
+EVENTS = EventLog()
@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.codec import dumps_line, loads
+from src.events import DOWNLOADED, LINKED, REMOVED, SKIPPED
+from src.log import get_logger
+from src.storage import LocalStorage
+
+log = get_logger(__name__)
+
+INDEX_FILE = "media.jsonl" # In every user's meta folder: one line per file written, seen again or removed
+FLUSH_INTERVAL = 30.0
+SEGMENT_PREFIX = "media." # Object storage can't append, each flush writes a media.<ms>-<id>.jsonl segment next to media.jsonl instead
+COMPACT_SEGMENTS = 20 # Segments of a user a run writes before folding them into media.jsonl, about 10 minutes of flushes
+
+
+def index_path(downloads_folder: str, username: str):
+    return os.path.join(downloads_folder, username, "meta", INDEX_FILE)
+
+def segment_paths(storage, downloads_folder: str, username: str) -> List[str]:
+    # Oldest first, the names start with the time they were written
+    folder = os.path.dirname(index_path(downloads_folder, username))
+    if not storage.has_dir(folder):
+        return []
+    names = [name for name in storage.listdir(folder) if name.startswith(SEGMENT_PREFIX) and name.endswith(".jsonl") and name != INDEX_FILE]
+    return [os.path.join(folder, name) for name in sorted(names)]
+
+def load_index(storage, downloads_folder: str, username: str) -> Optional[Dict[str, dict]]:
+    # Every file of the user that is still there, by path relative to the downloads folder. None when there is no index yet.
+    return read_index(storage, downloads_folder, username)[0]
+
+def read_index(storage, downloads_folder: str, username: str) -> Tuple[Optional[Dict[str, dict]], List[str]]:
+    # Like load_index, with the segments it read. Only those can go when the index is written back, others may have been added since.
+    text = storage.read_text(index_path(downloads_folder, username), None)
+    paths = segment_paths(storage, downloads_folder, username)
+    segments = [storage.read_text(path) for path in paths]
+    if text is None and not segments:
+        return None, []
+    files: Dict[str, dict] = {}
+    for line in "".join([text or ""] + segments).splitlines():
+        if not line:
+            continue
+        entry = loads(line)
+        path = entry["path"]
+        if "removed" in entry:
+            files.pop(path, None)
+        elif "at" in entry:
+            files[path] = entry
+        elif path in files:
+            files[path]["seen"] = entry["seen"]
+    return files, paths
+
+def write_index(storage, downloads_folder: str, username: str, files: Dict[str, dict], segments: Sequence[str] = ()):
+    # Rewrites the index with one line per file, dropping the history of how it got there. segments are the ones read_index folded into files.
+    text = "".join(dumps_line(entry).decode("utf-8") + "\n" for entry in sorted(files.values(), key=lambda entry: entry["at"]))
+    storage.write_text(index_path(downloads_folder, username), text)
+    for path in segments: # Only once media.jsonl has what they had
+        storage.remove(path)
+
+def compact_index(storage, downloads_folder: str, username: str):
+    files, segments = read_index(storage, downloads_folder, username)
+    if files is not None:
+        write_index(storage, downloads_folder, username, files, segments)
+
+def rebuild_index(storage, downloads_folder: str, username: str) -> int:
+    # One walk of the user's folder for trees from before the index, using the mtimes downloads get from taken_at
+    if not isinstance(storage, LocalStorage):
+        raise Exception("--rebuild-index only works on a local downloads folder")
+    old, segments = read_index(storage, downloads_folder, username)
+    old = old or {}
+    files = {}
+    user_folder = os.path.join(downloads_folder, username)
+    for folder, _, names in os.walk(user_folder):
+        relative = os.path.relpath(folder, downloads_folder)
+        parts = relative.split(os.sep)
+        if len(parts) < 2 or parts[1] == "meta":
+            continue
+        for name in names:
+            if name.endswith(".part") or name.endswith(".txt"):
+                continue
+            path = os.path.join(relative, name)
+            stat = os.stat(os.path.join(folder, name))
+            entry = {"path": path, "at": int(stat.st_mtime), "size": stat.st_size, "taken_at": int(stat.st_mtime), "collection": collection_of(path)}
+            if "tagged" in parts:
+                entry["linked"] = True
+            if path in old: # What the events said is better than what we can guess
+                entry.update(old[path])
+            files[path] = entry
+    write_index(storage, downloads_folder, username, files, segments)
+    return len(files)
+
+def move_entries(storage, downloads_folder: str, username: str, moved: Dict[str, str]):
+    # Keeps the index right after files were moved to other paths (--migrate-layout)
+    files, segments = read_index(storage, downloads_folder, username)
+    if files is None or not moved:
+        return
+    renamed = {}
+    for path, entry in files.items():
+        entry["path"] = moved.get(path, path)
+        if entry.get("source") in moved:
+            entry["source"] = moved[entry["source"]]
+        renamed[entry["path"]] = entry
+    write_index(storage, downloads_folder, username, renamed, segments)
+
+def collection_of(path: str) -> str:
+    # user/posts/..., user/highlights/<id>/...
+    parts = path.split(os.sep)
+    if len(parts) > 3 and parts[1] == "highlights":
+        return os.path.join(parts[1], parts[2])
+    return parts[1] if len(parts) > 2 else ""
+
+
+class IndexSink:
+    # An event sink that keeps meta/media.jsonl of every user up to date, so retention knows what's on disk without walking the tree.
+    # Lines are buffered and appended by a background thread, storage writes can't happen while the event log holds its lock.
+    def __init__(self, storage, downloads_folder: str, interval: float = FLUSH_INTERVAL):
+        self.storage = storage or LocalStorage()
+        self.downloads_folder = downloads_folder
+        self._buffer: Dict[str, List[str]] = defaultdict(list)
+        self.segmented = not isinstance(self.storage, LocalStorage)
+        self._segments: Dict[str, int] = defaultdict(int) # Per user, segments written since the last compaction
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock() # flush is called from the thread and by retention, one compaction at a time
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="index", daemon=True)
+        self._thread.start()
+
+    def entry(self, record: dict) -> Optional[dict]:
+        event = record["event"]
+        path = record.get("path")
+        if not path:
+            return None
+        path = os.path.relpath(path, self.downloads_folder)
+        if event == DOWNLOADED:
+            entry = {"path": path, "at": int(record["ts"]), "size": record.get("size", 0), "taken_at": record.get("taken_at") or 0}
+        elif event == LINKED:
+            entry = {"path": path, "at": int(record["ts"]), "taken_at": record.get("taken_at") or 0, "linked": True, "source": os.path.relpath(record["source"], self.downloads_folder)}
+        elif event == SKIPPED and record.get("reason") == "exists":
+            return {"path": path, "seen": int(record["ts"])}
+        elif event == REMOVED:
+            return {"path": path, "removed": int(record["ts"])}
+        else:
+            return None
+        for key in ("collection", "kind", "media_id"):
+            if record.get(key) is not None:
+                entry[key] = record[key]
+        return entry
+
+    def write(self, line: bytes):
+        record = json.loads(line)
+        entry = self.entry(record)
+        if entry is None or entry["path"].startswith(".."):
+            return
+        username = entry["path"].split(os.sep, 1)[0]
+        with self._lock:
+            self._buffer[username].append(dumps_line(entry).decode("utf-8") + "\n")
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, defaultdict(list)
+        with self._write_lock:
+            self._write(buffer)
+
+    def _write(self, buffer: Dict[str, List[str]]):
+        for username, lines in buffer.items():
+            path = index_path(self.downloads_folder, username)
+            if not self.storage.has_dir(os.path.dirname(path)): # Reposts of users we don't follow, a meta folder would make them tracked
+                continue
+            try:
+                if self.segmented:
+                    self.write_segment(username, "".join(lines))
+                else:
+                    self.storage.append_text(path, "".join(lines))
+            except Exception as e:
+                log.warning("Failed to update the media index of %s: %r", username, e)
+
+    def write_segment(self, username: str, text: str):
+        name = f"{SEGMENT_PREFIX}{int(time.time() * 1000):013d}-{os.urandom(4).hex()}.jsonl" # Other workers write segments of the same user
+        self.storage.write_text(os.path.join(os.path.dirname(index_path(self.downloads_folder, username)), name), text)
+        self._segments[username] += 1
+        if self._segments[username] >= COMPACT_SEGMENTS:
+            self.compact(username)
+
+    def compact(self, username: str):
+        compact_index(self.storage, self.downloads_folder, username)
+        self._segments[username] = 0
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        for username, segments in list(self._segments.items()) if self.segmented else []: # So the next run starts from one object per user
+            if segments:
+                try:
+                    self.compact(username)
+                except Exception as e:
+                    log.warning("Failed to compact the media index of %s: %r", username, e)
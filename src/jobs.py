@@ -0,0 +1,92 @@
+import heapq
+import itertools
+import time
+from typing import Callable, Iterable, List, Optional
+
+from src.metrics import METRICS
+from src.tracing import TRACER
+
+# Lower runs first
+EPHEMERAL = 0 # Stories, gone a day after they are posted
+NEW_CONTENT = 1 # Posts added since the last run
+HIGHLIGHTS = 2
+PROFILE = 3
+BACKFILL = 4 # Old posts of new users, fine to finish in a later run
+
+JOBS = METRICS.counter("ig_jobs_total", "Scheduled jobs by kind and whether they ran or were left for a later run.", ["kind", "result"])
+JOB_SECONDS = METRICS.histogram("ig_job_seconds", "Time spent running a job.", ["kind"])
+
+
+class Job:
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], Optional[Iterable["Job"]]],
+        priority: int = NEW_CONTENT,
+        deadline: float = float("inf"),
+        kind: str = "",
+    ):
+        self.name = name
+        self.run = run # Returns the follow-up jobs, if any
+        self.priority = priority
+        self.deadline = deadline
+        self.kind = kind or name.split(" ", 1)[0]
+
+    def __repr__(self):
+        return f"Job({self.name!r}, priority={self.priority}, deadline={self.deadline})"
+
+
+class JobScheduler:
+    # Runs jobs by priority then deadline. Once the time budget or the backfill limit is used up backfill jobs are left for the next run.
+    def __init__(self, time_budget: float = 0, backfill_limit: int = 0):
+        self.time_budget = time_budget
+        self.backfill_limit = backfill_limit
+        self.backfilled = 0
+        self.started_at = time.monotonic()
+        self.completed = 0
+        self.deferred: List[Job] = []
+        self.stopped = False
+        self._heap: list = []
+        self._seq = itertools.count()
+
+    def add(self, job: Job):
+        heapq.heappush(self._heap, (job.priority, job.deadline, next(self._seq), job))
+
+    def add_all(self, jobs: Iterable[Job]):
+        for job in jobs:
+            self.add(job)
+
+    def pending(self):
+        return len(self._heap)
+
+    def out_of_time(self):
+        return bool(self.time_budget) and time.monotonic() - self.started_at >= self.time_budget
+
+    def backfill_done(self):
+        return self.out_of_time() or (bool(self.backfill_limit) and self.backfilled >= self.backfill_limit)
+
+    def stop(self):
+        # The running job still finishes, the rest are left for the next run
+        self.stopped = True
+
+    def run(self):
+        self.started_at = time.monotonic()
+        while self._heap and not self.stopped:
+            _, _, _, job = heapq.heappop(self._heap)
+            if job.priority >= BACKFILL:
+                if self.backfill_done():
+                    self.deferred.append(job)
+                    JOBS.inc(kind=job.kind, result="deferred")
+                    continue
+                self.backfilled += 1
+            with JOB_SECONDS.time(kind=job.kind), TRACER.span(job.name, "job", priority=job.priority):
+                follow_up = job.run()
+            self.completed += 1
+            JOBS.inc(kind=job.kind, result="done")
+            if follow_up:
+                self.add_all(follow_up)
+        return self
+
+    def run_all(self, jobs: Iterable[Job]):
+        self.add_all(jobs)
+        return self.run()
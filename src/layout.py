@@ -0,0 +1,147 @@
+import os
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from src.index import load_index, move_entries
+from src.log import get_logger
+from src.storage import LocalStorage
+
+log = get_logger(__name__)
+
+LAYOUT_FILE = "layout.json" # In the downloads folder, every run and process reads the layout from here
+FLAT = "flat"
+MONTH = "month"
+HASH = "hash"
+SCHEMES = [FLAT, MONTH, HASH]
+
+SHARDED = ("stories", "posts", "reels") # Highlights already have a folder per highlight
+MARKERS = ("tagged", "private", "video_thumbnails") # Folders _get_media_out_paths adds, kept in front of the shard when migrating
+HASH_WIDTH = 2 # 256 folders, about 400 files each for 100k posts
+
+
+def shard_for(scheme: str, item_id, timestamp: int) -> str:
+    if scheme == MONTH:
+        if not timestamp:
+            return "unknown"
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y/%m")
+    if scheme == HASH:
+        # Spread evenly no matter when the account posted. Media ids end in the same few digits, so hash them instead of taking a prefix.
+        import hashlib # Only this scheme needs it, about 4 ms at startup
+        return hashlib.sha1(str(item_id).encode("utf-8")).hexdigest()[:HASH_WIDTH]
+    return ""
+
+def in_shard(path: str, shard: str):
+    return os.path.join(path, shard) if shard else path
+
+def item_id_from_name(name: str) -> str:
+    # {id}.ext, {parent}_{id}.ext and {...}_thumbnail.ext, the shard is always picked by the media id
+    stem = name.rsplit(".", 1)[0]
+    if stem.endswith("_thumbnail"):
+        stem = stem[: -len("_thumbnail")]
+    return stem.rsplit("_", 1)[-1]
+
+
+class MediaLayout:
+    # Where the media of an item goes. Downloads, the exists checks before them and tag copies all get their paths from here,
+    # so switching layouts is only ever done by migrate(), which moves the files the same way.
+    def __init__(self, scheme: str = FLAT):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown layout {scheme}, expected one of {', '.join(SCHEMES)}")
+        self.scheme = scheme
+
+    @classmethod
+    def load(cls, storage, downloads_folder: str):
+        data = (storage or LocalStorage()).read_json(os.path.join(downloads_folder, LAYOUT_FILE), None) or {}
+        if data.get("migrating_from"):
+            raise Exception(f"The media layout of {downloads_folder} is half way through a migration to {data['scheme']}, run --migrate-layout {data['scheme']} again to finish it")
+        return cls(data.get("scheme", FLAT))
+
+    def shard(self, folder: str, item_id, timestamp: int) -> str:
+        if folder not in SHARDED:
+            return ""
+        return shard_for(self.scheme, item_id, timestamp)
+
+    def media_paths(self, default_path: str, is_private: bool, has_video: Optional[str], is_tag: bool, shard: str = "") -> Tuple[str, str]:
+        # Same folders as always, with the shard as the innermost one: posts/2024/03/..., posts/video_thumbnails/2024/03/...
+        path = default_path
+        if is_tag:
+            path = os.path.join(path, "tagged")
+        if is_private:
+            path = os.path.join(path, "private")
+        if has_video:
+            return in_shard(os.path.join(path, "video_thumbnails"), shard), in_shard(path, shard)
+        return in_shard(path, shard), ""
+
+
+def collection_files(root: str) -> List[Tuple[Tuple[str, ...], str]]:
+    # (markers, path) of every media file under a collection folder, whatever layout it is in now
+    files = []
+    for folder, _, names in os.walk(root):
+        parts = os.path.relpath(folder, root).split(os.sep)
+        markers = tuple(part for part in parts if part in MARKERS)
+        for name in names:
+            if not name.endswith(".part"):
+                files.append((markers, os.path.join(folder, name)))
+    return files
+
+def remove_empty_dirs(root: str):
+    for folder, _, _ in sorted(os.walk(root), key=lambda entry: -len(entry[0])):
+        if folder != root and not os.listdir(folder):
+            os.rmdir(folder)
+
+def taken_at(index: dict, downloads_folder: str, path: str) -> int:
+    # What a download of the file would have passed to shard(). Items without one go to "unknown" there, and their mtime is
+    # only when they were downloaded, so the index decides when it has the file. Other downloads got their mtime from taken_at.
+    entry = index.get(os.path.relpath(path, downloads_folder))
+    if entry is not None:
+        return entry.get("taken_at") or 0
+    return int(os.path.getmtime(path))
+
+def migrate(storage, downloads_folder: str, scheme: str) -> int:
+    # Moves the media of every user in place. layout.json is written first and marked as migrating, so an interrupted
+    # migration stops the next run instead of it downloading everything that was already moved again. Running it again finishes it.
+    storage = storage or LocalStorage()
+    if not isinstance(storage, LocalStorage):
+        raise Exception("--migrate-layout only works on a local downloads folder, object storage has no folders to shard")
+    target = MediaLayout(scheme)
+    layout_path = os.path.join(downloads_folder, LAYOUT_FILE)
+    current = storage.read_json(layout_path, None) or {}
+    storage.write_json(layout_path, {"scheme": scheme, "migrating_from": current.get("migrating_from") or current.get("scheme", FLAT)})
+
+    moved_paths = {}
+    users = sorted(os.listdir(downloads_folder)) if os.path.isdir(downloads_folder) else []
+    for user in users:
+        if not os.path.isdir(os.path.join(downloads_folder, user, "meta")):
+            continue
+        index = load_index(storage, downloads_folder, user) or {}
+        for folder in SHARDED:
+            root = os.path.join(downloads_folder, user, folder)
+            if not os.path.isdir(root):
+                continue
+            count = 0
+            for markers, path in collection_files(root):
+                shard = target.shard(folder, item_id_from_name(os.path.basename(path)), taken_at(index, downloads_folder, path))
+                # Videos and plain images share a folder, only thumbnails have their own
+                is_thumbnail = "video_thumbnails" in markers
+                image_path, _ = target.media_paths(root, "private" in markers, "video" if is_thumbnail else None, "tagged" in markers, shard)
+                destination = os.path.join(image_path, os.path.basename(path))
+                if destination == path:
+                    continue
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                if os.path.exists(destination): # Already moved by an earlier try that got interrupted
+                    os.remove(path)
+                else:
+                    os.replace(path, destination)
+                moved_paths[os.path.relpath(path, downloads_folder)] = os.path.relpath(destination, downloads_folder)
+                count += 1
+            remove_empty_dirs(root)
+            if count:
+                log.info("Moved %d files of %s/%s", count, user, folder)
+
+    # After everything moved, tag copies point at files of other users as their source
+    for user in users:
+        if os.path.isdir(os.path.join(downloads_folder, user, "meta")):
+            move_entries(storage, downloads_folder, user, moved_paths)
+
+    storage.write_json(layout_path, {"scheme": scheme})
+    return len(moved_paths)
@@ -0,0 +1,156 @@
+import json
+import queue
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from src.consts import LIMIT, MEDIA_PATH
+from src.events import EVENTS, QueueSink
+from src.index import IndexSink
+from src.jobs import JobScheduler
+from src.resolver import RESOLVE_RATE
+from src.runner import CategoryRunner, get_category_session
+from src.storage import open_storage
+from src.tracing import TRACER
+from src.transfers import TransferScheduler
+from src.validators import ListUserType
+
+STREAM_BUFFER = 1000 # Records waiting for the consumer before downloading waits for it
+
+
+class Options:
+    # Everything a run takes besides the roster, with the same defaults as main.py's arguments
+    def __init__(
+        self,
+        downloads_folder: str = MEDIA_PATH,
+        stories: bool = True,
+        posts: bool = True,
+        highlights: bool = True,
+        profile_pics: bool = True,
+        download_limit: int = LIMIT,
+        sleep_duration: float = 1,
+        bandwidth_limit: int = 0,
+        download_workers: int = 0,
+        storage_url: str = "",
+        storage_endpoint: str = "",
+        time_budget: float = 0,
+        resolve_rate: float = RESOLVE_RATE,
+    ):
+        self.downloads_folder = downloads_folder
+        self.stories = stories
+        self.posts = posts
+        self.highlights = highlights
+        self.profile_pics = profile_pics
+        self.download_limit = download_limit
+        self.sleep_duration = sleep_duration
+        self.bandwidth_limit = bandwidth_limit
+        self.download_workers = download_workers
+        self.storage_url = storage_url
+        self.storage_endpoint = storage_endpoint
+        self.time_budget = time_budget
+        self.resolve_rate = resolve_rate
+
+    def transfers(self):
+        return TransferScheduler(self.bandwidth_limit, self.download_workers)
+
+    def storage(self):
+        return open_storage(self.storage_url, self.downloads_folder, self.storage_endpoint)
+
+
+def make_runner(category: str, roster: Dict[str, ListUserType], sessions: Dict[str, str], options: Options, transfers = None, storage = None):
+    # roster and sessions are the "categories" and "sessionids" of a list file, load_users_file returns both
+    return CategoryRunner(
+        category,
+        get_category_session(roster, sessions, category),
+        roster[category].get("users", []),
+        options.downloads_folder,
+        transfers,
+        storage=storage,
+        download_limit=options.download_limit,
+        sleep_duration=options.sleep_duration,
+        profile_pic_download=options.profile_pics,
+        resolve_rate=options.resolve_rate,
+    )
+
+def run(
+    roster: Dict[str, ListUserType],
+    sessions: Dict[str, str],
+    options: Optional[Options] = None,
+    categories: Optional[List[str]] = None,
+    transfers = None,
+    storage = None,
+    jobs: Optional[JobScheduler] = None,
+) -> JobScheduler:
+    # What a plain run of main.py does. One queue for every category so stories of all of them come before anyone's backfill.
+    options = options or Options()
+    own_transfers = transfers is None
+    transfers = transfers or options.transfers()
+    storage = storage or options.storage()
+    jobs = jobs if jobs is not None else JobScheduler(options.time_budget)
+    runners = []
+    try:
+        for category in TRACER.iter_spans(categories if categories is not None else list(roster), lambda category: f"category {category}", "category"):
+            if jobs.stopped:
+                break
+            runner = make_runner(category, roster, sessions, options, transfers, storage)
+            runners.append(runner)
+            runner.prepare()
+            jobs.add_all(runner.jobs(options.stories, options.posts, False, options.highlights))
+        with TRACER.span("jobs", "run"): # Everything the categories queued, so the trace covers the whole run
+            jobs.run()
+            for runner in runners: # Tag copies of files other processes were downloading
+                runner.instagram.finish_copies()
+        return jobs
+    finally:
+        for runner in runners:
+            runner.close()
+        if own_transfers:
+            transfers.close()
+
+def stream(
+    roster: Dict[str, ListUserType],
+    sessions: Dict[str, str],
+    options: Optional[Options] = None,
+    categories: Optional[List[str]] = None,
+) -> Iterator[dict]:
+    # Runs like run() in a background thread and yields a record as things happen: "item" for every item about to be downloaded,
+    # then "downloaded", "linked", "skipped" or "failed" for its files, same as the --events lines. The run waits when the consumer
+    # falls STREAM_BUFFER records behind. Stopping early lets the running job finish and leaves the rest for the next run.
+    # One stream at a time per process, the records come from the process wide event log.
+    options = options or Options()
+    storage = options.storage()
+    records: queue.Queue = queue.Queue(STREAM_BUFFER)
+    sink = QueueSink(records, "stream", items=True)
+    index = IndexSink(storage, options.downloads_folder)
+    jobs = JobScheduler(options.time_budget)
+    errors: List[BaseException] = []
+
+    def work():
+        try:
+            run(roster, sessions, options, categories, storage=storage, jobs=jobs)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            records.put(("stream", None))
+
+    EVENTS.add_sink(sink)
+    EVENTS.add_sink(index)
+    thread = threading.Thread(target=work, name="stream", daemon=True)
+    thread.start()
+    try:
+        while True:
+            _, line = records.get()
+            if line is None:
+                break
+            yield json.loads(line)
+    finally:
+        jobs.stop()
+        while thread.is_alive(): # Keep taking records so a blocked run can get to the end of its job
+            try:
+                records.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        EVENTS.remove_sink(sink)
+        EVENTS.remove_sink(index)
+        index.close()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,157 @@
+import json
+import logging
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from src.metrics import DOWNLOAD_BYTES, DOWNLOADS
+
+LOG = logging.getLogger("igdl")
+PROGRESS_LOG = LOG.getChild("progress") # Has its own level, progress lines still show in --quiet
+
+LEVELS = ["debug", "info", "warning", "error"]
+FAILED_RESULTS = ("retries_exceeded", "gone", "server_error", "not_found")
+
+
+def get_logger(name: str):
+    # igdl.utils for src.utils, so levels can be set per module
+    return LOG.getChild(name.rsplit(".", 1)[-1])
+
+
+class TextFormatter(logging.Formatter):
+    # Info reads like the plain prints it replaced, everything else says what it is
+    def format(self, record: logging.LogRecord):
+        message = super().format(record)
+        if record.levelno == logging.INFO:
+            return message
+        return f"{record.levelname}: {message}"
+
+
+class JsonFormatter(logging.Formatter):
+    # One json object per line, extra={"fields": {...}} ends up as keys of its own
+    def format(self, record: logging.LogRecord):
+        data = {"ts": round(record.created, 3), "level": record.levelname.lower(), "logger": record.name, "msg": record.getMessage()}
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LineHandler(logging.StreamHandler):
+    # Clears the progress line before writing so the two don't end up on the same line
+    def emit(self, record: logging.LogRecord):
+        PROGRESS.clear_line()
+        super().emit(record)
+
+
+def setup_logging(level: str = "info", fmt: str = "text", stream = None):
+    handler = LineHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter("%(message)s"))
+    LOG.handlers = [handler]
+    LOG.setLevel(level.upper())
+    LOG.propagate = False
+    PROGRESS_LOG.setLevel(logging.INFO)
+
+
+def metric_totals() -> Dict[str, float]:
+    return {
+        "downloaded": DOWNLOADS.sum(result="downloaded"),
+        "skipped": DOWNLOADS.sum(result="exists") + DOWNLOADS.sum(result="in_progress"),
+        "failed": sum(DOWNLOADS.sum(result=result) for result in FAILED_RESULTS),
+        "bytes": DOWNLOAD_BYTES.sum(),
+    }
+
+
+class Progress:
+    # One status line for the whole run (items/s, bytes/s, queue depths) instead of a bar or a line per file.
+    # "bar" redraws it in place on a terminal, "log" writes it through the log every interval, for cron logs and --log-format json.
+    def __init__(self):
+        self.totals: Callable[[], Dict[str, float]] = metric_totals
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.mode = "off"
+        self.interval = 0.0
+        self._stream = sys.stderr
+        self._drawn = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._last = (time.monotonic(), {})
+        self.started_at = time.monotonic()
+
+    def add_gauge(self, name: str, callback: Callable[[], float]):
+        self.gauges[name] = callback
+
+    def start(self, mode: str = "auto", interval: float = 0):
+        if mode == "auto":
+            mode = "bar" if self._stream.isatty() and LOG.handlers and isinstance(LOG.handlers[0].formatter, TextFormatter) else "log"
+        self.mode = mode
+        self.interval = interval or (0.5 if mode == "bar" else 30)
+        self.started_at = time.monotonic()
+        self._last = (self.started_at, self.totals())
+        if mode == "off" or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def snapshot(self):
+        now = time.monotonic()
+        totals = self.totals()
+        last_time, last = self._last
+        self._last = (now, totals)
+        elapsed = max(now - last_time, 1e-9)
+        items = totals["downloaded"] + totals["skipped"]
+        snapshot = dict(totals, elapsed=round(now - self.started_at, 1))
+        snapshot["items_per_second"] = round((items - last.get("downloaded", 0) - last.get("skipped", 0)) / elapsed, 1)
+        snapshot["bytes_per_second"] = round((totals["bytes"] - last.get("bytes", 0)) / elapsed)
+        for name, callback in self.gauges.items():
+            snapshot[name] = callback()
+        return snapshot
+
+    def render(self, snapshot: dict):
+        queues = " ".join(f"{name} {snapshot[name]:g}" for name in self.gauges)
+        return (
+            f"{snapshot['downloaded']:g} downloaded, {snapshot['skipped']:g} skipped, {snapshot['failed']:g} failed, "
+            f"{snapshot['bytes'] / 1024 / 1024:.1f}MB | {snapshot['items_per_second']:g} items/s "
+            f"{snapshot['bytes_per_second'] / 1024 / 1024:.1f}MB/s" + (f" | queued: {queues}" if queues else "")
+        )
+
+    def report(self, final: bool = False):
+        with self._lock:
+            snapshot = self.snapshot()
+            if final:
+                # Rates over the whole run for the summary
+                elapsed = max(time.monotonic() - self.started_at, 1e-9)
+                snapshot["items_per_second"] = round((snapshot["downloaded"] + snapshot["skipped"]) / elapsed, 1)
+                snapshot["bytes_per_second"] = round(snapshot["bytes"] / elapsed)
+            line = self.render(snapshot)
+            if self.mode == "bar" and not final:
+                self._stream.write("\r\x1b[K" + line)
+                self._stream.flush()
+                self._drawn = True
+                return
+        self.clear_line()
+        PROGRESS_LOG.info(("Done: " if final else "") + line, extra={"fields": dict(snapshot, final=final)})
+
+    def clear_line(self):
+        if self._drawn:
+            self._stream.write("\r\x1b[K")
+            self._stream.flush()
+            self._drawn = False
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.mode != "off":
+            self.report(final=True)
+        self.mode = "off"
+
+
+PROGRESS = Progress()
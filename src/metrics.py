@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+LabelsType = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+def _format_labels(labels: LabelsType, extra: Optional[Tuple[str, str]] = None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelsType, float] = {}
+
+    def _key(self, labels: Dict[str, str]) -> LabelsType:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def sum(self, **labels):
+        # Total over every label set that has these labels, all of them when none are given
+        wanted = {(name, str(value)) for name, value in labels.items()}
+        with self._lock:
+            return sum(value for key, value in self._values.items() if wanted.issubset(key))
+
+    def samples(self) -> List[Tuple[str, LabelsType, Optional[Tuple[str, str]], float]]:
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback # Read on every render, for values owned by something else
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is not None:
+            self.set(self.callback())
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: Dict[LabelsType, List[int]] = {}
+        self._sums: Dict[LabelsType, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        counts = self._counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key, ("le", _format_value(bound)), count))
+                samples.append((f"{self.name}_sum", key, None, self._sums[key]))
+                samples.append((f"{self.name}_count", key, None, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def register(self, metric: Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames)) # type: ignore
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), callback = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback)) # type: ignore
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets)) # type: ignore
+
+    def snapshot(self, reset: bool = False):
+        # Counters and histograms of this process, to be added into another process' registry with merge()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {}
+        for metric in metrics:
+            with metric._lock:
+                if isinstance(metric, Histogram):
+                    snapshot[metric.name] = ({key: list(counts) for key, counts in metric._counts.items()}, dict(metric._sums))
+                    if reset:
+                        metric._counts, metric._sums = {}, {}
+                elif isinstance(metric, Counter):
+                    snapshot[metric.name] = (dict(metric._values), None)
+                    if reset:
+                        metric._values = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, (values, sums) in snapshot.items():
+            metric = self._metrics.get(name)
+            if metric is None:
+                continue
+            with metric._lock:
+                if isinstance(metric, Histogram):
+                    for key, counts in values.items():
+                        current = metric._counts.setdefault(key, [0] * len(metric.buckets))
+                        metric._counts[key] = [a + b for a, b in zip(current, counts)]
+                        metric._sums[key] = metric._sums.get(key, 0) + sums[key]
+                elif isinstance(metric, Counter):
+                    for key, value in values.items():
+                        metric._values[key] = metric._values.get(key, 0) + value
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def write_textfile(self, path: str):
+        # Write then rename so the node exporter never reads a half written file
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # Pulls in ssl and email, only worth it with --metrics-port
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        return self._server
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+METRICS = Registry()
+
+API_REQUESTS = METRICS.counter("ig_api_requests_total", "Instagram API calls by endpoint and HTTP status.", ["endpoint", "status"])
+API_ERRORS = METRICS.counter("ig_api_errors_total", "Instagram API calls that answered with a 4xx or 5xx status.", ["endpoint", "status_class"])
+API_SECONDS = METRICS.histogram("ig_api_request_seconds", "Instagram API call latency.", ["endpoint"])
+
+DOWNLOADS = METRICS.counter("ig_downloads_total", "Media download attempts by result.", ["result"])
+DOWNLOAD_BYTES = METRICS.counter("ig_download_bytes_total", "Media bytes written to disk by user.", ["user"])
+DOWNLOAD_SECONDS = METRICS.histogram("ig_download_seconds", "Time spent downloading a single media file.", [])
+CACHE_HITS = METRICS.counter("ig_cache_hits_total", "Work skipped because it was already done by a previous run.", ["kind"])
+
+PHASE_SECONDS = METRICS.histogram("ig_phase_seconds", "Time spent in each phase of a run.", ["phase", "user", "session"])
+PHASE_ITEMS = METRICS.counter("ig_phase_items_total", "Parsed media items by phase.", ["phase", "session"])
+SESSIONS = METRICS.gauge("ig_sessions_active", "Instagram sessions currently in use.")
+RUN_START = METRICS.gauge("ig_run_start_timestamp_seconds", "Unix time the run started.")
+RUN_END = METRICS.gauge("ig_run_end_timestamp_seconds", "Unix time the run finished, 0 while running.")
@@ -0,0 +1,134 @@
+import json
+import multiprocessing
+import os
+import queue
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Dict, List, Tuple
+
+from src.codec import enable_fast_json
+from src.events import DOWNLOADED, EVENTS, FAILED, SKIPPED, QueueSink
+from src.jobs import JobScheduler
+from src.log import PROGRESS, get_logger, setup_logging
+from src.metrics import METRICS
+from src.runner import CategoryRunner
+from src.storage import open_storage
+from src.transfers import TransferScheduler
+
+log = get_logger(__name__)
+
+TOTALS = {DOWNLOADED: "downloaded", SKIPPED: "skipped", FAILED: "failed"}
+
+# Set in every worker process by init_worker
+_events = None
+_settings: dict = {}
+
+
+def make_shards(usernames_list: dict, categories: List[str], processes: int, split_users: bool = False) -> List[Tuple[str, List[str]]]:
+    # One shard per category. With split_users the biggest shards are halved until there is one per process, they share the category's session then.
+    shards = [(category, list(usernames_list[category].get("users", []))) for category in categories]
+    shards = [(category, users) for category, users in shards if users]
+    while split_users and shards and len(shards) < processes:
+        i = max(range(len(shards)), key=lambda i: len(shards[i][1]))
+        category, users = shards[i]
+        if len(users) < 2:
+            break
+        half = len(users) // 2
+        shards[i : i + 1] = [(category, users[:half]), (category, users[half:])]
+    return shards
+
+
+def init_worker(events, settings: dict):
+    global _events, _settings
+    _events = events
+    _settings = settings
+    if settings["fast_json"]:
+        enable_fast_json()
+
+
+def run_shard(name: str, category: str, sessionid: str, users: List[str]):
+    settings = _settings
+    os.makedirs(settings["log_dir"], exist_ok=True)
+    log_path = os.path.join(settings["log_dir"], f"{name.replace(os.sep, '_')}.log")
+    with open(log_path, "a", encoding="utf-8", buffering=1) as log_file:
+        # The parent shows one progress line for everybody, what each process logs goes to its own file
+        sys.stdout = sys.stderr = log_file
+        setup_logging(settings["log_level"], settings["log_format"], log_file)
+        EVENTS.add_sink(QueueSink(_events, name))
+        try:
+            storage = open_storage(settings["storage_url"], settings["downloads_folder"], settings["storage_endpoint"])
+            runner = CategoryRunner(
+                category,
+                sessionid,
+                users,
+                settings["downloads_folder"],
+                TransferScheduler(settings["bandwidth_limit"], settings["download_workers"]),
+                storage=storage,
+                download_limit=settings["download_limit"],
+                sleep_duration=settings["sleep_duration"],
+                profile_pic_download=settings["profile_pic_download"],
+                resolve_rate=settings["resolve_rate"],
+            )
+            runner.prepare()
+            jobs = JobScheduler(settings["time_budget"])
+            jobs.add_all(runner.jobs(settings["dl_story"], settings["dl_posts"], False, settings["dl_high"]))
+            jobs.run()
+            runner.instagram.finish_copies()
+        finally:
+            EVENTS.close()
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    # A process can run several shards, only hand over what this one added
+    return {"deferred": len(jobs.deferred), "metrics": METRICS.snapshot(reset=True)}
+
+
+def run_processes(shards: List[Tuple[str, List[str]]], sessions: Dict[str, str], settings: dict, processes: int):
+    # Spawned, not forked: every process starts clean with its own sessions, connection pools and transfer budget
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        return _run_processes(shards, sessions, settings, processes, context, manager.Queue())
+
+
+def _run_processes(shards, sessions, settings, processes, context, events):
+    # The progress line counts the events of the children, their metrics only arrive once a shard is done
+    totals = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    failed_shards = []
+    deferred = 0
+
+    def drain(timeout: float):
+        try:
+            while True:
+                _, line = events.get(timeout=timeout)
+                timeout = 0
+                EVENTS.forward(line)
+                record = json.loads(line)
+                if record["event"] in TOTALS:
+                    totals[TOTALS[record["event"]]] += 1
+                    totals["bytes"] += record.get("size", 0)
+        except queue.Empty:
+            pass
+
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker, initargs=(events, settings)) as executor:
+        futures = {}
+        for i, (category, users) in enumerate(shards):
+            name = category if len([shard for shard in shards if shard[0] == category]) == 1 else f"{category}.{i}"
+            futures[executor.submit(run_shard, name, category, sessions[category], users)] = name
+
+        pending = set(futures)
+        PROGRESS.totals = lambda: dict(totals)
+        PROGRESS.add_gauge("processes", lambda: len(pending))
+        while pending:
+            drain(0.5)
+            done, pending = wait(pending, timeout=0)
+            for future in done:
+                try:
+                    result = future.result()
+                    METRICS.merge(result["metrics"])
+                    deferred += result["deferred"]
+                    log.info("%s done", futures[future])
+                except Exception as e:
+                    failed_shards.append((futures[future], e))
+                    log.error("%s failed: %r, see its log in %s", futures[future], e, settings["log_dir"])
+        drain(0)
+    if failed_shards:
+        log.error("%d of %d processes failed", len(failed_shards), len(futures))
+    return failed_shards, deferred
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from src.log import get_logger
+from src.metrics import CACHE_HITS
+from src.tracing import TRACER
+from src.validators import UserType
+
+log = get_logger(__name__)
+
+DELETED_FILE = "deleted_users.json" # username -> when it was last found missing
+DELETED_TTL = 7 * 24 * 60 * 60 # Deleted or renamed accounts are only looked up again after this long
+RESOLVE_WORKERS = 8
+RESOLVE_RATE = 4.0 # Profile lookups per second per session
+RETRY_BACKOFF = 5 * 60 # After a failed lookup, doubled for every failure in a row up to RETRY_MAX
+RETRY_MAX = 6 * 60 * 60
+
+
+class RateLimit:
+    # Spaces out calls from any number of threads to at most per_second, without bursts
+    def __init__(self, per_second: float):
+        self.interval = 1 / per_second if per_second > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            TRACER.sleep(start - now, "rate_limit")
+
+
+class UserResolver:
+    # Looks up the ids of new users a few at a time instead of one after another, so a category with thousands of new
+    # accounts doesn't spend its first hour in a serial loop. Accounts that were missing are remembered for deleted_ttl.
+    def __init__(self, instagram, storage, downloads_folder: str, rate: float = RESOLVE_RATE, workers: int = RESOLVE_WORKERS, deleted_ttl: float = DELETED_TTL):
+        self.instagram = instagram
+        self.storage = storage
+        self.deleted_path = os.path.join(downloads_folder, DELETED_FILE)
+        self.rate = RateLimit(rate)
+        self.workers = workers
+        self.deleted_ttl = deleted_ttl
+        self.unresolved: Dict[str, Tuple[int, float]] = {} # username -> failed lookups in a row, when to try again
+
+    def lookup(self, username: str) -> Optional[UserType]:
+        self.rate.wait()
+        log.debug("Looking up %s", username)
+        return self.instagram.get_user_profile(username)
+
+    def resolve(self, usernames: List[str], now: Optional[float] = None) -> Tuple[Dict[str, UserType], List[str]]:
+        # Returns the users that were found by username, and the ones that don't exist (now, or when last checked).
+        # Lookups that fail for other reasons are left out of both and tried again once their backoff is over, see retry_due.
+        now = now or time.time()
+        deleted = self.storage.read_json(self.deleted_path, {}) if usernames else {}
+        known_deleted = [username for username in usernames if now - deleted.get(username, 0) < self.deleted_ttl]
+        if known_deleted:
+            CACHE_HITS.inc(len(known_deleted), kind="deleted_user")
+            log.info("Skipping %d users that were deleted when last checked", len(known_deleted))
+        waiting = [username for username in usernames if self.unresolved.get(username, (0, 0))[1] > now]
+        pending = [username for username in usernames if username not in known_deleted and username not in waiting]
+        if not pending:
+            return {}, known_deleted
+
+        log.info("Resolving %d new users", len(pending))
+        found: Dict[str, UserType] = {}
+        missing: List[str] = []
+        with ThreadPoolExecutor(min(self.workers, len(pending)), thread_name_prefix="resolve") as executor:
+            futures = {username: executor.submit(self.lookup, username) for username in pending}
+            for username, future in futures.items():
+                try:
+                    user = future.result()
+                except Exception as e:
+                    failures = self.unresolved.get(username, (0, 0))[0] + 1
+                    delay = min(RETRY_BACKOFF * 2 ** (failures - 1), RETRY_MAX)
+                    self.unresolved[username] = (failures, now + delay)
+                    log.warning("Failed to look up %s, trying again in %.0f minutes or on the next run: %r", username, delay / 60, e)
+                    continue
+                self.unresolved.pop(username, None)
+                if user is None:
+                    log.warning("User %s does not exist or was deleted", username)
+                    missing.append(username)
+                else:
+                    found[username] = user
+
+        if missing or any(username in deleted for username in found):
+            self.storage.update_json(
+                self.deleted_path,
+                lambda current: {**{name: at for name, at in current.items() if name not in found}, **{name: int(now) for name in missing}},
+                {},
+            )
+        return found, known_deleted + missing
+
+    def retry_due(self, now: Optional[float] = None) -> List[str]:
+        now = now or time.time()
+        return [username for username, (_, retry_at) in self.unresolved.items() if retry_at <= now]
@@ -0,0 +1,201 @@
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from src.consts import STORY_TTL
+from src.events import EVENTS, REMOVED
+from src.index import read_index, write_index
+from src.log import get_logger
+from src.storage import LocalStorage
+from src.stories import StoryStore
+from src.utils import format_size, parse_size
+
+log = get_logger(__name__)
+
+DAY = 24 * 60 * 60
+ORDERS = ["oldest", "lru"]
+# Anything else is a folder in the user's folder (posts, stories, reels, highlights, profile_pics)
+TAGGED = "tagged" # Tag copies of other users' media, in any collection
+THUMBNAILS = "video_thumbnails"
+ALL = "all"
+STORY_HISTORY = "story_history" # meta/stories.json and old story_{hour}.json files, only days= applies
+
+
+class Policy:
+    # COLLECTION:RULE[,RULE...] with keep=N (newest N), days=D (posted in the last D days), max_size=SIZE with order=oldest|lru, dedupe
+    def __init__(self, collection: str, keep: int = 0, days: float = 0, max_size: int = 0, order: str = "oldest", dedupe: bool = False):
+        if order not in ORDERS:
+            raise ValueError(f"Unknown retention order {order}, expected one of {', '.join(ORDERS)}")
+        if collection == STORY_HISTORY and (keep or max_size or dedupe):
+            raise ValueError(f"{STORY_HISTORY} only has days=")
+        if not (keep or days or max_size or dedupe):
+            raise ValueError(f"Retention policy for {collection} has no rule, expected keep=, days=, max_size= or dedupe")
+        self.collection = collection
+        self.keep = keep
+        self.days = days
+        self.max_size = max_size
+        self.order = order
+        self.dedupe = dedupe
+
+    @classmethod
+    def parse(cls, spec: str):
+        collection, _, rules = spec.partition(":")
+        kwargs = {}
+        for rule in filter(None, rules.split(",")):
+            name, _, value = rule.partition("=")
+            name = name.strip().replace("-", "_")
+            if name == "keep":
+                kwargs["keep"] = int(value)
+            elif name == "days":
+                kwargs["days"] = float(value)
+            elif name == "max_size":
+                kwargs["max_size"] = parse_size(value)
+            elif name == "order":
+                kwargs["order"] = value
+            elif name == "dedupe":
+                kwargs["dedupe"] = True
+            else:
+                raise ValueError(f"Unknown retention rule {rule} in {spec}")
+        return cls(collection.strip(), **kwargs)
+
+    def __str__(self):
+        rules = [f"keep={self.keep}"] if self.keep else []
+        rules += [f"days={self.days:g}"] if self.days else []
+        rules += [f"max_size={format_size(self.max_size)}", f"order={self.order}"] if self.max_size else []
+        rules += ["dedupe"] if self.dedupe else []
+        return f"{self.collection}:{','.join(rules)}"
+
+    def matches(self, entry: dict) -> bool:
+        parts = entry["path"].split(os.sep)
+        if self.collection == ALL:
+            return True
+        if self.collection == TAGGED:
+            return bool(entry.get("linked"))
+        if self.collection == THUMBNAILS:
+            return THUMBNAILS in parts
+        return len(parts) > 1 and parts[1] == self.collection
+
+    def select(self, entries: List[dict], now: float, exists) -> List[dict]:
+        # What this policy removes from entries, all of which it matches
+        selected = []
+        if self.dedupe:
+            # A tag copy is the same file as its source, drop it while the source is still around
+            selected += [entry for entry in entries if entry.get("linked") and entry.get("source") and exists(entry["source"])]
+        if self.days:
+            selected += [entry for entry in entries if posted(entry) < now - self.days * DAY]
+        if self.keep:
+            selected += sorted(entries, key=posted, reverse=True)[self.keep :]
+        if self.max_size:
+            gone = {entry["path"] for entry in selected}
+            left = [entry for entry in entries if entry["path"] not in gone]
+            size = sum(entry["size"] for entry in left)
+            for entry in sorted(left, key=used if self.order == "lru" else posted):
+                if size <= self.max_size:
+                    break
+                selected.append(entry)
+                size -= entry["size"]
+        unique = {entry["path"]: entry for entry in selected}
+        return list(unique.values())
+
+
+def posted(entry: dict):
+    return entry.get("taken_at") or entry["at"]
+
+def live(entry: dict, now: float):
+    # A story that can still be up, removing it would only have the next poll download it again
+    parts = entry["path"].split(os.sep)
+    return len(parts) > 2 and parts[1] == "stories" and max(posted(entry), entry.get("seen", 0)) > now - STORY_TTL
+
+def used(entry: dict):
+    # Last time a run wrote the file or found it already there
+    return max(entry.get("seen", 0), entry["at"])
+
+def parse_policies(specs: List[str]) -> List[Policy]:
+    return [Policy.parse(spec) for spec in specs]
+
+
+class Retention:
+    # Applies the policies user by user, from meta/media.jsonl instead of walking the media folders. With dry_run only reports what would go.
+    def __init__(self, policies: List[Policy], storage = None, downloads_folder: str = "", dry_run: bool = False):
+        self.policies = policies
+        self.storage = storage or LocalStorage()
+        self.downloads_folder = downloads_folder
+        self.dry_run = dry_run
+        self.stories = StoryStore(self.storage, downloads_folder)
+        self._indexes: Dict[str, Optional[Dict[str, dict]]] = {}
+        self._segments: Dict[str, List[str]] = {} # Per user, the index segments read, folded in when the index is written
+
+    def index(self, username: str):
+        if username not in self._indexes:
+            self._indexes[username], self._segments[username] = read_index(self.storage, self.downloads_folder, username)
+        return self._indexes[username]
+
+    def exists(self, path: str):
+        # Sources of tag copies, looked up in the index of their owner, no stat needed
+        index = self.index(path.split(os.sep, 1)[0])
+        return index is not None and path in index
+
+    def plan(self, username: str, now: Optional[float] = None) -> List[Tuple[Policy, List[dict]]]:
+        now = now or time.time()
+        files = self.index(username)
+        if files is None:
+            return []
+        for entry in files.values():
+            if "size" not in entry: # Tag copies have the size of their source
+                source = (self.index(entry.get("source", "").split(os.sep, 1)[0]) or {}).get(entry.get("source"), {})
+                entry["size"] = source.get("size", 0)
+        plan = []
+        left = {path: entry for path, entry in files.items() if not live(entry, now)}
+        for policy in self.policies:
+            if policy.collection == STORY_HISTORY:
+                continue
+            selected = policy.select([entry for entry in left.values() if policy.matches(entry)], now, self.exists)
+            for entry in selected:
+                del left[entry["path"]]
+            if selected:
+                plan.append((policy, selected))
+        return plan
+
+    def run(self, usernames: List[str], now: Optional[float] = None):
+        now = now or time.time()
+        verb = "Would remove" if self.dry_run else "Removed"
+        total_files = total_bytes = 0
+        for username in usernames:
+            if self.index(username) is None and any(policy.collection != STORY_HISTORY for policy in self.policies):
+                log.warning("No media index for %s yet, run with --rebuild-index once to apply retention to files from before it", username)
+            for policy, entries in self.plan(username, now):
+                size = sum(entry["size"] for entry in entries)
+                log.info(
+                    "%s %d files (%s) of %s for %s", verb, len(entries), format_size(size), username, policy,
+                    extra={"fields": {"user": username, "policy": str(policy), "files": len(entries), "bytes": size, "dry_run": self.dry_run}},
+                )
+                for entry in entries:
+                    log.debug("%s %s", verb, entry["path"])
+                    if not self.dry_run:
+                        self.remove(username, entry, policy)
+                total_files += len(entries)
+                total_bytes += size
+            if not self.dry_run and self.index(username) is not None:
+                write_index(self.storage, self.downloads_folder, username, self.index(username), self._segments.get(username, []))
+            for policy in self.policies:
+                if policy.collection == STORY_HISTORY:
+                    self.expire_stories(username, policy, now)
+        log.info(
+            "%s %d files, %s in total", verb, total_files, format_size(total_bytes),
+            extra={"fields": {"files": total_files, "bytes": total_bytes, "dry_run": self.dry_run}},
+        )
+        return total_files, total_bytes
+
+    def remove(self, username: str, entry: dict, policy: Policy):
+        path = os.path.join(self.downloads_folder, entry["path"])
+        self.storage.remove(path)
+        del self.index(username)[entry["path"]]
+        EVENTS.emit(REMOVED, path=path, owner=username, collection=entry.get("collection"), media_id=entry.get("media_id"), reason=str(policy))
+
+    def expire_stories(self, username: str, policy: Policy, now: float):
+        items, files = self.stories.expire(username, now - policy.days * DAY, self.dry_run)
+        if items or files:
+            log.info(
+                "%s %d stories and %d hourly files from the story history of %s", "Would drop" if self.dry_run else "Dropped", items, files, username,
+                extra={"fields": {"user": username, "policy": str(policy), "stories": items, "files": files, "dry_run": self.dry_run}},
+            )
@@ -0,0 +1,505 @@
+import json
+import os
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from math import ceil
+from typing import Dict, List, Optional
+
+from src.api import InstagramDownloader
+from src.consts import IMAGE_SIZE_HINT, LIMIT, STORY_TTL
+from src.jobs import BACKFILL, EPHEMERAL, HIGHLIGHTS, NEW_CONTENT, PROFILE, Job, JobScheduler
+from src.layout import MediaLayout
+from src.log import get_logger
+from src.metrics import CACHE_HITS, PHASE_ITEMS, PHASE_SECONDS, SESSIONS
+from src.resolver import RESOLVE_RATE, UserResolver
+from src.storage import LocalStorage
+from src.stories import StoryStore
+from src.tracing import TRACER
+from src.transfers import TransferScheduler
+from src.utils import (
+    download_item,
+    download_profile_pic,
+    get_extension_from_url,
+    get_time_now_as_week,
+    unquote_sid,
+    verify_profile_pic,
+)
+from src.validators import ListObjectType, ListUserType, ParsedItemType
+
+log = get_logger(__name__)
+
+HIGHLIGHT_SIGNATURE = ("latest_reel_media", "media_count", "cover_id") # Tray fields that change whenever a highlight's items or cover do
+def thumbnail_cover(old: dict) -> str:
+    # The cover id whose thumbnail is saved. Files from before the field had it saved along with cover_id.
+    return old.get("thumbnail_cover", old.get("cover_id", ""))
+
+BACKFILL_PAGES = 2 # Backfill pages per poll in daemon and worker mode, the rest continues from posts_state.json on a later one
+
+
+def load_users_file(file_path):
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            listobject: ListObjectType = json.load(f)
+            usernames_list = listobject.get("categories")
+            session_map = listobject.get("sessionids")
+    except Exception:
+        raise Exception(f"Failed to load list json: {file_path}")
+    return usernames_list, session_map
+
+def get_category_session(usernames_list: Dict[str, ListUserType], session_map: Dict[str, str], category: str):
+    sessionid_tag = usernames_list[category].get("sessionid", None)
+    if sessionid_tag is None:
+        raise Exception("Invalid Session ID Reference provided")
+
+    sessionid = session_map.get(sessionid_tag, None)
+    if sessionid is None:
+        raise Exception("Invalid Session ID provided")
+    return unquote_sid(sessionid)
+
+@contextmanager
+def phase(name: str, user: str, session: str):
+    with PHASE_SECONDS.time(phase=name, user=user, session=session), TRACER.span(f"{name} {user}".strip(), "phase", user=user):
+        yield
+
+
+class CategoryRunner:
+    # Everything one category needs for a run: its session, its users and the state shared between phases
+    def __init__(
+        self,
+        category: str,
+        sessionid: str,
+        usernames: List[str],
+        downloads_folder: str,
+        transfers: Optional[TransferScheduler] = None,
+        storage = None,
+        download_limit: int = LIMIT,
+        sleep_duration: float = 1,
+        profile_pic_download: bool = True,
+        resolve_rate: float = RESOLVE_RATE,
+    ):
+        self.category = category
+        self.usernames = usernames
+        self.downloads_folder = downloads_folder
+        self.transfers = transfers
+        self.storage = storage or LocalStorage()
+        self.download_limit = download_limit
+        self.sleep_duration = sleep_duration
+        self.profile_pic_download = profile_pic_download
+
+        self.layout = MediaLayout.load(self.storage, downloads_folder)
+        self.instagram = InstagramDownloader(sessionid, transfers, self.storage, self.layout)
+        self.stories = StoryStore(self.storage, downloads_folder)
+        self.resolver = UserResolver(self.instagram, self.storage, downloads_folder, resolve_rate)
+        SESSIONS.inc()
+        self.closed = False
+
+        self.username_mappings: Dict[str, str] = {}
+        self.all_usernames: Dict[str, str] = {}
+        self.missing_profile_pic_ids: Dict[str, dict] = {}
+        self.profile_pic_futures: List[Future] = []
+        self.time_str = get_time_now_as_week()
+        self.usernames_path = os.path.join(downloads_folder, "usernames.json")
+
+    def sleep(self):
+        TRACER.sleep(self.sleep_duration)
+
+    def close(self):
+        # When the runner is done for good, so the sessions gauge goes back down
+        if not self.closed:
+            self.closed = True
+            SESSIONS.dec()
+
+    def run(self, dl_story: bool = True, dl_posts: bool = True, dl_reels: bool = False, dl_high: bool = True):
+        self.prepare()
+        return JobScheduler().run_all(self.jobs(dl_story, dl_posts, dl_reels, dl_high))
+
+    def jobs(self, dl_story: bool = True, dl_posts: bool = True, dl_reels: bool = False, dl_high: bool = True) -> List[Job]:
+        jobs = self.story_jobs() if dl_story else []
+        for user_id, username in self.username_mappings.items() if dl_posts else []:
+            jobs.extend(self.posts_jobs(user_id, username))
+        for user_id, username in self.username_mappings.items() if dl_reels else []:
+            jobs.append(Job(f"reels {username}", partial(self.download_reels, user_id, username), NEW_CONTENT))
+        for user_id, username in self.username_mappings.items() if dl_high else []:
+            jobs.extend(self.highlights_jobs(user_id, username))
+        if self.profile_pic_download:
+            jobs.append(Job(f"profile_pics {self.category}", self.download_profile_pics, PROFILE))
+        elif self.profile_pic_futures: # Those of the new users are still downloaded
+            jobs.append(Job(f"new profile_pics {self.category}", self.wait_profile_pics, PROFILE))
+        return jobs
+
+    def prepare(self, now: Optional[float] = None):
+        downloads_folder = self.downloads_folder
+        usernames = self.usernames
+
+        for username in usernames:
+            self.storage.makedirs(os.path.join(downloads_folder, username, "meta"))
+            self.storage.makedirs(os.path.join(downloads_folder, username, "profile_pics"))
+
+        users_found = self.load_mappings()
+
+        resolved: Dict[str, str] = {}
+        with phase("resolve_users", "", self.category):
+            found, us_rm = self.resolver.resolve([username for username in usernames if username not in users_found], now)
+        transfers = self.instagram.transfers
+        for username, user in found.items():
+            profile_pic = user.get("profile_pic_url_hd") or user.get("profile_pic_url")
+            user_id = user.get("id")
+            self.username_mappings[user_id] = username
+            resolved[user_id] = username
+            # In the background with the media, the first stories don't have to wait for them
+            self.profile_pic_futures.append(transfers.submit(
+                username, IMAGE_SIZE_HINT, download_profile_pic, profile_pic, username, downloads_folder, self.time_str,
+                scheduler=transfers, storage=self.storage,
+            ))
+
+        if us_rm:
+            log.warning("Removing a total of %d deleted users", len(us_rm))
+        for user in us_rm:
+            usernames.remove(user)
+
+        if resolved: # Merged into what's there now, other processes may have added users since we read it
+            self.all_usernames = self.storage.update_json(self.usernames_path, lambda current: {**current, **resolved}, {})
+
+    def retry_unresolved(self, now: Optional[float] = None):
+        # Users whose lookup failed for another reason than not existing, once their backoff is over. Only the daemon
+        # calls this, a single run tries them again next run.
+        if not any(username in self.usernames for username in self.resolver.retry_due(now)):
+            return False
+        self.prepare(now)
+        return True
+
+    def load_mappings(self):
+        # Ids of the users that were resolved before, without asking Instagram
+        users_found = set()
+        self.all_usernames = self.storage.read_json(self.usernames_path, self.all_usernames)
+        for u_id, u_name in self.all_usernames.items():
+            if u_name in self.usernames:
+                self.username_mappings[u_id] = u_name
+                users_found.add(u_name)
+        return users_found
+
+    def story_jobs(self) -> List[Job]:
+        # Traverse stories LIMIT*3 at a time
+        users = list(self.username_mappings.keys())
+        batch_size = self.download_limit * 3
+        return [
+            Job(f"stories {self.category} {i // batch_size + 1}", partial(self.story_batch_job, users[i : i + batch_size]), EPHEMERAL)
+            for i in range(0, len(users), batch_size)
+        ]
+
+    def story_batch_job(self, user_ids: List[str]) -> List[Job]:
+        self.sleep()
+        jobs = []
+        for user_id, story_data in self.fetch_story_batch(user_ids).items():
+            if not story_data:
+                continue
+            username = self.username_mappings[user_id]
+            expires = min(item["time"] for item in story_data) + STORY_TTL # The first story to vanish sets the deadline
+            jobs.append(Job(f"media stories {username}", partial(self.download_stories_media, username, story_data), EPHEMERAL, expires))
+        return jobs
+
+    def download_stories(self, user_ids: Optional[List[str]] = None):
+        users = list(self.username_mappings.keys()) if user_ids is None else user_ids
+        batch_size = self.download_limit * 3
+        stories = {}
+        for i in range(0, len(users), batch_size):
+            self.sleep()
+            stories.update(self.download_story_batch(users[i : i + batch_size]))
+        return stories
+
+    def download_story_batch(self, user_ids: List[str]) -> Dict[str, List[ParsedItemType]]:
+        stories = self.fetch_story_batch(user_ids)
+        for user_id, story_data in stories.items():
+            self.download_stories_media(self.username_mappings[user_id], story_data)
+        return stories
+
+    def fetch_story_batch(self, user_ids: List[str]) -> Dict[str, List[ParsedItemType]]:
+        username_mappings = self.username_mappings
+        cur_usernames = [username_mappings[uid] for uid in user_ids]
+        log.info("Getting stories for %s", " ".join(cur_usernames))
+
+        data = self.instagram.get_story_reels_data(user_ids)
+        self.missing_profile_pic_ids.update(
+            verify_profile_pic(
+                data["reels"].values(),
+                self.downloads_folder,
+                self.missing_profile_pic_ids,
+                storage=self.storage,
+            )
+        )
+
+        stories = {}
+        for story_data, user_id in self.instagram.parse_story_reels_data(
+            data, username_mappings
+        ):
+            username = username_mappings[str(user_id)]
+            PHASE_ITEMS.inc(len(story_data), phase="stories", session=self.category)
+            self.stories.record(username, story_data)
+            stories[str(user_id)] = story_data
+        return stories
+
+    def download_stories_media(self, username: str, story_data: List[ParsedItemType]):
+        with phase("stories", username, self.category):
+            self.instagram.download_list(
+                story_data, self.username_mappings, "stories", self.downloads_folder
+            )
+
+    def posts_jobs(self, user_id: str, username: str, new_posts: Optional[List[ParsedItemType]] = None) -> List[Job]:
+        # The newest page always runs, pages left over from an unfinished backfill pick up where they stopped
+        new_posts = [] if new_posts is None else new_posts
+        jobs = [self.posts_page_job(user_id, username, "", 1, False, new_posts)]
+        for cursor in self.load_posts_state(username).get("cursors", []):
+            jobs.append(self.posts_page_job(user_id, username, cursor, 1, True, new_posts))
+        return jobs
+
+    def posts_page_job(self, user_id: str, username: str, cursor: str, page: int, backfill: bool, new_posts: List[ParsedItemType]):
+        return Job(
+            f"posts {username} page {page}",
+            partial(self.download_posts_page, user_id, username, cursor, page, backfill, new_posts),
+            BACKFILL if backfill else NEW_CONTENT,
+        )
+
+    def download_posts(self, user_id: str, username: str, backfill_pages: int = 0) -> List[ParsedItemType]:
+        new_posts: List[ParsedItemType] = []
+        JobScheduler(backfill_limit=backfill_pages).run_all(self.posts_jobs(user_id, username, new_posts))
+        return new_posts
+
+    def backfill_left(self, username: str):
+        return bool(self.load_posts_state(username).get("cursors"))
+
+    def download_posts_page(self, user_id: str, username: str, cursor: str, page: int, backfill: bool, new_posts: List[ParsedItemType]) -> List[Job]:
+        self.sleep()
+        with phase("posts", username, self.category):
+            if page == 1:
+                log.info("Getting posts for %s %s", username, user_id)
+
+            posts_folder = os.path.join("posts")
+            old_posts = self.load_posts(username)
+            known_posts = {p["id"] for p in old_posts}
+
+            # Like before, the newest page asks for a single post so runs with nothing new stay cheap
+            count = 1 if not cursor else 50
+            items, next_id, has_more = self.instagram.get_posts_page(user_id, cursor, count, page)
+            posts_data = []
+            for item in items:
+                if item["pk"] in known_posts:
+                    CACHE_HITS.inc(kind="known_post")
+                    has_more = False
+                    break
+                posts_data.append(item)
+
+            self.missing_profile_pic_ids.update(verify_profile_pic(posts_data, self.downloads_folder, self.missing_profile_pic_ids, force=True, storage=self.storage)) # Force redownload all pics, it won't take much and it's just one time, and better safe than sorry, since this is already HD.
+            full_posts = []
+            for posts in self.instagram.parse_posts_data(posts_data):
+                full_posts.extend(posts)
+            PHASE_ITEMS.inc(len(full_posts), phase="posts", session=self.category)
+            self.instagram.download_list(
+                full_posts, self.username_mappings, posts_folder, self.downloads_folder
+            )
+            new_posts.extend(full_posts)
+
+            # Save after every page so an interrupted backfill resumes from here next run
+            self.save_posts(username, sorted(full_posts + old_posts, key=lambda p: p["time"], reverse=True))
+            state = self.load_posts_state(username)
+            cursors = [c for c in state.get("cursors", []) if c != cursor]
+            if has_more and next_id:
+                cursors.append(next_id)
+            state["cursors"] = cursors
+            self.save_posts_state(username, state)
+
+        if has_more and next_id:
+            # A user with nothing saved yet is being backfilled, anything past the first page can wait
+            return [self.posts_page_job(user_id, username, next_id, page + 1, backfill or not old_posts, new_posts)]
+        return []
+
+    def load_posts(self, username: str) -> List[ParsedItemType]:
+        return self.storage.read_json(os.path.join(self.downloads_folder, username, "meta", "posts.json"), [])
+
+    def save_posts(self, username: str, posts: List[ParsedItemType]):
+        self.storage.write_json(os.path.join(self.downloads_folder, username, "meta", "posts.json"), posts)
+
+    def load_posts_state(self, username: str) -> dict:
+        return self.storage.read_json(os.path.join(self.downloads_folder, username, "meta", "posts_state.json"), {})
+
+    def save_posts_state(self, username: str, state: dict):
+        self.storage.write_json(os.path.join(self.downloads_folder, username, "meta", "posts_state.json"), state)
+
+    def download_reels(self, user_id: str, username: str) -> List[ParsedItemType]:
+        self.sleep()
+        with phase("reels", username, self.category):
+            log.info("Getting reels for %s %s", username, user_id)
+
+            reels_folder = os.path.join("reels")
+            reels_meta_path = os.path.join(self.downloads_folder, username, "meta")
+            reels_file = os.path.join(reels_meta_path, "reels.json")
+            old_reels = self.storage.read_json(reels_file, [])
+
+            reels_data = list(self.instagram.get_reels_data(user_id, old_reels))
+            full_reels = []
+            for reels in self.instagram.parse_posts_data(reels_data):
+                full_reels.extend(reels)
+            PHASE_ITEMS.inc(len(full_reels), phase="reels", session=self.category)
+            self.instagram.download_list(
+                full_reels, self.username_mappings, reels_folder, self.downloads_folder
+            )
+
+            self.storage.write_json(reels_file, full_reels + old_reels)
+        return full_reels
+
+    def highlights_jobs(self, user_id: str, username: str, highlights_data: Optional[dict] = None) -> List[Job]:
+        highlights_data = {} if highlights_data is None else highlights_data
+        return [Job(f"highlights {username}", partial(self.download_highlight_tray, user_id, username, highlights_data), HIGHLIGHTS)]
+
+    def download_highlights(self, user_id: str, username: str):
+        highlights_data: dict = {}
+        JobScheduler().run_all(self.highlights_jobs(user_id, username, highlights_data))
+        return highlights_data
+
+    def download_highlight_tray(self, user_id: str, username: str, highlights_data: dict) -> List[Job]:
+        download_limit = self.download_limit
+        self.sleep()
+        with phase("highlights", username, self.category):
+            log.info("Getting highlights for %s %s", username, user_id)
+            tray, _ = self.instagram.get_highlights_data(user_id)
+            old_highlights = self.load_highlights(username)
+            changed = []
+            covers = []
+            for h_id, highlight in tray.items():
+                old = old_highlights.get(h_id)
+                highlight["thumbnail_cover"] = thumbnail_cover(old or {})
+                if old is not None and old.get("reels") and highlight["latest_reel_media"] and all(old.get(key) == highlight[key] for key in HIGHLIGHT_SIGNATURE):
+                    highlight["reels"] = old["reels"]
+                    CACHE_HITS.inc(kind="highlight")
+                    if old["title"] != highlight["title"]:
+                        self.save_highlight_name(username, h_id, highlight["title"])
+                    if self.download_highlight_cover(username, h_id, highlight): # One that had no cover image last time
+                        covers.append(h_id)
+                else:
+                    changed.append(f"highlight:{h_id}")
+            highlights_data.update(tray)
+            if changed or covers or [(h_id, h["title"]) for h_id, h in tray.items()] != [(h_id, h.get("title")) for h_id, h in old_highlights.items()]:
+                self.save_highlights(username, highlights_data)
+
+        if not changed:
+            log.info("No changes in the highlights of %s", username)
+            return []
+        pages = ceil(len(changed) / download_limit)
+        return [
+            Job(
+                f"highlights {username} page {i // download_limit + 1}",
+                partial(self.download_highlights_page, user_id, username, highlights_data, old_highlights, changed[i : i + download_limit], i // download_limit + 1, pages),
+                HIGHLIGHTS,
+            )
+            for i in range(0, len(changed), download_limit)  # Walk 3 at a time
+        ]
+
+    def download_highlights_page(self, user_id: str, username: str, highlights_data: dict, old_highlights: dict, cur_h: List[str], page: int, pages: int):
+        downloads_folder = self.downloads_folder
+        self.sleep()
+        with phase("highlights", username, self.category):
+            log.info("Getting highlights page %d / %d of %s", page, pages, username)
+            with TRACER.span(f"highlights page {page}", "page", user_id=user_id):
+                data = self.instagram.get_story_reels_data(cur_h)
+
+            for j, highlight in enumerate(data["reels"].values()):
+                h_id = highlight["id"].split(":", 1)[-1]
+                old = old_highlights.get(h_id, {})
+                known = {str(item["id"]) for item in old.get("reels", [])}
+                reels = highlights_data[h_id]["reels"] = list(self.instagram.parse_highlights_data(highlight["items"]))
+                new_reels = [item for item in reels if str(item["id"]) not in known]
+                PHASE_ITEMS.inc(len(new_reels), phase="highlights", session=self.category)
+
+                highlights_folder = os.path.join("highlights", h_id)
+                log.info("Getting highlight %s (%d/%d), %d new of %d", h_id, j + 1, len(cur_h), len(new_reels), len(reels))
+                self.instagram.download_list(
+                    new_reels,
+                    self.username_mappings,
+                    highlights_folder,
+                    downloads_folder,
+                )
+
+                self.download_highlight_cover(username, h_id, highlights_data[h_id])
+                if old.get("title") != highlights_data[h_id]["title"]:
+                    self.save_highlight_name(username, h_id, highlights_data[h_id]["title"])
+
+            self.save_highlights(username, highlights_data)
+
+    def download_highlight_cover(self, username: str, h_id: str, highlight: dict):
+        # Kept apart from cover_id, which is part of the tray signature, so a missing cover image only retries the thumbnail
+        saved = highlight.get("thumbnail_cover", "")
+        if saved == highlight["cover_id"]:
+            return False
+        thumb_url = highlight["thumbnail_url"]
+        if not thumb_url:
+            log.info("No cover image for highlight %s, trying its thumbnail again next run", h_id)
+            return False
+        log.debug("Saving thumbnail of %s", h_id)
+        highlights_folder = os.path.join("highlights", h_id)
+        download_item(
+            thumb_url, os.path.join(self.downloads_folder, username, highlights_folder, "thumbnail." + get_extension_from_url(thumb_url)),
+            desc="thumbnail", scheduler=self.transfers, key=username, storage=self.storage,
+            force=bool(saved), # Same file name for the new cover
+            event={"kind": "thumbnail", "media_id": h_id, "collection": highlights_folder},
+        )
+        highlight["thumbnail_cover"] = highlight["cover_id"]
+        return True
+
+    def save_highlight_name(self, username: str, h_id: str, title: str):
+        self.storage.write_text(os.path.join(self.downloads_folder, username, "highlights", h_id, "name.txt"), title)
+
+    def load_highlights(self, username: str) -> dict:
+        return self.storage.read_json(os.path.join(self.downloads_folder, username, "meta", "highlights.json"), {})
+
+    def save_highlights(self, username: str, highlights_data: dict):
+        highlights_path = os.path.join(self.downloads_folder, username, "meta")
+        self.storage.makedirs(highlights_path)
+
+        highlights_file = os.path.join(highlights_path, "highlights.json")
+        self.storage.write_json(highlights_file, highlights_data)
+
+    def wait_profile_pics(self):
+        futures, self.profile_pic_futures = self.profile_pic_futures, []
+        self.instagram.transfers.wait(futures)
+
+    def download_profile_pics(self, check_expired: bool = True):
+        self.wait_profile_pics() # Their last.txt says they are up to date
+        downloads_folder = self.downloads_folder
+        missing_profile_pic_ids = self.missing_profile_pic_ids
+        self.time_str = get_time_now_as_week()
+        with phase("profile_pics", "", self.category):
+            log.info("Validating profile pictures")
+            for username in self.usernames if check_expired else []:
+                if username in missing_profile_pic_ids:
+                    continue
+                pro_pic_path = os.path.join(downloads_folder, username, "profile_pics")
+                pro_pic_file_path = os.path.join(pro_pic_path, "last.txt")
+                self.storage.makedirs(pro_pic_path)
+                if username in self.username_mappings.values():
+                    last_date = self.storage.read_text(pro_pic_file_path).strip()
+                    if last_date == self.time_str:
+                        continue
+                    log.info("Profile pic expired for %s, getting a new one", username)
+                    missing_profile_pic_ids[username] = {}
+
+            for username, user_obj in missing_profile_pic_ids.items():
+                log.info("Getting a new profile pic for %s", username)
+                self.sleep()
+                user_id = user_obj.get("id")
+                sd_url = user_obj.get("sd_url")
+                hd_url = user_obj.get("hd_url")
+                hd_max_url = user_obj.get("hd_max_url")
+                force = False
+                if hd_max_url:
+                    profile_pic = hd_max_url
+                    force = True
+                elif hd_url:
+                    profile_pic = hd_url
+                else:
+                    user = self.instagram.get_user_profile(username)
+                    profile_pic = user.get("profile_pic_url_hd") or user.get("profile_pic_url") or sd_url
+                    user_id = user.get("id")
+                self.username_mappings[user_id] = username
+                self.all_usernames[user_id] = username
+                download_profile_pic(profile_pic, username, downloads_folder, self.time_str, force=force, scheduler=self.transfers, storage=self.storage)
+            missing_profile_pic_ids.clear()
@@ -0,0 +1,292 @@
+import mimetypes
+import os
+import shutil
+import threading
+import time
+from contextlib import ExitStack
+from typing import Dict, Optional, Set
+from urllib.parse import urlparse
+
+from src.codec import dumps, loads
+from src.events import EVENTS, METADATA_UPDATED
+from src.metrics import CACHE_HITS, METRICS
+from src.utils import DOWNLOAD_CHUNK_SIZE, STALE_PART_SECONDS, claim_file, optional_module, set_creation_time, write_response
+
+PART_SIZE = 8 * 1024 * 1024 # S3 wants at least 5MB for every part but the last
+
+STORAGE_REQUESTS = METRICS.counter("ig_storage_requests_total", "Requests made to the storage backend, by operation.", ["operation"])
+
+
+def open_storage(url: str, root: str, endpoint_url: str = ""):
+    # Paths are still built under the downloads folder (root), a backend maps them to its own keys
+    if not url or url.startswith("file://"):
+        return LocalStorage()
+    if url.startswith("s3://"):
+        parsed = urlparse(url)
+        return S3Storage(parsed.netloc, parsed.path.strip("/"), root, endpoint_url)
+    raise ValueError(f"Unknown storage {url}, expected s3://bucket/prefix")
+
+
+class LocalStorage:
+    # Plain files under the downloads folder. Other backends take the same paths and map them to their own keys.
+    def exists(self, path: str):
+        return os.path.exists(path)
+
+    def has_dir(self, path: str):
+        return os.path.isdir(path)
+
+    def makedirs(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+    def listdir(self, path: str):
+        return set(os.listdir(path)) if os.path.isdir(path) else set()
+
+    def save_response(self, context, path: str, timestamp: int = 0, desc = None, scheduler = None, key: str = "", force: bool = False) -> Optional[int]:
+        # Written next to the target and moved in place when done, so a file that exists is always complete
+        part_path = path + ".part"
+        if not claim_file(part_path):
+            return None
+        try:
+            if os.path.exists(path) and not force: # Finished by someone else in the meantime
+                return None
+            written = write_response(context, part_path, timestamp, desc=desc, scheduler=scheduler, key=key)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return written
+
+    def in_progress(self, path: str):
+        # Claimed by a download that is still writing, see claim_file
+        try:
+            return time.time() - os.path.getmtime(path + ".part") < STALE_PART_SECONDS
+        except FileNotFoundError:
+            return False
+
+    def copy(self, src: str, dst: str, timestamp: int = 0):
+        if os.path.exists(dst) or not os.path.exists(src):
+            return False
+        shutil.copy2(src, dst)
+        if timestamp > 0:
+            set_creation_time(dst, timestamp)
+        return True
+
+    def read_json(self, path: str, default = None):
+        if not os.path.exists(path):
+            return default
+        with open(path, "rb") as f:
+            return loads(f.read())
+
+    def write_json(self, path: str, data):
+        with open(path, "wb") as f:
+            f.write(dumps(data))
+        EVENTS.emit(METADATA_UPDATED, path=path)
+
+    def update_json(self, path: str, update, default = None):
+        # Read, change and write back under a lock file, for files several processes write to (usernames.json)
+        lock_path = path + ".lock"
+        while not claim_file(lock_path):
+            time.sleep(0.05)
+        try:
+            data = update(self.read_json(path, default))
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(dumps(data))
+            os.replace(tmp_path, path)
+        finally:
+            os.remove(lock_path)
+        EVENTS.emit(METADATA_UPDATED, path=path)
+        return data
+
+    def append_text(self, path: str, text: str):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(text)
+
+    def remove(self, path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def read_text(self, path: str, default: str = ""):
+        if not os.path.exists(path):
+            return default
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def write_text(self, path: str, text: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        EVENTS.emit(METADATA_UPDATED, path=path)
+
+LOCAL_STORAGE = LocalStorage()
+
+
+class S3Storage:
+    # S3 compatible object storage (AWS, MinIO, ...). Media goes straight from the CDN into a multipart upload, nothing touches the local disk.
+    def __init__(self, bucket: str, prefix: str, root: str, endpoint_url: str = ""):
+        boto3 = optional_module("boto3") # Heavy, only imported when object storage is used
+        if boto3 is None:
+            raise Exception("The boto3 package is needed for s3:// storage, install it with pip install boto3")
+        self.client_error = optional_module("botocore.exceptions").ClientError
+        self.bucket = bucket
+        self.prefix = prefix + "/" if prefix else ""
+        self.root = os.path.abspath(root)
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or os.environ.get("AWS_ENDPOINT_URL") or None)
+        # One listing per folder instead of a HEAD per file, kept up to date with our own writes
+        self._listings: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def key(self, path: str):
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        if relative.startswith(".."):
+            raise ValueError(f"{path} is outside of the downloads folder {self.root}")
+        if relative == ".":
+            return self.prefix
+        return self.prefix + relative.replace(os.sep, "/")
+
+    def listdir(self, path: str):
+        folder = self.key(path).rstrip("/")
+        folder = folder + "/" if folder else ""
+        with self._lock:
+            if folder in self._listings:
+                CACHE_HITS.inc(kind="storage_listing")
+                return self._listings[folder]
+        names = set()
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=folder, Delimiter="/"):
+            STORAGE_REQUESTS.inc(operation="list")
+            names.update(item["Key"][len(folder):] for item in page.get("Contents", []))
+            names.update(item["Prefix"][len(folder):].rstrip("/") for item in page.get("CommonPrefixes", []))
+        with self._lock:
+            return self._listings.setdefault(folder, names)
+
+    def _added(self, path: str):
+        # Record a new key, and any new folders on the way up, in the cached listings
+        path = os.path.abspath(path)
+        while path != self.root:
+            folder, name = os.path.split(path)
+            names = self.listdir(folder)
+            if name in names:
+                break
+            names.add(name)
+            path = folder
+
+    def exists(self, path: str):
+        folder, name = os.path.split(path)
+        return name in self.listdir(folder)
+
+    def has_dir(self, path: str):
+        return self.exists(path)
+
+    def makedirs(self, path: str):
+        pass # Folders are just key prefixes
+
+    def save_response(self, context, path: str, timestamp: int = 0, desc = None, scheduler = None, key: str = "", force: bool = False) -> Optional[int]:
+        object_key = self.key(path)
+        extra = {"Metadata": {"mtime": str(timestamp)}} if timestamp > 0 else {}
+        if context.headers.get("content-type"):
+            extra["ContentType"] = context.headers["content-type"]
+
+        upload_id = None
+        parts = []
+        buffer = bytearray()
+        written = 0
+        try:
+            with ExitStack() as stack:
+                if scheduler is not None:
+                    stack.enter_context(scheduler.transfer(key))
+                for chunk in context.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    if scheduler is not None:
+                        scheduler.throttle(key, len(chunk))
+                    buffer += chunk
+                    written += len(chunk)
+                    if len(buffer) >= PART_SIZE:
+                        if upload_id is None:
+                            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=object_key, **extra)["UploadId"]
+                            STORAGE_REQUESTS.inc(operation="create_multipart")
+                        parts.append(self._upload_part(object_key, upload_id, len(parts) + 1, buffer))
+                        buffer = bytearray()
+
+            if upload_id is None: # Small enough for one request
+                self.client.put_object(Bucket=self.bucket, Key=object_key, Body=bytes(buffer), **extra)
+                STORAGE_REQUESTS.inc(operation="put")
+            else:
+                if buffer:
+                    parts.append(self._upload_part(object_key, upload_id, len(parts) + 1, buffer))
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=object_key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+                STORAGE_REQUESTS.inc(operation="complete_multipart")
+        except BaseException:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=object_key, UploadId=upload_id)
+            raise
+        self._added(path)
+        return written
+
+    def _upload_part(self, object_key: str, upload_id: str, number: int, data: bytearray):
+        response = self.client.upload_part(Bucket=self.bucket, Key=object_key, UploadId=upload_id, PartNumber=number, Body=bytes(data))
+        STORAGE_REQUESTS.inc(operation="upload_part")
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def in_progress(self, path: str):
+        return False # Uploads are not claimed, whoever finishes last wins
+
+    def copy(self, src: str, dst: str, timestamp: int = 0):
+        # Server side copy, the bytes never come back to us
+        if self.exists(dst) or not self.exists(src):
+            return False
+        extra = {}
+        if timestamp > 0: # Replacing the metadata drops the content type too
+            extra = {"Metadata": {"mtime": str(timestamp)}, "MetadataDirective": "REPLACE", "ContentType": mimetypes.guess_type(dst)[0] or "application/octet-stream"}
+        self.client.copy_object(Bucket=self.bucket, Key=self.key(dst), CopySource={"Bucket": self.bucket, "Key": self.key(src)}, **extra)
+        STORAGE_REQUESTS.inc(operation="copy")
+        self._added(dst)
+        return True
+
+    def _get(self, path: str):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(path))["Body"].read()
+        except self.client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        finally:
+            STORAGE_REQUESTS.inc(operation="get")
+        return body
+
+    def _put(self, path: str, body: bytes, content_type: str):
+        self.client.put_object(Bucket=self.bucket, Key=self.key(path), Body=body, ContentType=content_type)
+        STORAGE_REQUESTS.inc(operation="put")
+        self._added(path)
+        EVENTS.emit(METADATA_UPDATED, path=path)
+
+    def read_json(self, path: str, default = None):
+        body = self._get(path)
+        return default if body is None else loads(body)
+
+    def write_json(self, path: str, data):
+        self._put(path, dumps(data), "application/json")
+
+    def update_json(self, path: str, update, default = None):
+        # No locking on object storage, a write that lands in between is lost. Fine for usernames.json, the users are resolved again next run.
+        data = update(self.read_json(path, default))
+        self.write_json(path, data)
+        return data
+
+    def append_text(self, path: str, text: str):
+        # Objects can't be appended to, so this rewrites the whole object. Only used for small logs that get compacted.
+        self._put(path, (self.read_text(path) + text).encode("utf-8"), "text/plain; charset=utf-8")
+
+    def remove(self, path: str):
+        if not self.exists(path):
+            return
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+        STORAGE_REQUESTS.inc(operation="delete")
+        folder, name = os.path.split(path)
+        self.listdir(folder).discard(name)
+
+    def read_text(self, path: str, default: str = ""):
+        body = self._get(path)
+        return default if body is None else body.decode("utf-8")
+
+    def write_text(self, path: str, text: str):
+        self._put(path, text.encode("utf-8"), "text/plain; charset=utf-8")
@@ -0,0 +1,137 @@
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from src.codec import dumps_line, loads
+from src.consts import STORY_TTL
+from src.storage import LocalStorage
+from src.validators import ParsedItemType
+
+STORE_FILE = "stories.json" # Compacted: every story ever seen, keyed by id, with first and last seen times
+LOG_FILE = "stories.log.jsonl" # Deltas since the last compaction, one line per poll
+COMPACT_EVERY = 24 * 7 # Polls, about a week of hourly runs
+
+HOUR_FORMAT = r"%d-%m-%y_%H" # Same as the old story_{hour}.json names
+
+
+def hour_start(hour: str) -> int:
+    return int(datetime.strptime(hour, HOUR_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+def hour_name(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(HOUR_FORMAT)
+
+
+def empty_state():
+    return {"snapshots": [], "items": {}}
+
+def apply(state: dict, entry: dict):
+    # Safe to apply twice, a crash between writing the store and clearing the log replays the log
+    at = entry["at"]
+    items = state["items"]
+    for item in entry.get("new", []):
+        items.setdefault(str(item["id"]), {"first_seen": at, "last_seen": at, "item": item})
+    for item_id in entry.get("seen", []):
+        seen = items.get(item_id)
+        if seen is not None:
+            seen["first_seen"] = min(seen["first_seen"], at)
+            seen["last_seen"] = max(seen["last_seen"], at)
+    state["snapshots"].append(at)
+
+
+class StoryStore:
+    # Replaces the hourly story_{hour}.json dumps, which repeated every story about 24 times. A poll only appends the ids it saw and the stories that are new.
+    def __init__(self, storage = None, downloads_folder: str = "", compact_every: int = COMPACT_EVERY):
+        self.storage = storage or LocalStorage()
+        self.downloads_folder = downloads_folder
+        self.compact_every = compact_every
+        self.recent: Dict[str, Dict[str, int]] = {} # Per user, the ids of stories that can still be up, with their times
+        self.entries: Dict[str, int] = {} # Per user, lines in the log since the last compaction
+
+    def meta_path(self, username: str):
+        return os.path.join(self.downloads_folder, username, "meta")
+
+    def legacy_files(self, username: str) -> List[str]:
+        names = self.storage.listdir(self.meta_path(username))
+        return sorted(name for name in names if name.startswith("story_") and name.endswith(".json"))
+
+    def load(self, username: str, include_legacy: bool = False):
+        meta_path = self.meta_path(username)
+        state = self.storage.read_json(os.path.join(meta_path, STORE_FILE), None) or empty_state()
+        entries = 0
+        if include_legacy:
+            for name in self.legacy_files(username):
+                data = self.storage.read_json(os.path.join(meta_path, name), [])
+                at = hour_start(name[len("story_") : -len(".json")])
+                apply(state, {"at": at, "new": data, "seen": [str(item["id"]) for item in data]})
+        for line in self.storage.read_text(os.path.join(meta_path, LOG_FILE)).splitlines():
+            if line:
+                apply(state, loads(line))
+                entries += 1
+        state["snapshots"] = sorted(set(state["snapshots"]))
+        return state, entries
+
+    def record(self, username: str, items: List[ParsedItemType], now: Optional[float] = None) -> List[ParsedItemType]:
+        # Returns the stories this poll saw for the first time
+        at = int(now or time.time())
+        if username not in self.recent: # Only the first poll of a run reads the store, later ones only append
+            state, self.entries[username] = self.load(username)
+            self.recent[username] = {item_id: entry["item"].get("time", 0) for item_id, entry in state["items"].items()}
+        recent = self.recent[username]
+        new = [item for item in items if str(item["id"]) not in recent]
+        entry = {"at": at, "seen": [str(item["id"]) for item in items], "new": new}
+        self.storage.append_text(os.path.join(self.meta_path(username), LOG_FILE), dumps_line(entry).decode("utf-8") + "\n")
+        recent.update((str(item["id"]), item.get("time", 0)) for item in items)
+        for item_id in [item_id for item_id, taken_at in recent.items() if taken_at < at - STORY_TTL]: # Gone from Instagram, can't be seen again
+            del recent[item_id]
+        self.entries[username] += 1
+        if self.entries[username] >= self.compact_every:
+            self.save(username, self.load(username)[0])
+        return new
+
+    def save(self, username: str, state: dict):
+        meta_path = self.meta_path(username)
+        self.storage.write_json(os.path.join(meta_path, STORE_FILE), state)
+        self.storage.write_text(os.path.join(meta_path, LOG_FILE), "")
+        if username in self.entries:
+            self.entries[username] = 0
+
+    def compact(self, username: str, include_legacy: bool = True) -> int:
+        # Folds the log, and any story_{hour}.json files from before the store existed, into stories.json. Returns the number of old files removed.
+        legacy = self.legacy_files(username) if include_legacy else []
+        state, entries = self.load(username, include_legacy)
+        if not entries and not legacy:
+            return 0
+        self.save(username, state)
+        for name in legacy: # Only once their contents are in the store
+            self.storage.remove(os.path.join(self.meta_path(username), name))
+        return len(legacy)
+
+    def expire(self, username: str, before: float, dry_run: bool = False):
+        # Forgets stories last seen before, and polls and hourly files from before then. Returns how many stories and files go.
+        legacy = [name for name in self.legacy_files(username) if hour_start(name[len("story_") : -len(".json")]) < before]
+        state, _ = self.load(username)
+        old = [item_id for item_id, entry in state["items"].items() if entry["last_seen"] < before]
+        if dry_run or not (old or legacy):
+            return len(old), len(legacy)
+        for item_id in old:
+            del state["items"][item_id]
+        state["snapshots"] = [at for at in state["snapshots"] if at >= before]
+        self.save(username, state)
+        for name in legacy:
+            self.storage.remove(os.path.join(self.meta_path(username), name))
+        return len(old), len(legacy)
+
+    def items(self, username: str) -> Dict[str, dict]:
+        return self.load(username, include_legacy=True)[0]["items"]
+
+    def view(self, username: str, hour: str) -> Optional[List[ParsedItemType]]:
+        # What story_{hour}.json used to hold: the stories up during the last poll of that hour. None when there was no poll.
+        state, _ = self.load(username, include_legacy=True)
+        start = hour_start(hour)
+        polls = [at for at in state["snapshots"] if start <= at < start + 3600]
+        if not polls:
+            return None
+        at = polls[-1]
+        seen = [entry for entry in state["items"].values() if entry["first_seen"] <= at <= entry["last_seen"]]
+        return [entry["item"] for entry in sorted(seen, key=lambda entry: entry["item"].get("time", 0))]
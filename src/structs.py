@@ -0,0 +1,88 @@
+from typing import Dict, List, Optional, Union
+
+import msgspec
+
+# Only imported by src/codec.py once --fast-json is on with msgspec installed
+
+
+class Record(msgspec.Struct):
+    # Lets the rest of the code keep using item["key"] / item.get("key") on structs
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default = None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+# Mirrors of the TypedDicts in src/validators.py, cut down to the fields that are read. Everything else in a response is skipped while decoding.
+
+class ProfilePicInfo(Record):
+    url: str = ""
+
+class User(Record):
+    pk: Union[int, str] = ""
+    id: Union[int, str, None] = None
+    username: str = ""
+    profile_pic_url: Optional[str] = None
+    profile_pic_url_hd: Optional[str] = None
+    hd_profile_pic_url_info: Optional[ProfilePicInfo] = None
+
+class MediaCandidate(Record):
+    width: int = 0
+    height: int = 0
+    url: str = ""
+
+class ImageVersions(Record):
+    candidates: List[MediaCandidate] = []
+
+class UserMediaTag(Record):
+    user: User
+
+class ReelItem(Record):
+    pk: Union[int, str]
+    user: Optional[User] = None
+    taken_at: int = 0
+    carousel_parent_id: Union[int, str, None] = None
+    parent_id: Union[int, str, None] = None
+    audience: str = ""
+    image_versions2: Optional[ImageVersions] = None
+    video_versions: Optional[List[MediaCandidate]] = None
+    usertags: Optional[Dict[str, List[UserMediaTag]]] = None
+    carousel_media: Optional[List["ReelItem"]] = None
+
+class FeedPage(Record):
+    items: List[ReelItem] = []
+    next_max_id: Union[int, str, None] = ""
+    more_available: bool = False
+
+class Reel(Record):
+    id: Union[int, str]
+    user: Optional[User] = None
+    items: List[ReelItem] = []
+
+class ReelsMedia(Record):
+    reels: Dict[str, Reel] = {}
+
+class TagUser(Record, gc=False):
+    id: Union[int, str]
+    username: str
+
+class ParsedItem(Record, gc=False): # No reference cycles possible, so the GC can skip the millions of these a backfill creates
+    id: Union[int, str]
+    owner: Union[int, str]
+    owner_username: str
+    tagged_users: List[TagUser]
+    image_url: str
+    video_url: Optional[str]
+    besties_only: bool
+    parent: Union[int, str, None]
+    time: int
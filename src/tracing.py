@@ -0,0 +1,136 @@
+import io
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List
+
+# Categories that are waiting rather than working, reported apart in the summary
+WAIT_CATEGORIES = ("sleep", "rate_limit")
+
+
+class Tracer:
+    # Records nested spans as Chrome trace "complete" events, loadable in chrome://tracing or ui.perfetto.dev
+    def __init__(self):
+        self.enabled = False
+        self.events: List[dict] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._threads: Dict[int, str] = {}
+        self._self_time: Dict[str, float] = defaultdict(float)
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, cat: str = "work", **args):
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        stack.append(0.0) # Time spent in children, to get this span's own time
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += duration
+            args["cpu_ms"] = round((time.thread_time() - cpu_start) * 1000, 3)
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": round((start - self._origin) * 1e6, 1),
+                "dur": round(duration * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+                self._threads[thread.ident] = thread.name # type: ignore
+                self._self_time[cat] += duration - children
+
+    def iter_spans(self, iterable: Iterable, name: Callable[..., str], cat: str = "work"):
+        # Wraps every loop iteration in a span without indenting the loop body
+        for item in iterable:
+            with self.span(name(item), cat):
+                yield item
+
+    def sleep(self, seconds: float, cat: str = "sleep"):
+        with self.span("sleep", cat, seconds=seconds):
+            time.sleep(seconds)
+
+    def _stack(self) -> List[float]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def write(self, path: str):
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in self._threads.items()
+        ]
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        waiting = sum(self._self_time.get(cat, 0) for cat in WAIT_CATEGORIES)
+        working = sum(t for cat, t in self._self_time.items() if cat not in WAIT_CATEGORIES)
+        lines = [f"Traced {len(self.events)} spans: {working:.2f}s working, {waiting:.2f}s waiting"]
+        for cat, seconds in sorted(self._self_time.items(), key=lambda x: -x[1]):
+            lines.append(f"  {cat:<12} {seconds:10.2f}s")
+        return "\n".join(lines)
+
+
+TRACER = Tracer()
+
+
+class Profiler:
+    def __init__(self, path: str, limit: int = 40):
+        self.path = path
+        self.limit = limit
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.write()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def write(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.profile.dump_stats(self.path + ".prof") # Raw stats for snakeviz and friends
+        import pstats # Slow to import, only needed with --profile
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out).strip_dirs()
+        out.write("Hot spots by own time\n")
+        stats.sort_stats("tottime").print_stats(self.limit)
+        out.write("Hot spots by cumulative time\n")
+        stats.sort_stats("cumulative").print_stats(self.limit)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+
@@ -0,0 +1,174 @@
+import heapq
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterable, List, Tuple
+
+from src.tracing import TRACER
+
+
+class TransferScheduler:
+    # Shapes media transfers: a global bytes/s cap split evenly between the keys (users / collections)
+    # that are currently transferring, and a queue that hands out pending downloads round robin per key,
+    # smallest first, so a single huge video can't hold back a pile of small images.
+    def __init__(self, max_bytes_per_second: float = 0, workers: int = 0, rate_window: float = 5.0):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.workers = workers
+        self.rate_window = rate_window
+
+        self._cond = threading.Condition()
+        self._pending: Dict[str, list] = {}
+        self._keys: Deque[str] = deque() # Keys with pending jobs, in round robin order
+        self._active: Dict[str, int] = defaultdict(int)
+        self._allowance: Dict[str, float] = {}
+        self._last_refill = time.monotonic()
+        self._threads: List[threading.Thread] = []
+        self._seq = 0
+        self._closed = False
+
+        self.started_at = time.monotonic()
+        self.bytes_total = 0
+        self.bytes_by_key: Dict[str, int] = defaultdict(int)
+        self.completed = 0
+        self.failed = 0
+        self._samples: Deque[Tuple[float, int]] = deque()
+
+    # Queue
+
+    def submit(self, key: str, size_hint: int, fn: Callable, /, *args, **kwargs) -> Future:
+        future: Future = Future()
+        if not self.workers:
+            self._execute(future, fn, args, kwargs)
+            return future
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Transfer scheduler is closed")
+            self._start_workers()
+            self._seq += 1
+            heap = self._pending.setdefault(key, [])
+            if not heap:
+                self._keys.append(key)
+            heapq.heappush(heap, (size_hint, self._seq, future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def wait(self, futures: Iterable[Future]):
+        futures = list(futures)
+        wait(futures)
+        for future in futures:
+            future.result() # Raise the first failure like a serial download would
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"transfer-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._keys and not self._closed:
+                    self._cond.wait()
+                if not self._keys:
+                    return
+                key = self._keys.popleft()
+                heap = self._pending[key]
+                _, _, future, fn, args, kwargs = heapq.heappop(heap)
+                if heap:
+                    self._keys.append(key)
+                else:
+                    del self._pending[key]
+            self._execute(future, fn, args, kwargs)
+
+    def _execute(self, future: Future, fn: Callable, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._cond:
+                self.failed += 1
+            future.set_exception(e)
+        else:
+            with self._cond:
+                self.completed += 1
+            future.set_result(result)
+
+    # Bandwidth
+
+    @contextmanager
+    def transfer(self, key: str):
+        with self._cond:
+            self._refill()
+            self._active[key] += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._refill()
+                self._active[key] -= 1
+                if not self._active[key]:
+                    del self._active[key]
+                    self._allowance.pop(key, None)
+                self._cond.notify_all()
+
+    def throttle(self, key: str, nbytes: int):
+        with self._cond:
+            while self.max_bytes_per_second > 0:
+                self._refill()
+                allowance = self._allowance.get(key, 0)
+                if allowance > 0 or key not in self._active:
+                    # Chunks bigger than the allowance go into debt and are paid back by waiting later
+                    self._allowance[key] = allowance - nbytes
+                    break
+                share = self.max_bytes_per_second / max(len(self._active), 1)
+                with TRACER.span("bandwidth wait", "rate_limit", user=key):
+                    self._cond.wait(-allowance / share + 0.001)
+            self._record(key, nbytes)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if not self._active or self.max_bytes_per_second <= 0:
+            return
+        share = self.max_bytes_per_second / len(self._active)
+        for key in self._active:
+            self._allowance[key] = min(self._allowance.get(key, 0) + elapsed * share, share) # At most 1s of burst
+
+    # Counters
+
+    def _record(self, key: str, nbytes: int):
+        now = time.monotonic()
+        self.bytes_total += nbytes
+        self.bytes_by_key[key] += nbytes
+        self._samples.append((now, nbytes))
+        while self._samples and now - self._samples[0][0] > self.rate_window:
+            self._samples.popleft()
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            window_bytes = sum(n for t, n in self._samples if now - t <= self.rate_window)
+            elapsed = now - self.started_at
+            return {
+                "bytes": self.bytes_total,
+                "bytes_per_second": window_bytes / min(self.rate_window, elapsed or 1),
+                "average_bytes_per_second": self.bytes_total / (elapsed or 1),
+                "active": sum(self._active.values()),
+                "pending": sum(len(heap) for heap in self._pending.values()),
+                "completed": self.completed,
+                "failed": self.failed,
+                "by_key": dict(self.bytes_by_key),
+            }
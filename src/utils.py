@@ -1,183 +1,299 @@
-import os
-import re
-import shutil
-from datetime import datetime
-from urllib.parse import unquote_plus
-
-from tqdm import tqdm
-
-try:
-    import filedate
-except ModuleNotFoundError:
-    filedate = None
-
-
-import requests
-
-PROTOCOL_RE = re.compile(r"^(https?)://")
-def url_join(*urls: str, domain=""):
-    if not urls:
-        return ""
-    if urls[0].startswith("/") and not domain: # Do not allow absolutes with no domain
-        raise ValueError("Cannot append url with no known domain")
-
-    string = ""
-    protocol = ""
-    first = True
-    for url in urls:
-        url = url.strip()
-        if not url:
-            continue
-        if first:
-            protocol_re = PROTOCOL_RE.search(url)
-            if protocol_re:
-                protocol = protocol_re.group(1)
-                url = url.split("://", 1)[1]
-            domain = url.split("/", 1)[0]
-            first = False
-        if url and url[0] == "/": # root
-            string = domain
-            url = url.lstrip("/")
-        if string and string[-1] == "/":
-            string += url
-        else:
-            string += ("/" if string else "") + url
-
-    return f"{protocol}://{string}"
-
-def get_extension_from_url(url):
-    return url.split("?", 1)[0].rsplit(".", 1)[-1]
-
-def get_file_name_from_url(url):
-    return url.strip("/").split("?", 1)[0].rsplit("/", 1)[-1]
-
-def timestamp_to_iso(timestamp: int):
-    time = datetime.fromtimestamp(timestamp)
-    time = time.isoformat()
-    return time
-
-def set_creation_time(file, time: int):
-    if filedate:
-        ts = timestamp_to_iso(time)
-        filedate.File(file).set(
-            created=ts,
-            modified=ts,
-            accessed=ts,
-        )
-    else:
-        os.utime(file, times=(time,)*2) # type: ignore
-
-def download_item(url: str, store_path: str, timestamp: int = 0, retry_count: int = 0, force: bool = False, desc = None):
-    os.makedirs(os.path.dirname(store_path), exist_ok=True)
-    if retry_count > 3:
-        print("Retry Count Exceeded for", url)
-        return False
-    if os.path.exists(store_path) and not force:
-        print("Already exists", store_path, end="\r")
-        return False
-
-    with requests.get(url, stream=True) as context:
-        if context.status_code == 410:
-            print("Cannot download", url, "for error 410")
-            return False
-        if context.status_code // 100 == 5:
-            print("Server error on", url, context.status_code)
-            return download_item(url, store_path, timestamp, retry_count+1, desc=desc)
-        if context.status_code == 404:
-            print("Item deleted", url)
-            return False
-        
-        context.raise_for_status()
-        
-        if store_path == "memory":
-            return context.raw
-        
-        total_size = int(context.headers.get("content-length", 0))
-        with open(store_path, "wb") as f, tqdm(total=total_size, unit='B', unit_scale=True, desc=desc) as pbar:
-            # shutil.copyfileobj(context.raw, f)
-            for chunk in context.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    pbar.update(len(chunk))
-            
-        if timestamp > 0:
-            set_creation_time(store_path, timestamp)
-    
-    return True
-
-def disable_proxy(*domain):
-    if not domain or (domain and not domain[0]):
-        os.environ["NO_PROXY"] = "*"
-        return
-    domain = ','.join(domain)
-    os.environ["NO_PROXY"] = ",".join([os.environ.get("NO_PROXY",""), domain]).strip(",")
-    return
-
-def get_time_now():
-    return datetime.utcnow()
-
-def get_time_now_as_hour():
-    return get_time_now().strftime(r"%d-%m-%y_%H")
-
-def get_time_now_as_day():
-    return get_time_now().strftime(r"%d-%m-%y")
-
-def get_time_now_as_week():
-    return get_time_now().strftime(r"%W")
-
-def unquote_sid(sid):
-    if "%" in sid:
-        return unquote_plus(sid)
-    return sid
-
-def check_profile_pic_exists(pic_url, username, downloads_folder):
-    if not pic_url:
-        return None
-    pro_pic_name = get_file_name_from_url(pic_url)
-    pic_path = os.path.join(downloads_folder, username, "profile_pics", pro_pic_name)
-    return os.path.isfile(pic_path)
-    
-
-def verify_profile_pic(contains_user_iter, downloads_folder, current_missing_pics, force: bool = False, force_mode="hd"): # force mode will only force if it's HD
-    current_pics = {}
-    for item in contains_user_iter:
-        pic_user = item.get("user")
-        user_pic_hd_max = pic_user.get("hd_profile_pic_url_info", {}).get("url")
-        user_pic_hd = pic_user.get("profile_pic_url_hd")
-        user_pic_sd = pic_user.get("profile_pic_url")
-        user_obj = {
-            "id": pic_user.get("id"),
-            "sd_url": user_pic_sd,
-            "hd_url": user_pic_hd,
-            "hd_max_url": user_pic_hd_max,
-        }
-        user_username = pic_user.get("username")
-        if not user_username:
-            continue
-        if current_missing_pics.get(user_username, {}).get("hd_max_url"):
-            user_obj["hd_max_url"] = current_missing_pics.get(user_username, {}).get("hd_max_url")
-        if current_missing_pics.get(user_username, {}).get("hd_url"):
-            user_obj["hd_url"] = current_missing_pics.get(user_username, {}).get("hd_url")
-        if force:
-            if force_mode == "hd":
-                if user_pic_hd_max:
-                    current_pics[user_username] = user_obj
-                    continue
-            else:
-                current_pics[user_username] = user_obj
-        if check_profile_pic_exists(user_pic_hd_max or user_pic_hd or user_pic_sd, user_username, downloads_folder): # All profile picture urls give the same name
-            continue
-
-        current_pics[user_username] = user_obj
-    return current_pics
-        
-def download_profile_pic(pic_url, pic_user, downloads_folder, time_str, force: bool = False):
-    pro_pic_file = get_file_name_from_url(pic_url)
-    pro_pic_path = os.path.join(downloads_folder, pic_user, "profile_pics")
-    pro_pic_file_path = os.path.join(pro_pic_path, pro_pic_file)
-    dl_ret = download_item(pic_url, pro_pic_file_path, force=force, desc=f"{pic_user} profile photo")
-    pro_pic_file_path = os.path.join(pro_pic_path, "last.txt")
-    with open(pro_pic_file_path, "w") as f:
-        f.write(time_str)
-    return dl_ret
-    
+import os
+import re
+import time
+from contextlib import ExitStack
+from datetime import datetime
+from functools import lru_cache
+from importlib import import_module
+from typing import Optional
+from urllib.parse import unquote_plus
+
+from src.events import DOWNLOADED, EVENTS, FAILED, SKIPPED
+from src.log import get_logger
+from src.metrics import CACHE_HITS, DOWNLOAD_BYTES, DOWNLOAD_SECONDS, DOWNLOADS
+from src.tracing import TRACER
+
+PROTOCOL_RE = re.compile(r"^(https?)://")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+STALE_PART_SECONDS = 10 * 60 # A .part file nobody wrote to for this long belongs to a dead download
+
+log = get_logger(__name__)
+
+@lru_cache(maxsize=None)
+def optional_module(name: str):
+    # Optional and slow to import dependencies are imported when first used, so importing src stays cheap. None when not installed.
+    try:
+        return import_module(name)
+    except ModuleNotFoundError:
+        return None
+
+def url_join(*urls: str, domain=""):
+    if not urls:
+        return ""
+    if urls[0].startswith("/") and not domain: # Do not allow absolutes with no domain
+        raise ValueError("Cannot append url with no known domain")
+
+    string = ""
+    protocol = ""
+    first = True
+    for url in urls:
+        url = url.strip()
+        if not url:
+            continue
+        if first:
+            protocol_re = PROTOCOL_RE.search(url)
+            if protocol_re:
+                protocol = protocol_re.group(1)
+                url = url.split("://", 1)[1]
+            domain = url.split("/", 1)[0]
+            first = False
+        if url and url[0] == "/": # root
+            string = domain
+            url = url.lstrip("/")
+        if string and string[-1] == "/":
+            string += url
+        else:
+            string += ("/" if string else "") + url
+
+    return f"{protocol}://{string}"
+
+def get_extension_from_url(url):
+    return url.split("?", 1)[0].rsplit(".", 1)[-1]
+
+def get_file_name_from_url(url):
+    return url.strip("/").split("?", 1)[0].rsplit("/", 1)[-1]
+
+def timestamp_to_iso(timestamp: int):
+    time = datetime.fromtimestamp(timestamp)
+    time = time.isoformat()
+    return time
+
+def set_creation_time(file, time: int, fd: Optional[int] = None):
+    if fd is not None and os.utime in os.supports_fd: # No creation time on these platforms, so skip reopening the file
+        os.utime(fd, times=(time,)*2)
+    elif optional_module("filedate"):
+        ts = timestamp_to_iso(time)
+        optional_module("filedate").File(file).set(
+            created=ts,
+            modified=ts,
+            accessed=ts,
+        )
+    else:
+        os.utime(file, times=(time,)*2) # type: ignore
+
+def parse_size(size) -> int:
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size or 0))
+
+def format_size(size: float):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+class ServerError(Exception):
+    # A 5xx from the CDN, download_item tries again
+    pass
+
+def download_item(url: str, store_path: str, timestamp: int = 0, retry_count: int = 0, force: bool = False, desc = None, scheduler = None, key: str = "", storage = None, event: Optional[dict] = None):
+    storage = storage or local_storage()
+    event = dict(event or {}, path=store_path, owner=(event or {}).get("owner") or key or None, taken_at=timestamp or None)
+    storage.makedirs(os.path.dirname(store_path))
+    if retry_count > 3:
+        log.warning("Retry count exceeded for %s", url)
+        DOWNLOADS.inc(result="retries_exceeded")
+        EVENTS.emit(FAILED, reason="retries_exceeded", **event)
+        return False
+    with TRACER.span("exists", "fs"):
+        exists = storage.exists(store_path)
+    if exists and not force:
+        log.debug("Already exists %s", store_path)
+        DOWNLOADS.inc(result="exists")
+        CACHE_HITS.inc(kind="media_exists")
+        EVENTS.emit(SKIPPED, reason="exists", **event)
+        return False
+
+    import requests # Slow to import, only needed once there is something to download
+    try:
+        with requests.get(url, stream=True) as context:
+            if context.status_code == 410:
+                log.warning("Cannot download %s, it is gone (410)", url)
+                DOWNLOADS.inc(result="gone")
+                EVENTS.emit(FAILED, reason="gone", **event)
+                return False
+            if context.status_code // 100 == 5:
+                raise ServerError(context.status_code)
+            if context.status_code == 404:
+                log.info("Item deleted %s", url)
+                DOWNLOADS.inc(result="not_found")
+                EVENTS.emit(FAILED, reason="not_found", **event)
+                return False
+
+            context.raise_for_status()
+
+            if store_path == "memory":
+                return context.raw
+
+            with DOWNLOAD_SECONDS.time(), TRACER.span(get_file_name_from_url(url), "download", user=key):
+                written = storage.save_response(context, store_path, timestamp, desc=desc, scheduler=scheduler, key=key, force=force)
+            if written is None:
+                log.debug("Already being downloaded %s", store_path)
+                DOWNLOADS.inc(result="in_progress")
+                EVENTS.emit(SKIPPED, reason="in_progress", **event)
+                return False
+            DOWNLOADS.inc(result="downloaded")
+            DOWNLOAD_BYTES.inc(written, user=key)
+            log.debug("%s: %s", desc or store_path, format_size(written))
+            EVENTS.emit(DOWNLOADED, size=written, **event)
+    except ServerError as e:
+        log.warning("Server error %s on %s, retrying", e, url)
+        DOWNLOADS.inc(result="server_error")
+    except Exception as e:
+        EVENTS.emit(FAILED, reason=repr(e), **event)
+        raise
+    else:
+        return True
+    # Retried outside the handlers above, a retry that fails reports it once itself
+    return download_item(url, store_path, timestamp, retry_count+1, force, desc=desc, scheduler=scheduler, key=key, storage=storage, event=event)
+
+def claim_file(path: str):
+    # Exclusive create is atomic across processes and across machines sharing the folder, whoever creates the file does the download
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) < STALE_PART_SECONDS:
+                    return False
+                os.remove(path) # Left over from a download that died
+            except FileNotFoundError:
+                pass
+    return False
+
+def write_response(context, store_path: str, timestamp: int = 0, desc = None, scheduler = None, key: str = ""):
+    total_size = int(context.headers.get("content-length", 0))
+    # Encoded bodies need requests to decode them, raw reads are only safe for identity transfers
+    raw = context.raw if not context.headers.get("content-encoding") and hasattr(context.raw, "readinto") else None
+    buffer = bytearray(DOWNLOAD_CHUNK_SIZE)
+    view = memoryview(buffer)
+    written = 0
+    with open(store_path, "wb", buffering=0) as f, ExitStack() as stack:
+        if scheduler is not None:
+            stack.enter_context(scheduler.transfer(key))
+        fd = f.fileno()
+        if total_size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except OSError: # Not supported by the filesystem
+                pass
+
+        chunks = iter(lambda: raw.readinto(buffer), 0) if raw is not None else context.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+        for chunk in chunks:
+            size = chunk if raw is not None else len(chunk)
+            if not size:
+                continue
+            if scheduler is not None:
+                scheduler.throttle(key, size)
+            data = view[:size] if raw is not None else chunk
+            while data:
+                data = data[f.write(data):]
+            written += size
+
+        if written != total_size:
+            f.truncate(written) # Drop the preallocated tail if the server sent less
+        if timestamp > 0 and os.utime in os.supports_fd:
+            set_creation_time(store_path, timestamp, fd)
+
+    if timestamp > 0 and os.utime not in os.supports_fd:
+        set_creation_time(store_path, timestamp)
+    return written
+
+def local_storage():
+    from src.storage import LOCAL_STORAGE # src.storage imports this module
+    return LOCAL_STORAGE
+
+def disable_proxy(*domain):
+    if not domain or (domain and not domain[0]):
+        os.environ["NO_PROXY"] = "*"
+        return
+    domain = ','.join(domain)
+    os.environ["NO_PROXY"] = ",".join([os.environ.get("NO_PROXY",""), domain]).strip(",")
+    return
+
+def get_time_now():
+    return datetime.utcnow()
+
+def get_time_now_as_hour():
+    return get_time_now().strftime(r"%d-%m-%y_%H")
+
+def get_time_now_as_day():
+    return get_time_now().strftime(r"%d-%m-%y")
+
+def get_time_now_as_week():
+    return get_time_now().strftime(r"%W")
+
+def unquote_sid(sid):
+    if "%" in sid:
+        return unquote_plus(sid)
+    return sid
+
+def check_profile_pic_exists(pic_url, username, downloads_folder, storage = None):
+    if not pic_url:
+        return None
+    pro_pic_name = get_file_name_from_url(pic_url)
+    pic_path = os.path.join(downloads_folder, username, "profile_pics", pro_pic_name)
+    return (storage or local_storage()).exists(pic_path)
+    
+
+def verify_profile_pic(contains_user_iter, downloads_folder, current_missing_pics, force: bool = False, force_mode="hd", storage = None): # force mode will only force if it's HD
+    current_pics = {}
+    for item in contains_user_iter:
+        pic_user = item.get("user")
+        user_pic_hd_max = pic_user.get("hd_profile_pic_url_info", {}).get("url")
+        user_pic_hd = pic_user.get("profile_pic_url_hd")
+        user_pic_sd = pic_user.get("profile_pic_url")
+        user_obj = {
+            "id": pic_user.get("id"),
+            "sd_url": user_pic_sd,
+            "hd_url": user_pic_hd,
+            "hd_max_url": user_pic_hd_max,
+        }
+        user_username = pic_user.get("username")
+        if not user_username:
+            continue
+        if current_missing_pics.get(user_username, {}).get("hd_max_url"):
+            user_obj["hd_max_url"] = current_missing_pics.get(user_username, {}).get("hd_max_url")
+        if current_missing_pics.get(user_username, {}).get("hd_url"):
+            user_obj["hd_url"] = current_missing_pics.get(user_username, {}).get("hd_url")
+        if force:
+            if force_mode == "hd":
+                if user_pic_hd_max:
+                    current_pics[user_username] = user_obj
+                    continue
+            else:
+                current_pics[user_username] = user_obj
+        if check_profile_pic_exists(user_pic_hd_max or user_pic_hd or user_pic_sd, user_username, downloads_folder, storage): # All profile picture urls give the same name
+            CACHE_HITS.inc(kind="profile_pic_exists")
+            continue
+
+        current_pics[user_username] = user_obj
+    return current_pics
+        
+def download_profile_pic(pic_url, pic_user, downloads_folder, time_str, force: bool = False, scheduler = None, storage = None):
+    storage = storage or local_storage()
+    pro_pic_file = get_file_name_from_url(pic_url)
+    pro_pic_path = os.path.join(downloads_folder, pic_user, "profile_pics")
+    pro_pic_file_path = os.path.join(pro_pic_path, pro_pic_file)
+    dl_ret = download_item(
+        pic_url, pro_pic_file_path, force=force, desc=f"{pic_user} profile photo", scheduler=scheduler, key=pic_user, storage=storage,
+        event={"kind": "profile_pic", "collection": "profile_pics", "owner": pic_user},
+    )
+    pro_pic_file_path = os.path.join(pro_pic_path, "last.txt")
+    storage.write_text(pro_pic_file_path, time_str)
+    return dl_ret
+    
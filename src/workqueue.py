@@ -0,0 +1,323 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+try:
+    import redis
+except ModuleNotFoundError:
+    redis = None
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+MAX_ATTEMPTS = 3
+
+
+def open_queue(url: str, max_attempts: int = MAX_ATTEMPTS):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisQueue(url, max_attempts)
+    if url.startswith("sqlite://"):
+        url = url[len("sqlite://"):]
+    return SQLiteQueue(url, max_attempts)
+
+
+class SQLiteQueue:
+    # One database file on storage every node can reach. Rollback journal instead of WAL since WAL needs shared memory, which network filesystems don't have.
+    def __init__(self, path: str, max_attempts: int = MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock() # The lease renewer shares the connection, one transaction at a time
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        with self.transaction():
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, category TEXT NOT NULL, priority INTEGER NOT NULL, payload TEXT NOT NULL, "
+                "state TEXT NOT NULL, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT, error TEXT, updated REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, category, priority)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def transaction(self):
+        return _Transaction(self.db, self._lock)
+
+    def put(self, job_id: str, category: str, payload: dict, priority: int):
+        with self.transaction():
+            row = self.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row and row[0] in (QUEUED, LEASED):
+                return False
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs (id, category, priority, payload, state, attempts, updated) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (job_id, category, priority, json.dumps(payload, ensure_ascii=False), QUEUED, time.time()),
+            )
+        return True
+
+    def lease(self, worker: str, lease_time: float, categories: Iterable[str]) -> Optional[dict]:
+        categories = list(categories)
+        marks = ",".join("?" * len(categories))
+        now = time.time()
+        with self.transaction():
+            self._expire(now)
+            row = self.db.execute(
+                f"SELECT id, category, payload, attempts FROM jobs WHERE state = ? AND category IN ({marks}) ORDER BY priority, rowid LIMIT 1",
+                (QUEUED, *categories),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (LEASED, worker, now + lease_time, now, row[0]),
+            )
+        return {"id": row[0], "category": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1}
+
+    def expire(self):
+        with self.transaction():
+            self._expire(time.time())
+
+    def _expire(self, now: float):
+        # Jobs of workers that stopped renewing go back in the queue, or fail for good once they used up their attempts
+        self.db.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, error = 'lease expired', updated = ? "
+            "WHERE state = ? AND lease_until < ?",
+            (self.max_attempts, FAILED, QUEUED, now, LEASED, now),
+        )
+
+    def renew(self, job_id: str, worker: str, lease_time: float):
+        with self.transaction():
+            cur = self.db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND state = ? AND worker = ?",
+                (time.time() + lease_time, job_id, LEASED, worker),
+            )
+        return cur.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, result: dict):
+        with self.transaction():
+            cur = self.db.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = NULL, updated = ? WHERE id = ? AND state = ? AND worker = ?",
+                (DONE, json.dumps(result), time.time(), job_id, LEASED, worker),
+            )
+        return cur.rowcount == 1
+
+    def fail(self, job_id: str, worker: str, error: str):
+        with self.transaction():
+            cur = self.db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, error = ?, updated = ? "
+                "WHERE id = ? AND state = ? AND worker = ?",
+                (self.max_attempts, FAILED, QUEUED, error, time.time(), job_id, LEASED, worker),
+            )
+        return cur.rowcount == 1
+
+    def _read(self, query: str, params = ()):
+        with self._lock:
+            return self.db.execute(query, params).fetchall()
+
+    def counts(self, categories: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        query = "SELECT state, lease_until < ?, COUNT(*) FROM jobs"
+        params: list = [time.time()]
+        if categories is not None:
+            categories = list(categories)
+            query += f" WHERE category IN ({','.join('?' * len(categories))})"
+            params.extend(categories)
+        counts = {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0, "expired": 0}
+        for state, expired, count in self._read(query + " GROUP BY 1, 2", params):
+            counts[state] += count
+            if state == LEASED and expired:
+                counts["expired"] += count
+        return counts
+
+    def failures(self):
+        return self._read("SELECT id, error FROM jobs WHERE state = ?", (FAILED,))
+
+    def unfinished(self):
+        return self._read("SELECT id, state, worker FROM jobs WHERE state IN (?, ?) ORDER BY priority, rowid", (QUEUED, LEASED))
+
+    def set_open(self, is_open: bool):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('open', ?)", ("1" if is_open else "0",))
+
+    def is_open(self):
+        rows = self._read("SELECT value FROM meta WHERE key = 'open'")
+        return bool(rows) and rows[0][0] == "1"
+
+    def close(self):
+        self.db.close()
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front so two workers can't lease the same row, the thread lock keeps our own threads apart
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+# Jobs live in one hash as json, queued ids in a sorted set per category scored by priority, leased ids in a sorted set scored by lease expiry.
+# Everything that reads and then writes runs as a script so it is atomic on the server.
+_EXPIRE = """
+local prefix, now, max_attempts = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', prefix .. 'leases', '-inf', now)) do
+    redis.call('ZREM', prefix .. 'leases', id)
+    local job = cjson.decode(redis.call('HGET', prefix .. 'jobs', id))
+    job.worker = ''
+    job.error = 'lease expired'
+    if job.attempts >= max_attempts then
+        job.state = 'failed'
+    else
+        job.state = 'queued'
+        redis.call('ZADD', prefix .. 'queued:' .. job.category, job.priority, id)
+    end
+    redis.call('HSET', prefix .. 'jobs', id, cjson.encode(job))
+end
+"""
+
+_PUT = """
+local prefix, id, job = ARGV[1], ARGV[2], cjson.decode(ARGV[3])
+local old = redis.call('HGET', prefix .. 'jobs', id)
+if old then
+    local state = cjson.decode(old).state
+    if state == 'queued' or state == 'leased' then return 0 end
+end
+redis.call('HSET', prefix .. 'jobs', id, ARGV[3])
+redis.call('ZADD', prefix .. 'queued:' .. job.category, job.priority, id)
+return 1
+"""
+
+_LEASE = _EXPIRE + """
+local worker, lease_until = ARGV[4], tonumber(ARGV[5])
+local best, best_score, best_key
+for i = 6, #ARGV do
+    local key = prefix .. 'queued:' .. ARGV[i]
+    local top = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    if #top > 0 and (best == nil or tonumber(top[2]) < best_score) then
+        best, best_score, best_key = top[1], tonumber(top[2]), key
+    end
+end
+if best == nil then return false end
+redis.call('ZREM', best_key, best)
+redis.call('ZADD', prefix .. 'leases', lease_until, best)
+local job = cjson.decode(redis.call('HGET', prefix .. 'jobs', best))
+job.state = 'leased'
+job.worker = worker
+job.attempts = job.attempts + 1
+local encoded = cjson.encode(job)
+redis.call('HSET', prefix .. 'jobs', best, encoded)
+return encoded
+"""
+
+_FINISH = """
+local prefix, id, worker, state, value, max_attempts = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], tonumber(ARGV[6])
+local raw = redis.call('HGET', prefix .. 'jobs', id)
+if not raw then return 0 end
+local job = cjson.decode(raw)
+if job.state ~= 'leased' or job.worker ~= worker then return 0 end
+if state == 'renew' then
+    redis.call('ZADD', prefix .. 'leases', tonumber(value), id)
+    return 1
+end
+redis.call('ZREM', prefix .. 'leases', id)
+job.worker = ''
+if state == 'done' then
+    job.state = 'done'
+    job.result = value
+    job.error = ''
+else
+    job.error = value
+    if job.attempts >= max_attempts then
+        job.state = 'failed'
+    else
+        job.state = 'queued'
+        redis.call('ZADD', prefix .. 'queued:' .. job.category, job.priority, id)
+    end
+end
+redis.call('HSET', prefix .. 'jobs', id, cjson.encode(job))
+return 1
+"""
+
+
+class RedisQueue:
+    def __init__(self, url: str, max_attempts: int = MAX_ATTEMPTS, prefix: str = "igdl:"):
+        if redis is None:
+            raise Exception("The redis package is needed for a redis:// queue, install it with pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.max_attempts = max_attempts
+        self.prefix = prefix
+        self._put = self.client.register_script(_PUT)
+        self._expire = self.client.register_script(_EXPIRE)
+        self._lease = self.client.register_script(_LEASE)
+        self._finish = self.client.register_script(_FINISH)
+
+    def put(self, job_id: str, category: str, payload: dict, priority: int):
+        job = {"id": job_id, "category": category, "priority": priority, "payload": payload, "state": QUEUED, "worker": "", "attempts": 0, "result": "", "error": ""}
+        return bool(self._put(args=[self.prefix, job_id, json.dumps(job, ensure_ascii=False)]))
+
+    def lease(self, worker: str, lease_time: float, categories: Iterable[str]) -> Optional[dict]:
+        now = time.time()
+        raw = self._lease(args=[self.prefix, now, self.max_attempts, worker, now + lease_time, *categories])
+        if not raw:
+            return None
+        job = json.loads(raw)
+        return {"id": job["id"], "category": job["category"], "payload": job["payload"], "attempts": job["attempts"]}
+
+    def expire(self):
+        self._expire(args=[self.prefix, time.time(), self.max_attempts])
+
+    def renew(self, job_id: str, worker: str, lease_time: float):
+        return bool(self._finish(args=[self.prefix, job_id, worker, "renew", time.time() + lease_time, self.max_attempts]))
+
+    def complete(self, job_id: str, worker: str, result: dict):
+        return bool(self._finish(args=[self.prefix, job_id, worker, DONE, json.dumps(result), self.max_attempts]))
+
+    def fail(self, job_id: str, worker: str, error: str):
+        return bool(self._finish(args=[self.prefix, job_id, worker, FAILED, error, self.max_attempts]))
+
+    def _jobs(self):
+        return [(job_id.decode(), json.loads(raw)) for job_id, raw in self.client.hscan_iter(self.prefix + "jobs")]
+
+    def counts(self, categories: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        categories = set(categories) if categories is not None else None
+        now = time.time()
+        expired = {job_id.decode() for job_id in self.client.zrangebyscore(self.prefix + "leases", "-inf", now)}
+        counts = {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0, "expired": 0}
+        for job_id, job in self._jobs():
+            if categories is not None and job["category"] not in categories:
+                continue
+            counts[job["state"]] += 1
+            if job["state"] == LEASED and job_id in expired:
+                counts["expired"] += 1
+        return counts
+
+    def failures(self):
+        return [(job_id, job["error"]) for job_id, job in self._jobs() if job["state"] == FAILED]
+
+    def unfinished(self):
+        jobs = [(job["priority"], job_id, job["state"], job["worker"]) for job_id, job in self._jobs() if job["state"] in (QUEUED, LEASED)]
+        return [(job_id, state, worker) for _, job_id, state, worker in sorted(jobs)]
+
+    def set_open(self, is_open: bool):
+        self.client.set(self.prefix + "open", "1" if is_open else "0")
+
+    def is_open(self):
+        return self.client.get(self.prefix + "open") == b"1"
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,67 @@
+import os
+import threading
+
+from src.api import InstagramDownloader
+
+
+def test_tag_copy_waits_for_a_download_someone_else_claimed(tmp_path):
+    source = str(tmp_path / "owner" / "posts" / "1.jpg")
+    target = str(tmp_path / "tagged" / "posts" / "tagged" / "1.jpg")
+    os.makedirs(os.path.dirname(source))
+    os.makedirs(os.path.dirname(target))
+    open(source + ".part", "wb").close() # Another worker is downloading it
+
+    instagram = InstagramDownloader("")
+    instagram._link(source, target, 0, "image", {})
+    assert instagram.deferred_copies and not os.path.exists(target)
+
+    def finish_download():
+        with open(source, "wb") as f:
+            f.write(b"image")
+        os.remove(source + ".part")
+
+    threading.Timer(0.5, finish_download).start()
+    instagram.finish_copies(timeout=10)
+    assert open(target, "rb").read() == b"image"
+    assert not instagram.deferred_copies
+
+
+def test_tag_copy_of_a_missing_file_is_not_deferred(tmp_path):
+    instagram = InstagramDownloader("")
+    instagram._link(str(tmp_path / "gone.jpg"), str(tmp_path / "copy.jpg"), 0, "image", {})
+    assert not instagram.deferred_copies
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def test_highlight_cover_falls_back_when_the_cropped_version_is_missing(monkeypatch):
+    tray = [
+        {"id": "highlight:1", "title": "a", "cover_media": {"media_id": "11", "cropped_image_version": {"url": "https://cdn/cropped.jpg"}}},
+        {"id": "highlight:2", "title": "b", "cover_media": {"media_id": "12", "full_image_version": {"url": "https://cdn/full.jpg"}}},
+        {"id": "highlight:3", "title": "c", "cover_media": {"media_id": "13"}},
+        {"id": "highlight:4", "title": "d"},
+    ]
+    instagram = InstagramDownloader("")
+    monkeypatch.setattr(instagram, "_get_request", lambda url, auth: Response({"tray": tray}))
+    monkeypatch.setattr("src.api.decode_response", lambda response: response.json())
+    highlights_data, _ = instagram.get_highlights_data("1")
+    assert [highlights_data[h_id]["thumbnail_url"] for h_id in "1234"] == ["https://cdn/cropped.jpg", "https://cdn/full.jpg", "", ""]
+
+
+def test_every_thread_gets_its_own_session():
+    instagram = InstagramDownloader("abc")
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(instagram.session)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert instagram.session is instagram.session
+    assert len({id(session) for session in sessions + [instagram.session]}) == 5
+    assert all(session.cookies.get("sessionid") == "abc" for session in sessions)
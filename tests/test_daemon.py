@@ -0,0 +1,60 @@
+import time
+
+from src.daemon import FAILURE_BACKOFF, Daemon
+from src.storage import LocalStorage
+
+
+class FakeRunner:
+    # The parts of CategoryRunner the daemon uses, with posts of "broken" failing like a rate limited feed page
+    def __init__(self, failing_stories: bool = False):
+        self.username_mappings = {"1": "broken", "2": "fine"}
+        self.profile_pic_download = False
+        self.storage = LocalStorage()
+        self.failing_stories = failing_stories
+        self.polled = []
+
+    def download_stories(self, user_ids):
+        if self.failing_stories:
+            raise ConnectionError("429 Too Many Requests")
+        return {}
+
+    def download_posts(self, user_id, username, backfill_pages=0):
+        self.polled.append(username)
+        if username == "broken":
+            raise KeyError("items")
+        return [{"time": int(time.time())}]
+
+    def download_highlights(self, user_id, username):
+        return {}
+
+    def backfill_left(self, username):
+        return False
+
+    def retry_unresolved(self, now=None):
+        return False
+
+
+def test_failed_poll_backs_off_without_stopping_the_daemon(tmp_path):
+    runner = FakeRunner()
+    daemon = Daemon({"cat": runner}, str(tmp_path), dl_story=False, dl_high=False)
+    now = time.time()
+    daemon.run_cycle(now)
+
+    assert runner.polled == ["broken", "fine"]
+    broken = daemon.schedules[("1", "posts")]
+    assert broken.failures == 1
+    assert now + FAILURE_BACKOFF * 0.9 < broken.next_poll < now + FAILURE_BACKOFF * 1.1
+    assert daemon.schedules[("2", "posts")].failures == 0
+
+    daemon.run_cycle(broken.next_poll)
+    assert broken.failures == 2
+    assert broken.next_poll > time.time() + FAILURE_BACKOFF * 1.9 # Doubled
+
+
+def test_failed_story_poll_backs_off_every_user_in_it(tmp_path):
+    daemon = Daemon({"cat": FakeRunner(failing_stories=True)}, str(tmp_path), dl_posts=False, dl_high=False)
+    daemon.run_cycle(time.time())
+    assert [daemon.schedules[(user_id, "stories")].failures for user_id in ("1", "2")] == [1, 1]
+    daemon.save_state()
+    daemon.load_state()
+    assert daemon.saved_state["schedules"]["1:stories"]["failures"] == 1
@@ -0,0 +1,44 @@
+from src.distributed import Worker
+from src.workqueue import DONE, SQLiteQueue
+
+
+class FakeInstagram:
+    def finish_copies(self):
+        pass
+
+
+class FakeRunner:
+    # A user with three more backfill steps left after the newest page
+    def __init__(self, category):
+        self.category = category
+        self.username_mappings = {}
+        self.missing_profile_pic_ids = {}
+        self.instagram = FakeInstagram()
+        self.pages_left = 3
+        self.calls = 0
+
+    def load_mappings(self):
+        pass
+
+    def download_posts(self, user_id, username, backfill_pages=0):
+        self.calls += 1
+        return [{"id": self.calls}]
+
+    def backfill_left(self, username):
+        self.pages_left -= 1
+        return self.pages_left >= 0
+
+
+def test_worker_backfill_runs_until_the_cursor_is_done(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / "queue.db"))
+    runner = FakeRunner("cat")
+    worker = Worker(queue, lambda category: runner, ["cat"], worker_id="w1")
+    queue.put("cat:posts:1", "cat", {"category": "cat", "phase": "posts", "users": [["1", "user"]]}, 1)
+    while True:
+        job = queue.lease("w1", 60, ["cat"])
+        if job is None:
+            break
+        worker.run_job(job)
+    assert runner.calls == 4 # The newest page, then one backfill job per step
+    assert queue.counts(["cat"])[DONE] == 4
+    queue.close()
@@ -0,0 +1,44 @@
+import json
+
+from src.events import DOWNLOADED, CommandSink, EventLog, JsonlSink, read_events
+
+
+def test_partial_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    with open(path, "wb") as f:
+        f.write(b'{"seq": 1, "event": "downloaded"}\n{"seq": 2, "event": "downl')
+    events = EventLog()
+    sink = JsonlSink(path)
+    events.add_sink(sink)
+    assert events.seq == 1
+    events.emit(DOWNLOADED, path="a.jpg")
+    events.close()
+    assert [event["seq"] for event in read_events(path)] == [1, 2]
+
+
+def test_command_sink_that_exited_drops_events(tmp_path):
+    events = EventLog()
+    sink = CommandSink("exit 0")
+    sink.process.wait()
+    events.add_sink(sink)
+    for _ in range(3):
+        events.emit(DOWNLOADED, path="a.jpg") # Doesn't raise into the download
+    assert sink.dropped == 3
+    events.close()
+
+
+def test_a_failing_sink_does_not_stop_the_others(tmp_path):
+    class Broken:
+        def write(self, line):
+            raise OSError("disk full")
+
+        def close(self):
+            pass
+
+    path = str(tmp_path / "events.jsonl")
+    events = EventLog()
+    events.add_sink(Broken())
+    events.add_sink(JsonlSink(path))
+    events.emit(DOWNLOADED, path="a.jpg")
+    events.close()
+    assert [json.loads(line)["path"] for line in open(path, encoding="utf-8")] == ["a.jpg"]
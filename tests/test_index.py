@@ -0,0 +1,68 @@
+import json
+import os
+
+from src.events import DOWNLOADED, REMOVED
+from src.index import COMPACT_SEGMENTS, INDEX_FILE, IndexSink, load_index, read_index, write_index
+
+
+class MemoryStorage:
+    # Object storage without append, like S3Storage
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+
+    def has_dir(self, path):
+        return any(key.startswith(path + os.sep) for key in self.objects) or path.endswith("meta")
+
+    def listdir(self, path):
+        return {key[len(path) + 1 :].split(os.sep, 1)[0] for key in self.objects if key.startswith(path + os.sep)}
+
+    def read_text(self, path, default=""):
+        self.gets += 1
+        return self.objects.get(path, default)
+
+    def write_text(self, path, text):
+        self.objects[path] = text
+
+    def remove(self, path):
+        self.objects.pop(path, None)
+
+
+def event(sink, kind, path, ts, **fields):
+    sink.write(json.dumps({"ts": ts, "event": kind, "path": path, **fields}).encode("utf-8"))
+
+
+def test_object_storage_gets_segments_instead_of_rewrites(tmp_path):
+    storage = MemoryStorage()
+    root = str(tmp_path)
+    sink = IndexSink(storage, root, interval=3600)
+    try:
+        for i in range(COMPACT_SEGMENTS - 1):
+            event(sink, DOWNLOADED, os.path.join(root, "user", "posts", f"{i}.jpg"), 1000 + i, size=10)
+            sink.flush()
+        assert storage.gets == 0 # Nothing was read back to append to
+        assert len(storage.objects) == COMPACT_SEGMENTS - 1
+        event(sink, REMOVED, os.path.join(root, "user", "posts", "0.jpg"), 2000)
+        files = load_index(storage, root, "user")
+        assert len(files) == COMPACT_SEGMENTS - 1 # The removal is still buffered
+    finally:
+        sink.close()
+
+    meta = os.path.join(root, "user", "meta")
+    assert list(storage.objects) == [os.path.join(meta, INDEX_FILE)] # Folded into one object when the run ends
+    files = load_index(storage, root, "user")
+    assert sorted(files) == sorted(os.path.join("user", "posts", f"{i}.jpg") for i in range(1, COMPACT_SEGMENTS - 1))
+
+
+def test_compaction_keeps_segments_written_after_it_read(tmp_path):
+    storage = MemoryStorage()
+    root = str(tmp_path)
+    meta = os.path.join(root, "user", "meta")
+    line = '{"path": "%s", "at": %d, "size": 1}\n'
+    storage.write_text(os.path.join(meta, "media.0000000000001-a.jsonl"), line % (os.path.join("user", "posts", "1.jpg"), 1))
+    files, segments = read_index(storage, root, "user")
+    storage.write_text(os.path.join(meta, "media.0000000000002-b.jsonl"), line % (os.path.join("user", "posts", "2.jpg"), 2)) # Another worker
+    write_index(storage, root, "user", files, segments)
+
+    assert sorted(storage.objects) == [os.path.join(meta, "media.0000000000002-b.jsonl"), os.path.join(meta, INDEX_FILE)]
+    assert sorted(load_index(storage, root, "user")) == [os.path.join("user", "posts", f"{i}.jpg") for i in (1, 2)]
@@ -0,0 +1,14 @@
+from src.jobs import BACKFILL, EPHEMERAL, Job, JobScheduler
+
+
+def test_backfill_limit_defers_the_rest():
+    ran = []
+
+    def page(n):
+        ran.append(n)
+        return [Job(f"posts page {n + 1}", lambda: page(n + 1), BACKFILL)] if n < 10 else []
+
+    jobs = JobScheduler(backfill_limit=2)
+    jobs.run_all([Job("posts page 1", lambda: page(1), BACKFILL), Job("stories", lambda: ran.append("stories"), EPHEMERAL)])
+    assert ran == ["stories", 1, 2]
+    assert [job.name for job in jobs.deferred] == ["posts page 3"]
@@ -0,0 +1,29 @@
+import os
+
+from src.index import load_index, write_index
+from src.layout import MONTH, migrate
+from src.storage import LocalStorage
+
+MARCH_2021 = 1615000000 # 2021-03-06
+MAY_2022 = 1652000000 # 2022-05-08
+
+
+def test_migrate_shards_like_downloads(tmp_path):
+    root = str(tmp_path)
+    posts = tmp_path / "user" / "posts"
+    (tmp_path / "user" / "meta").mkdir(parents=True)
+    posts.mkdir()
+    for name in ("1.jpg", "2.jpg", "3.jpg"):
+        (posts / name).write_bytes(b"x")
+    os.utime(posts / "2.jpg", (MARCH_2021, MARCH_2021)) # Not in the index, the mtime is its taken_at
+    storage = LocalStorage()
+    write_index(storage, root, "user", {
+        os.path.join("user", "posts", "1.jpg"): {"path": os.path.join("user", "posts", "1.jpg"), "at": 1, "taken_at": 0},
+        os.path.join("user", "posts", "3.jpg"): {"path": os.path.join("user", "posts", "3.jpg"), "at": 1, "taken_at": MAY_2022},
+    })
+
+    assert migrate(storage, root, MONTH) == 3
+    assert (posts / "unknown" / "1.jpg").exists() # Where a download without taken_at puts it, not the month it was downloaded in
+    assert (posts / "2021" / "03" / "2.jpg").exists()
+    assert (posts / "2022" / "05" / "3.jpg").exists()
+    assert os.path.join("user", "posts", "unknown", "1.jpg") in load_index(storage, root, "user")
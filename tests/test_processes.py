@@ -0,0 +1,8 @@
+from src.processes import make_shards
+
+
+def test_shards_skip_categories_without_users():
+    usernames_list = {"a": {"users": ["u1", "u2", "u3"]}, "b": {"users": []}, "c": {}}
+    assert make_shards(usernames_list, ["a", "b", "c"], 2) == [("a", ["u1", "u2", "u3"])]
+    assert make_shards(usernames_list, ["a", "b", "c"], 2, split_users=True) == [("a", ["u1"]), ("a", ["u2", "u3"])]
+    assert make_shards(usernames_list, ["b", "c"], 4, split_users=True) == []
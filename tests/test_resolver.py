@@ -0,0 +1,42 @@
+from src.resolver import RETRY_BACKOFF, UserResolver
+from src.storage import LocalStorage
+
+
+class FakeInstagram:
+    # Lookups of "flaky" fail until it is switched back on, "gone" doesn't exist
+    def __init__(self):
+        self.up = False
+        self.lookups = []
+
+    def get_user_profile(self, username):
+        self.lookups.append(username)
+        if username == "gone":
+            return None
+        if username == "flaky" and not self.up:
+            raise ConnectionError("429 Too Many Requests")
+        return {"id": f"id-{username}", "username": username}
+
+
+def test_failed_lookups_are_retried_after_a_backoff(tmp_path):
+    instagram = FakeInstagram()
+    resolver = UserResolver(instagram, LocalStorage(), str(tmp_path), rate=0)
+    now = 1_000_000
+
+    found, missing = resolver.resolve(["flaky", "gone", "fine"], now)
+    assert set(found) == {"fine"} and missing == ["gone"]
+    assert resolver.retry_due(now) == []
+    assert resolver.retry_due(now + RETRY_BACKOFF) == ["flaky"]
+
+    instagram.lookups.clear()
+    assert resolver.resolve(["flaky"], now + 60) == ({}, []) # Still backing off
+    assert instagram.lookups == []
+
+    resolver.resolve(["flaky"], now + RETRY_BACKOFF)
+    assert resolver.unresolved["flaky"][0] == 2
+    assert resolver.retry_due(now + RETRY_BACKOFF * 2) == [] # Doubled
+    assert resolver.retry_due(now + RETRY_BACKOFF * 3) == ["flaky"]
+
+    instagram.up = True
+    found, _ = resolver.resolve(["flaky"], now + RETRY_BACKOFF * 3)
+    assert set(found) == {"flaky"}
+    assert resolver.unresolved == {}
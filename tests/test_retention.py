@@ -0,0 +1,26 @@
+import os
+
+from src.retention import DAY, Policy, Retention
+
+
+def entry(path, taken_at, **fields):
+    return {"path": os.path.join(*path.split("/")), "at": taken_at, "taken_at": taken_at, "size": 10, **fields}
+
+
+def test_stories_that_can_still_be_up_are_kept(tmp_path):
+    now = 100 * DAY
+    files = {
+        e["path"]: e for e in [
+            entry("user/stories/old.jpg", now - 3 * DAY),
+            entry("user/stories/live.jpg", now - 3600),
+            entry("user/stories/seen.jpg", 0, at=now - 2 * DAY, seen=now - 600), # No taken_at, but it was up a moment ago
+            entry("user/posts/post.jpg", now - 3600),
+        ]
+    }
+    retention = Retention([Policy("stories", keep=0, max_size=1), Policy("posts", days=0.01)], downloads_folder=str(tmp_path))
+    retention._indexes["user"] = files
+    plan = retention.plan("user", now)
+    assert [(policy.collection, [e["path"] for e in entries]) for policy, entries in plan] == [
+        ("stories", [os.path.join("user", "stories", "old.jpg")]),
+        ("posts", [os.path.join("user", "posts", "post.jpg")]),
+    ]
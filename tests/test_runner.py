@@ -0,0 +1,74 @@
+import json
+
+from src.metrics import SESSIONS
+from src.runner import CategoryRunner
+
+
+def test_highlight_without_a_cover_url_is_skipped(tmp_path, monkeypatch):
+    runner = CategoryRunner("default", "", ["user"], str(tmp_path), sleep_duration=0, profile_pic_download=False)
+    (tmp_path / "user" / "meta").mkdir(parents=True)
+    (tmp_path / "user" / "highlights" / "1").mkdir(parents=True) # download_list makes it
+    monkeypatch.setattr(runner.instagram, "get_story_reels_data", lambda ids: {"reels": {"highlight:1": {"id": "highlight:1", "items": []}}})
+    monkeypatch.setattr(runner.instagram, "download_list", lambda *args, **kwargs: None)
+
+    highlights_data = {"1": {"title": "a", "id": "1", "reels": [], "thumbnail_url": "", "latest_reel_media": 5, "media_count": 0, "cover_id": "11", "thumbnail_cover": ""}}
+    runner.download_highlights_page("1", "user", highlights_data, {}, ["highlight:1"], 1, 1)
+
+    saved = json.loads((tmp_path / "user" / "meta" / "highlights.json").read_text())
+    assert saved["1"]["cover_id"] == "11" and saved["1"]["thumbnail_cover"] == "" # So the next run tries the thumbnail again
+    assert (tmp_path / "user" / "highlights" / "1" / "name.txt").read_text() == "a"
+
+
+def test_missing_cover_retries_only_the_thumbnail(tmp_path, monkeypatch):
+    runner = CategoryRunner("default", "", ["user"], str(tmp_path), sleep_duration=0, profile_pic_download=False)
+    (tmp_path / "user" / "meta").mkdir(parents=True)
+    reels = [{"id": "5", "time": 5}]
+    old = {"title": "a", "id": "1", "reels": reels, "thumbnail_url": "", "latest_reel_media": 5, "media_count": 1, "cover_id": "11", "thumbnail_cover": ""}
+    runner.save_highlights("user", {"1": old})
+    tray = {"title": "a", "id": "1", "reels": [], "thumbnail_url": "", "latest_reel_media": 5, "media_count": 1, "cover_id": "11"}
+    monkeypatch.setattr(runner.instagram, "get_highlights_data", lambda user_id: ({"1": dict(tray)}, ["highlight:1"]))
+    downloads = []
+    monkeypatch.setattr("src.runner.download_item", lambda url, path, **kwargs: downloads.append(url))
+
+    assert runner.download_highlight_tray("1", "user", {}) == [] # Items unchanged, nothing refetched
+    assert downloads == []
+
+    tray["thumbnail_url"] = "https://cdn/cover.jpg"
+    assert runner.download_highlight_tray("1", "user", {}) == []
+    assert downloads == ["https://cdn/cover.jpg"]
+    saved = runner.load_highlights("user")
+    assert saved["1"]["thumbnail_cover"] == "11" and saved["1"]["reels"] == reels
+
+
+def test_unresolved_users_are_looked_up_again_once_due(tmp_path, monkeypatch):
+    runner = CategoryRunner("default", "", ["flaky", "fine"], str(tmp_path), sleep_duration=0, profile_pic_download=False)
+    runner.resolver.rate.interval = 0
+    failing = {"flaky"}
+
+    def get_user_profile(username):
+        if username in failing:
+            raise ConnectionError("429 Too Many Requests")
+        return {"id": f"id-{username}", "profile_pic_url": f"https://cdn/{username}.jpg"}
+
+    monkeypatch.setattr(runner.instagram, "get_user_profile", get_user_profile)
+    monkeypatch.setattr("src.runner.download_profile_pic", lambda *args, **kwargs: True)
+    runner.prepare()
+    assert runner.username_mappings == {"id-fine": "fine"}
+    assert not runner.retry_unresolved() # Not due yet
+
+    failing.clear()
+    retry_at = runner.resolver.unresolved["flaky"][1]
+    assert runner.retry_unresolved(retry_at)
+    assert runner.username_mappings == {"id-fine": "fine", "id-flaky": "flaky"}
+    assert not runner.retry_unresolved(retry_at)
+
+
+def test_closed_runners_leave_the_sessions_gauge(tmp_path):
+    before = SESSIONS.get()
+    runners = [CategoryRunner(category, "", [], str(tmp_path)) for category in ("a", "b")]
+    assert SESSIONS.get() == before + 2
+    runners[0].close()
+    runners[0].close()
+    assert SESSIONS.get() == before + 1
+    runners[1].close()
+    assert SESSIONS.get() == before
@@ -0,0 +1,39 @@
+from src.stories import StoryStore
+from src.storage import LocalStorage
+
+DAY = 24 * 60 * 60
+
+
+def make_store(tmp_path, **kwargs):
+    (tmp_path / "user" / "meta").mkdir(parents=True) # The runner creates it with the user's folders
+    return StoryStore(LocalStorage(), str(tmp_path), **kwargs)
+
+
+def story(item_id, taken_at):
+    return {"id": item_id, "time": taken_at, "url": f"https://cdn/{item_id}.jpg"}
+
+
+def test_record_reads_the_store_once_per_run(tmp_path, monkeypatch):
+    store = make_store(tmp_path, compact_every=3)
+    loads = []
+    load = store.load
+    monkeypatch.setattr(store, "load", lambda *args, **kwargs: loads.append(args) or load(*args, **kwargs))
+
+    now = 10 * DAY
+    assert [item["id"] for item in store.record("user", [story(1, now - 100)], now)] == [1]
+    assert [item["id"] for item in store.record("user", [story(1, now - 100), story(2, now)], now + 60)] == [2]
+    assert len(loads) == 1
+    assert store.record("user", [story(2, now)], now + 120) == [] # Third poll compacts
+    assert len(loads) == 2
+
+    items = StoryStore(LocalStorage(), str(tmp_path)).items("user")
+    assert set(items) == {"1", "2"}
+    assert items["1"]["last_seen"] == now + 60 and items["2"]["last_seen"] == now + 120
+
+
+def test_record_forgets_stories_past_their_ttl(tmp_path):
+    store = make_store(tmp_path)
+    now = 10 * DAY
+    store.record("user", [story(1, now - 100), story(2, now)], now)
+    store.record("user", [story(2, now)], now + DAY)
+    assert set(store.recent["user"]) == {"2"}
@@ -0,0 +1,26 @@
+import pytest
+
+from src.transfers import TransferScheduler
+
+
+def fetch(url, key="", size_hint=0):
+    return url, key, size_hint
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_submit_passes_key_kwargs_through(workers):
+    # download_item takes key= and size_hint= itself, they must not collide with submit's own parameters
+    transfers = TransferScheduler(workers=workers)
+    try:
+        future = transfers.submit("owner", 1024, fetch, "https://cdn/1.jpg", key="owner", size_hint=5)
+        assert future.result(timeout=5) == ("https://cdn/1.jpg", "owner", 5)
+    finally:
+        transfers.close()
+
+
+def test_failures_are_counted_and_raised():
+    transfers = TransferScheduler()
+    future = transfers.submit("owner", 1, fetch, "url", missing=True)
+    with pytest.raises(TypeError):
+        transfers.wait([future])
+    assert transfers.stats()["failed"] == 1
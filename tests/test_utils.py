@@ -0,0 +1,58 @@
+import json
+import sys
+import types
+
+import pytest
+
+from src.events import EVENTS
+from src.utils import download_item
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+
+class Sink:
+    def __init__(self):
+        self.events = []
+
+    def write(self, line):
+        self.events.append(json.loads(line))
+
+    def close(self):
+        pass
+
+
+def test_server_error_then_failure_emits_one_failed_event(tmp_path, monkeypatch):
+    statuses = iter([503, 403])
+    monkeypatch.setitem(sys.modules, "requests", types.SimpleNamespace(get=lambda url, stream: Response(next(statuses))))
+    sink = Sink()
+    EVENTS.add_sink(sink)
+    try:
+        with pytest.raises(Exception, match="HTTP 403"):
+            download_item("https://cdn/1.jpg", str(tmp_path / "1.jpg"), key="owner")
+    finally:
+        EVENTS.remove_sink(sink)
+    assert [event["event"] for event in sink.events] == ["failed"]
+
+
+def test_server_errors_give_up_after_the_retries(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "requests", types.SimpleNamespace(get=lambda url, stream: Response(500)))
+    sink = Sink()
+    EVENTS.add_sink(sink)
+    try:
+        assert download_item("https://cdn/1.jpg", str(tmp_path / "1.jpg"), key="owner") is False
+    finally:
+        EVENTS.remove_sink(sink)
+    assert [(event["event"], event["reason"]) for event in sink.events] == [("failed", "retries_exceeded")]
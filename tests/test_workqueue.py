@@ -0,0 +1,73 @@
+import threading
+import time
+
+from src.workqueue import DONE, FAILED, LEASED, QUEUED, SQLiteQueue
+
+
+def make_queue(tmp_path, **kwargs):
+    return SQLiteQueue(str(tmp_path / "queue.db"), **kwargs)
+
+
+def test_jobs_are_leased_by_priority_and_finished_once(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.put("cat:posts:1", "cat", {"n": 1}, 2)
+    assert queue.put("cat:stories:1", "cat", {"n": 2}, 1)
+    assert not queue.put("cat:posts:1", "cat", {"n": 1}, 2) # Already queued
+
+    job = queue.lease("w1", 60, ["cat"])
+    assert job["id"] == "cat:stories:1" and job["payload"] == {"n": 2} and job["attempts"] == 1
+    assert not queue.put("cat:stories:1", "cat", {"n": 2}, 1) # Leased
+    assert not queue.complete(job["id"], "w2", {}) # Someone else's lease
+    assert queue.complete(job["id"], "w1", {"items": 3})
+    assert queue.put("cat:stories:1", "cat", {"n": 2}, 1) # Done, so the next run can queue it again
+    assert queue.lease("w1", 60, ["other"]) is None
+    queue.close()
+
+
+def test_failed_and_expired_jobs_come_back_until_out_of_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    queue.put("cat:posts:1", "cat", {}, 1)
+    job = queue.lease("w1", 60, ["cat"])
+    assert queue.fail(job["id"], "w1", "boom")
+    assert queue.counts()[QUEUED] == 1
+
+    queue.lease("w1", -1, ["cat"]) # Lease already ran out, the worker died
+    assert queue.counts()[LEASED] == 1
+    queue.expire()
+    assert queue.counts()[FAILED] == 1
+    assert queue.failures() == [("cat:posts:1", "lease expired")]
+    queue.close()
+
+
+def test_lease_renewer_and_worker_can_share_the_queue(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.put("cat:posts:0", "cat", {}, 1)
+    job = queue.lease("w1", 60, ["cat"])
+    errors = []
+    stop = threading.Event()
+
+    def renew():
+        while not stop.is_set():
+            try:
+                assert queue.renew(job["id"], "w1", 60)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    renewers = [threading.Thread(target=renew) for _ in range(2)]
+    for renewer in renewers:
+        renewer.start()
+    deadline = time.monotonic() + 1
+    i = 0
+    while time.monotonic() < deadline and not errors:
+        i += 1
+        queue.put(f"cat:posts:{i}", "cat", {}, 1)
+        other = queue.lease("w1", 60, ["cat"])
+        queue.complete(other["id"], "w1", {})
+        queue.counts(["cat"])
+    stop.set()
+    for renewer in renewers:
+        renewer.join()
+    assert errors == []
+    assert queue.counts(["cat"])[DONE] == i
+    queue.close()